@@ -0,0 +1,107 @@
+"""Benchmark for sharing persona answers between identical questions.
+
+Asks ``--questions`` questions over ``--spread`` seconds against a stub Inquire API
+(``benchmarks/stub_inquire_api.py``), like a busy group where many users send the same
+question to the same persona. Questions are drawn from ``--distinct`` different
+(persona, question) pairs with a Zipf-like skew, some of them differing only in case and
+spacing and some only in punctuation, which must not share an answer. Runs once without :class:`AnswerCache` (every question starts its own inquiry) and
+once with all personas cached, and reports the inquiries created, the hit rate and p50/p99
+answer latency.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.answer_cache --questions 2000 --distinct 100
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.stub_inquire_api import StubInquireApi
+from clients.telegram.answer_cache import AnswerCache, normalize_question
+from clients.telegram.inquire import InquireClient
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def questions(args: argparse.Namespace) -> List[Tuple[float, str, str]]:
+    """``(delay, persona, question)`` of every question, the same for every run."""
+    rng = random.Random(0)
+    # questions come in threes to the same persona, differing only in an operator
+    pairs = [(f"persona-{i // 3 % 10}", f"What is the answer to {i // 3}{'+-*'[i % 3]}{i // 3}?")
+             for i in range(args.distinct)]
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(pairs))]
+    asked = []
+    for persona, question in rng.choices(pairs, weights, k=args.questions):
+        # the same question typed differently
+        if rng.random() < 0.3:
+            question = "  " + question.upper()
+        asked.append((rng.uniform(0, args.spread), persona, question))
+    return asked
+
+
+async def run(args: argparse.Namespace, personas: List[str]) -> Dict[str, Any]:
+    stub = StubInquireApi(("127.0.0.1", 0), latency=args.latency, jitter=args.jitter).start()
+    client = InquireClient(stub.url, "benchmark", max_connections=200)
+    cache = AnswerCache(personas, maxsize=args.cache_size, ttl=args.ttl)
+    latencies: List[float] = []
+
+    async def ask(delay: float, persona: str, question: str, user_id: int) -> None:
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+
+        async def inquire() -> Dict[str, Any]:
+            inquiry = await client.create_inquiry(user_id, persona, question)
+            return await client.wait_for_inquiry(inquiry['id'], timeout=45)
+
+        inquiry = await cache.answer(persona, question, inquire)
+        assert inquiry['status'] == 'COMPLETED'
+        # the stub's answer starts with the question, a shared answer must be to the same question
+        answered = normalize_question(inquiry['result']).split(": ", 1)[1]
+        assert answered.startswith(normalize_question(question)), (question, inquiry['result'])
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(delay, persona, question, user_id)
+                               for user_id, (delay, persona, question) in enumerate(questions(args))))
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.close()
+        stub.shutdown()
+
+    return {
+        "inquiries": stub.requests["POST"],
+        "hit rate": cache.hit_rate(),
+        "coalesced": cache.stats["coalesced"],
+        "answers/sec": args.questions / elapsed,
+        "p50 latency (s)": statistics.median(latencies),
+        "p99 latency (s)": percentile(latencies, 99),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    for name, personas in (("off", []), ("cached", ["*"])):
+        stats = await run(args, personas)
+        print(f"{name:>7}: " + ", ".join(
+            f"{key} = {value:.3f}" if isinstance(value, float) else f"{key} = {value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer cache benchmark against a stub Inquire API")
+    parser.add_argument("--questions", type=int, default=2000)
+    parser.add_argument("--distinct", type=int, default=100, help="different (persona, question) pairs")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the question popularity")
+    parser.add_argument("--spread", type=float, default=20.0, help="seconds over which the questions arrive")
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--jitter", type=float, default=1.0)
+    parser.add_argument("--ttl", type=float, default=60.0)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+"""A local stand-in for the Telegram Bot API, used by the benchmarks.
+
+Answers ``getMe``, ``sendMessage``, ``editMessageText``, ``deleteMessage`` and
+``sendChatAction`` and enforces Telegram's flood limits over sliding windows: 30 requests per
+second for the whole bot, one message per second in a private chat and 20 messages per minute
+in a group (negative chat id). Requests over a limit are answered with ``429`` and a ``retry_after``.
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+# (requests, seconds) per scope
+OVERALL_LIMIT = (30, 1.0)
+PRIVATE_LIMIT = (1, 1.0)
+GROUP_LIMIT = (20, 60.0)
+
+MESSAGE_ENDPOINTS = frozenset({"sendMessage", "editMessageText"})
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """Threaded HTTP server emulating a few methods of the Bot API, see the module docstring.
+
+    Args:
+        address (:obj:`tuple`): ``(host, port)`` to listen on, port ``0`` picks a free port.
+        latency (:obj:`float`, optional): Seconds every request takes.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address: Tuple[str, int], latency: float = 0.02):
+        super().__init__(address, FakeBotApiHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self._sent: Dict[Any, Deque[float]] = defaultdict(deque)
+        self._message_id = 0
+        self.rejected: Dict[str, int] = defaultdict(int)
+        self.counters = {"requests": 0, "messages": 0, "chat_actions": 0, "too_many_requests": 0}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _retry_after(self, scope: Any, limit: Tuple[int, float], now: float) -> Optional[float]:
+        count, period = limit
+        sent = self._sent[scope]
+        while sent and sent[0] <= now - period:
+            sent.popleft()
+        if len(sent) >= count:
+            return sent[0] + period - now
+        return None
+
+    def admit(self, endpoint: str, chat_id: Optional[str]) -> Optional[int]:
+        """Records a request, returns the seconds to retry after if it is over a limit."""
+        now = time.monotonic()
+        with self.lock:
+            self.counters["requests"] += 1
+            if chat_id is None:
+                return None
+            scopes = [("overall", OVERALL_LIMIT)]
+            if endpoint in MESSAGE_ENDPOINTS:
+                group = chat_id.startswith("-") or chat_id.startswith("@")
+                scopes.append((chat_id, GROUP_LIMIT if group else PRIVATE_LIMIT))
+            for scope, limit in scopes:
+                retry_after = self._retry_after(scope, limit, now)
+                if retry_after is not None:
+                    self.counters["too_many_requests"] += 1
+                    self.rejected[scope if scope == "overall" else "chat"] += 1
+                    return max(1, round(retry_after))
+            for scope, _ in scopes:
+                self._sent[scope].append(now)
+            self.counters["messages" if endpoint in MESSAGE_ENDPOINTS else "chat_actions"] += 1
+            self._message_id += 1
+            return None
+
+    def next_message_id(self) -> int:
+        with self.lock:
+            return self._message_id
+
+    def start(self) -> "FakeBotApi":
+        """Serves requests from a daemon thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeBotApi
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _respond(self, status: int, body: Any) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self) -> Dict[str, str]:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length).decode() if length else ""
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(raw or "{}")
+        return dict(parse_qsl(raw))
+
+    def do_POST(self) -> None:
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        body = self._body()
+        time.sleep(self.server.latency)
+
+        if endpoint == "getMe":
+            return self._respond(200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Inquire", "username": "inquire_fake_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True,
+            }})
+
+        chat_id = body.get("chat_id")
+        retry_after = self.server.admit(endpoint, None if chat_id is None else str(chat_id))
+        if retry_after is not None:
+            return self._respond(429, {"ok": False, "error_code": 429,
+                                       "description": f"Too Many Requests: retry after {retry_after}",
+                                       "parameters": {"retry_after": retry_after}})
+        if endpoint in ("sendChatAction", "deleteMessage"):
+            return self._respond(200, {"ok": True, "result": True})
+        if endpoint in MESSAGE_ENDPOINTS:
+            chat = int(chat_id)
+            return self._respond(200, {"ok": True, "result": {
+                "message_id": int(body.get("message_id") or self.server.next_message_id()),
+                "date": int(time.time()),
+                "chat": {"id": chat, "type": "group" if chat < 0 else "private"},
+                "text": body.get("text", ""),
+            }})
+        self._respond(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8788)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    server = FakeBotApi((args.host, args.port), latency=args.latency)
+    print(f"Fake Bot API listening on {server.url}/bot<token>/")
+    server.serve_forever()
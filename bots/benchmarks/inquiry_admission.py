@@ -0,0 +1,112 @@
+"""Benchmark for the inquiry admission controller under a spike of questions.
+
+Asks ``--questions`` questions from ``--users`` users within ``--spread`` seconds against a
+stub Inquire API (``benchmarks/stub_inquire_api.py``), like a large group all asking at
+once. Runs once without limits, every question starts its inquiry right away, and once
+through :class:`InquiryAdmission`. Reports the questions answered and turned away, the
+most inquiries the stub had running at once, the API requests per second and p50/p99 answer
+latency.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.inquiry_admission --questions 1000 --max-inflight 64
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Any, Dict, List
+
+from benchmarks.stub_inquire_api import StubInquireApi
+from clients.telegram.admission import AdmissionRejected, InquiryAdmission
+from clients.telegram.inquire import InquireClient
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def peak_concurrency(inquiries: List[Dict[str, Any]]) -> int:
+    """Most inquiries running at once on the stub."""
+    events = sorted([(inquiry["createdAt"], 1) for inquiry in inquiries]
+                    + [(inquiry["completesAt"], -1) for inquiry in inquiries])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+async def run(args: argparse.Namespace, admission: InquiryAdmission) -> Dict[str, Any]:
+    stub = StubInquireApi(("127.0.0.1", 0), latency=args.latency, jitter=args.jitter).start()
+    client = InquireClient(stub.url, "benchmark", max_connections=200)
+    rng = random.Random(0)
+    latencies: List[float] = []
+    shed: Dict[str, int] = {"user": 0, "full": 0, "timeout": 0}
+
+    async def ask(delay: float, user_id: int) -> None:
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        try:
+            async with admission.admit(user_id):
+                inquiry = await client.create_inquiry(user_id, "chat", f"question {rng.random()}")
+                inquiry = await client.wait_for_inquiry(inquiry['id'], timeout=args.timeout)
+        except AdmissionRejected as excp:
+            shed[excp.reason] += 1
+            return
+        assert inquiry['status'] == 'COMPLETED'
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(rng.uniform(0, args.spread), rng.randrange(args.users))
+                               for _ in range(args.questions)))
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.close()
+        stub.shutdown()
+
+    stats = admission.stats()
+    return {
+        "answered": len(latencies),
+        "shed user": shed["user"],
+        "shed full": shed["full"],
+        "shed timeout": shed["timeout"],
+        "peak upstream": peak_concurrency(list(stub.inquiries.values())),
+        "api requests/sec": (stub.requests["POST"] + stub.requests["GET"]) / elapsed,
+        "max waiting": stats["max_waiting_seen"],
+        "p50 latency (s)": statistics.median(latencies) if latencies else float("nan"),
+        "p99 latency (s)": percentile(latencies, 99),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    runs = (
+        ("off", lambda: InquiryAdmission(max_inflight=0, max_per_user=0)),
+        ("admitted", lambda: InquiryAdmission(max_inflight=args.max_inflight, max_per_user=args.max_per_user,
+                                              max_waiting=args.max_waiting, wait_timeout=args.wait_timeout)),
+    )
+    for name, admission in runs:
+        stats = await run(args, admission())
+        print(f"{name:>8}: " + ", ".join(
+            f"{key} = {value:.2f}" if isinstance(value, float) else f"{key} = {value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inquiry admission benchmark against a stub Inquire API")
+    parser.add_argument("--questions", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--spread", type=float, default=5.0, help="seconds over which the questions arrive")
+    parser.add_argument("--latency", type=float, default=3.0)
+    parser.add_argument("--jitter", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=45.0)
+    parser.add_argument("--max-inflight", type=int, default=64)
+    parser.add_argument("--max-per-user", type=int, default=3)
+    parser.add_argument("--max-waiting", type=int, default=256)
+    parser.add_argument("--wait-timeout", type=float, default=10.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,143 @@
+"""Load benchmark for the inquiry path of the Telegram bot.
+
+Starts a local stub Inquire API and completes ``--inquiries`` inquiries with at
+most ``--concurrency`` in flight in each of these modes:
+
+- ``blocking``: the previous blocking ``requests`` + sleep polling loop
+- ``fixed``: async requests, every inquiry polled every 0.5 s by its own loop
+- ``poller``: the shared :class:`InquiryPoller` with adaptive backoff
+- ``batch``: the shared poller using batch status lookups
+- ``notify``: completion notifications pushed by the stub, ``--drop-rate`` of them
+  lost to exercise the polling fallback
+
+Reports inquiries/sec, p50/p99 latency and poll requests per inquiry for each mode.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.inquiry_load --inquiries 200 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import requests
+
+from benchmarks.stub_inquire_api import StubInquireApi
+from clients.telegram.http_server import HttpServer
+from clients.telegram.inquire import InquireClient
+from clients.telegram.notifications import InquiryNotifier
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def blocking_inquiry(api_url: str, user_id: int) -> None:
+    """The previous implementation: blocking requests and a blocking poll inside a coroutine."""
+    payload = {"connectionType": "TELEGRAM", "connectionUserId": user_id, "queryType": "chat", "query": "hello"}
+    response = requests.post(api_url + "/inquiries", data=payload)
+    poll_url = api_url + "/inquiries/" + response.json()['data']['id']
+    while requests.get(poll_url).json()['data']['status'] != 'COMPLETED':
+        time.sleep(0.5)
+
+
+def fixed_step_inquiry(client: InquireClient) -> Callable[[str, int], Awaitable[None]]:
+    """An async client where every inquiry runs its own fixed 0.5 s poll loop."""
+    async def run(api_url: str, user_id: int) -> None:
+        inquiry = await client.create_inquiry(user_id, "chat", "hello")
+        while (await client.get_inquiry(inquiry['id']))['status'] != 'COMPLETED':
+            await asyncio.sleep(0.5)
+    return run
+
+
+def async_inquiry(client: InquireClient) -> Callable[[str, int], Awaitable[None]]:
+    async def run(api_url: str, user_id: int) -> None:
+        inquiry = await client.create_inquiry(user_id, "chat", "hello")
+        await client.wait_for_inquiry(inquiry['id'], timeout=45)
+    return run
+
+
+async def run_load(api_url: str, inquiry: Callable[[str, int], Awaitable[None]], total: int, concurrency: int) -> Dict[str, float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(user_id: int) -> None:
+        # latency is measured from submission, so time spent queued behind other inquiries counts
+        start = time.perf_counter()
+        async with semaphore:
+            await inquiry(api_url, user_id)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "inquiries/sec": total / elapsed,
+        "p50 latency (s)": statistics.median(latencies),
+        "p99 latency (s)": percentile(latencies, 99),
+    }
+
+
+async def run_mode(args: argparse.Namespace, mode: str) -> Dict[str, float]:
+    notifier = None
+    server = None
+    notify_url = None
+    if mode == "notify":
+        notifier = InquiryNotifier()
+        server = HttpServer("127.0.0.1", 0)
+        notifier.attach(server)
+        await server.start()
+        notify_url = f"http://127.0.0.1:{server.port}"
+
+    stub = StubInquireApi(("127.0.0.1", 0), latency=args.latency, jitter=args.jitter,
+                          notify_url=notify_url, drop_rate=args.drop_rate, batch=mode == "batch").start()
+    client = InquireClient(stub.url, "benchmark", max_connections=args.concurrency, notifier=notifier,
+                           fallback_step=args.fallback_step, batch_size=100 if mode == "batch" else 0)
+    try:
+        if mode == "blocking":
+            total = args.blocking_inquiries
+            stats = await run_load(stub.url, blocking_inquiry, total, args.concurrency)
+        elif mode == "fixed":
+            total = args.inquiries
+            stats = await run_load(stub.url, fixed_step_inquiry(client), total, args.concurrency)
+        else:
+            total = args.inquiries
+            stats = await run_load(stub.url, async_inquiry(client), total, args.concurrency)
+    finally:
+        await client.close()
+        if server is not None:
+            await server.stop()
+        stub.shutdown()
+
+    stats["polls/inquiry"] = stub.requests["GET"] / total
+    return stats
+
+
+async def main(args: argparse.Namespace) -> None:
+    modes = ["fixed", "poller", "batch", "notify"]
+    if not args.skip_blocking:
+        modes.insert(0, "blocking")
+    for mode in modes:
+        stats = await run_mode(args, mode)
+        print(f"{mode:>9}: " + ", ".join(f"{name} = {value:.3f}" for name, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inquiry load benchmark against a stub Inquire API")
+    parser.add_argument("--inquiries", type=int, default=500)
+    parser.add_argument("--blocking-inquiries", type=int, default=20,
+                        help="inquiries for the blocking mode, which runs them one at a time")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--jitter", type=float, default=1.0)
+    parser.add_argument("--drop-rate", type=float, default=0.05,
+                        help="share of completion notifications the stub drops in notify mode")
+    parser.add_argument("--fallback-step", type=float, default=5.0)
+    parser.add_argument("--skip-blocking", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,117 @@
+"""Benchmark of the cost of a log line on the thread logging it.
+
+Logs ``--lines`` lines like the per-message lines of the handlers, with the ids the tracing
+filter adds, and reports the microseconds per line spent by the caller:
+
+- formatting only, with the python-json-logger formatter used before, with
+  :class:`JsonFormatter` and the json module and with :class:`JsonFormatter` and orjson
+- logging to a slow stream, each write taking ``--write-delay`` seconds like stderr piped to
+  a busy log collector, written right away, through :class:`QueueLogging` and through
+  :class:`QueueLogging` keeping ``--sample`` of the lines
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.log_throughput --lines 50000
+"""
+
+import argparse
+import datetime
+import io
+import logging
+import time
+from typing import Callable, List
+
+from pythonjsonlogger import jsonlogger
+
+import clients.telegram.logs as logs
+from clients.telegram.logs import JsonFormatter, QueueLogging, SamplingFilter
+
+LOGGER = "clients.telegram.commands"
+
+
+class LegacyJsonFormatter(jsonlogger.JsonFormatter):
+    """The formatter server.py used before."""
+
+    def add_fields(self, log_record, record, message_dict):
+        super().add_fields(log_record, record, message_dict)
+        log_record['app'] = 'bots'
+        log_record['msg'] = record.message
+        if not log_record.get('time'):
+            now = int((datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+            log_record['time'] = now
+        if log_record.get('level'):
+            log_record['level'] = log_record['level'].upper()
+        else:
+            log_record['level'] = record.levelname
+
+
+class SlowStream(io.StringIO):
+    def __init__(self, delay: float) -> None:
+        super().__init__()
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return len(text)
+
+
+def record(i: int) -> logging.LogRecord:
+    record = logging.LogRecord(LOGGER, logging.INFO, __file__, 1, "Reply of %s parts sent", (1,), None)
+    record.trace_id = "67d446eb8de856da1dd3ece20f6a4e13"
+    record.span_id = "b1c58c54d58dc4f0"
+    record.update_id = 100000 + i
+    record.chat_id = 123456789
+    record.inquiry_id = "0577d16afc82406881661286be10776c"
+    return record
+
+
+def per_line(lines: int, func: Callable[[int], None]) -> float:
+    start = time.perf_counter()
+    for i in range(lines):
+        func(i)
+    return (time.perf_counter() - start) / lines * 1e6
+
+
+def bench_formatters(args: argparse.Namespace) -> None:
+    records = [record(i) for i in range(args.lines)]
+    orjson = logs.orjson
+    formatters = [("python-json-logger", LegacyJsonFormatter('%(level)s %(time)s %(msg)s %(name)s'))]
+    logs.orjson = None
+    formatters.append(("json", JsonFormatter(static_fields={"app": "bots"})))
+    results = [(name, per_line(args.lines, lambda i: formatter.format(records[i]))) for name, formatter in formatters]
+    logs.orjson = orjson
+    if orjson is not None:
+        formatter = JsonFormatter(static_fields={"app": "bots"})
+        results.append(("orjson", per_line(args.lines, lambda i: formatter.format(records[i]))))
+    for name, micros in results:
+        print(f"format {name:>18}: {micros:.2f} us/line")
+
+
+def bench_handlers(args: argparse.Namespace) -> None:
+    logger = logging.getLogger(LOGGER)
+    lines = args.lines // 10
+    runs: List[tuple] = [("direct", 0, None), ("queued", 10000, None),
+                         (f"queued, {args.sample:g} sampled", 10000, args.sample)]
+    for name, max_queue, sample in runs:
+        handler = logging.StreamHandler(SlowStream(args.write_delay))
+        handler.setFormatter(JsonFormatter(static_fields={"app": "bots"}))
+        filters = [SamplingFilter({LOGGER: sample})] if sample is not None else []
+        logging_ = QueueLogging([handler], filters=filters, max_queue=max_queue)
+        logging_.start(logging.INFO)
+        micros = per_line(lines, lambda i: logger.info("Reply of %s parts sent", 1, extra={"update_id": i}))
+        start = time.perf_counter()
+        logging_.stop()
+        drained = time.perf_counter() - start
+        stats = logging_.stats()
+        print(f"log {name:>21}: {micros:.2f} us/line on the caller, {stats['dropped']} dropped, "
+              f"{drained:.2f} s to drain")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Log line cost benchmark")
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--write-delay", type=float, default=0.0001, help="seconds a write to the stream takes")
+    parser.add_argument("--sample", type=float, default=0.1, help="share of the lines kept when sampling")
+    args = parser.parse_args()
+    bench_formatters(args)
+    bench_handlers(args)
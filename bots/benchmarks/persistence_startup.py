@@ -0,0 +1,148 @@
+"""Startup benchmark for :class:`MySQLPersistence`.
+
+Builds a SQLite database with ``--chats`` synthetic chats (and as many users), stored both
+in the legacy single-row ``Persistence`` table and in the normalized ``PersistenceEntry``
+table, then measures how long it takes until the bot could start handling updates, i.e.
+loading the persistence plus the ``get_chat_data``/``get_user_data`` calls the application
+makes while initializing, and the peak RSS of doing so, in each of these modes:
+
+- ``previous``: the previous loader, one ``SELECT`` per column and every blob decoded twice
+- ``legacy``: the single-row table loaded with one query
+- ``normalized``: the normalized table streamed row by row
+- ``lazy``: the normalized table with chat and user data loaded on first access
+
+Every mode runs in its own process so the peak RSS of one does not hide the next.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.persistence_startup --chats 1000000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.sql import text
+from telegram.ext import DictPersistence
+
+from clients.telegram.mysqlpersistence import MySQLPersistence
+
+MODES = ("previous", "legacy", "normalized", "lazy")
+
+
+def chat_value(i: int) -> Dict[str, str]:
+    return {"persona": f"persona-{i % 100}", "language": "en"}
+
+
+def create_dataset(path: str, chats: int) -> None:
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        """
+        CREATE TABLE Persistence (bot_data TEXT, chat_data TEXT, user_data TEXT,
+                                  callback_data TEXT, conversations TEXT);
+        CREATE TABLE PersistenceEntry (kind VARCHAR(32) NOT NULL, id VARCHAR(191) NOT NULL,
+                                       data TEXT NOT NULL, PRIMARY KEY (kind, id));
+        """
+    )
+
+    chat_data = {str(i): chat_value(i) for i in range(chats)}
+    bot_data = {"chats": chats}
+    # the legacy blobs are stored as json encoded strings
+    connection.execute(
+        "INSERT INTO Persistence VALUES (?, ?, ?, ?, ?)",
+        [json.dumps(json.dumps(value)) for value in (bot_data, chat_data, chat_data, [[], {}], {})],
+    )
+    for kind in ("chat_data", "user_data"):
+        connection.executemany(
+            "INSERT INTO PersistenceEntry VALUES (?, ?, ?)",
+            ((kind, key, json.dumps(value)) for key, value in chat_data.items()),
+        )
+    connection.execute("INSERT INTO PersistenceEntry VALUES ('bot_data', '', ?)", (json.dumps(bot_data),))
+    connection.commit()
+    connection.close()
+
+
+def previous_load(session: scoped_session) -> DictPersistence:
+    """The previous loader: a query per column, then DictPersistence parses every blob again."""
+    values = {}
+    for kind in ("chat_data", "user_data", "bot_data", "conversations", "callback_data"):
+        row = session.execute(text(f"SELECT {kind} FROM Persistence")).first()
+        values[kind] = json.loads(row[0]) if row is not None and row[0] else ""
+    return DictPersistence(
+        chat_data_json=values["chat_data"],
+        user_data_json=values["user_data"],
+        bot_data_json=values["bot_data"],
+    )
+
+
+async def measure(mode: str, path: str) -> Dict[str, float]:
+    session = scoped_session(sessionmaker(bind=create_engine(f"sqlite:///{path}")))
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if mode == "previous":
+        persistence = previous_load(session)
+    else:
+        persistence = MySQLPersistence(session=session, normalized=mode != "legacy", lazy=mode == "lazy")
+    loaded = time.perf_counter() - start
+    # what Application.initialize asks the persistence for
+    chats = len(await persistence.get_chat_data())
+    await persistence.get_user_data()
+    ready = time.perf_counter() - start
+
+    if mode == "lazy":
+        start = time.perf_counter()
+        await persistence.refresh_chat_data(1, {})
+        first_access = time.perf_counter() - start
+    else:
+        first_access = 0.0
+
+    return {
+        "load (s)": loaded,
+        "ready (s)": ready,
+        "first access (s)": first_access,
+        "chats in memory": chats,
+        # ru_maxrss is reported in KiB on Linux
+        "peak RSS (MiB)": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "RSS growth (MiB)": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024,
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "persistence.db")
+        start = time.perf_counter()
+        create_dataset(path, args.chats)
+        print(f"created {args.chats} chats and users in {time.perf_counter() - start:.1f} s")
+
+        for mode in args.modes:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.persistence_startup", "--measure", mode, "--db", path],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            stats = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>10}: " + ", ".join(f"{name} = {value:.3f}" for name, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MySQLPersistence startup benchmark on a SQLite dataset")
+    parser.add_argument("--chats", type=int, default=1_000_000)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--measure", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.measure:
+        print(json.dumps(asyncio.run(measure(arguments.measure, arguments.db))))
+    else:
+        main(arguments)
@@ -0,0 +1,70 @@
+"""Write benchmark for the persistence backends.
+
+Applies ``--updates`` chat data changes spread over ``--chats`` chats to each backend, both
+writing every change immediately and in write-behind mode (``--flush-interval``), then
+flushes. Reports updates/sec, rows written and the mean flush latency.
+
+- ``sqlite``: :class:`SQLitePersistence`, normalized tables in WAL mode
+- ``sqlite-legacy``: :class:`SQLitePersistence` with the single-row legacy table
+- ``file``: :class:`FilePersistence`, append-only log plus snapshot
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.persistence_writes --updates 20000 --chats 1000
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from typing import Callable, Dict
+
+from clients.telegram.filepersistence import FilePersistence
+from clients.telegram.persistence import IncrementalPersistence
+from clients.telegram.sqlitepersistence import SQLitePersistence
+
+BACKENDS: Dict[str, Callable[..., IncrementalPersistence]] = {
+    "sqlite": lambda directory, **kwargs: SQLitePersistence(url=f"sqlite:///{directory}/bot.db", **kwargs),
+    "sqlite-legacy": lambda directory, **kwargs: SQLitePersistence(
+        url=f"sqlite:///{directory}/bot.db", normalized=False, **kwargs),
+    "file": lambda directory, **kwargs: FilePersistence(url=f"file://{directory}/data", **kwargs),
+}
+
+
+async def run_backend(args: argparse.Namespace, backend: str, flush_interval: float) -> Dict[str, float]:
+    with tempfile.TemporaryDirectory() as directory:
+        persistence = BACKENDS[backend](directory, flush_interval=flush_interval or None, retry_backoff=0.1)
+        random.seed(0)
+
+        start = time.perf_counter()
+        for i in range(args.updates):
+            chat_id = random.randrange(args.chats)
+            await persistence.update_chat_data(chat_id, {"persona": f"persona-{i % 100}", "count": i})
+        await persistence.flush()
+        elapsed = time.perf_counter() - start
+
+        stats = persistence.stats()
+    return {
+        "updates/sec": args.updates / elapsed,
+        "rows written": stats["rows_written"],
+        "flushes": stats["flushes"],
+        "mean flush (ms)": stats["flush_seconds_total"] / max(stats["flushes"], 1) * 1000,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    for backend in args.backends:
+        for flush_interval in (0, args.flush_interval):
+            mode = f"write-behind {flush_interval}s" if flush_interval else "immediate"
+            stats = await run_backend(args, backend, flush_interval)
+            print(f"{backend:>13} {mode:>18}: " + ", ".join(f"{name} = {value:.1f}" for name, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Persistence backend write benchmark")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    parser.add_argument("--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS))
+    asyncio.run(main(parser.parse_args()))
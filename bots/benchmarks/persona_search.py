@@ -0,0 +1,101 @@
+"""Microbenchmark for the inline query persona search.
+
+Builds ``--personas`` synthetic personas and runs ``--queries`` queries (prefixes, words,
+substrings, typos and description words, like users type them keystroke by keystroke)
+against the previous linear scan and the :class:`PersonaIndex`. Reports the index build
+time and p50/p99 latency per query.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.persona_search --personas 10000
+"""
+
+import argparse
+import random
+import statistics
+import time
+from typing import Any, Callable, Dict, List
+
+from clients.telegram.persona_index import PAGE_SIZE, PersonaIndex
+
+ROLES = ["teacher", "doctor", "lawyer", "therapist", "chef", "coach", "historian", "poet", "pirate",
+         "detective", "engineer", "nurse", "scientist", "banker", "farmer", "pilot", "artist",
+         "musician", "philosopher", "astronaut", "librarian", "mechanic", "gardener", "tutor"]
+TOPICS = ["math", "physics", "chemistry", "biology", "history", "music", "fitness", "finance",
+          "travel", "cooking", "coding", "writing", "law", "health", "space", "ocean", "chess",
+          "film", "fashion", "gaming", "language", "startup", "yoga", "wine", "marketing"]
+
+
+def make_personas(count: int) -> List[Dict[str, Any]]:
+    personas = []
+    for i in range(count):
+        topic, role = TOPICS[i % len(TOPICS)], ROLES[(i // len(TOPICS)) % len(ROLES)]
+        suffix = f"-{i // (len(TOPICS) * len(ROLES))}" if i >= len(TOPICS) * len(ROLES) else ""
+        personas.append({
+            "name": f"{topic}-{role}{suffix}",
+            "description": f"A {role} who knows everything about {topic} and answers your questions",
+        })
+    return personas
+
+
+def make_queries(personas: List[Dict[str, Any]], count: int) -> List[str]:
+    rng = random.Random(0)
+    queries = []
+    for _ in range(count):
+        name = rng.choice(personas)["name"]
+        kind = rng.randrange(5)
+        if kind == 0:
+            queries.append(name[:rng.randint(1, len(name))])
+        elif kind == 1:
+            word = rng.choice(name.split("-"))
+            queries.append(word[:rng.randint(1, len(word))])
+        elif kind == 2:
+            start = rng.randrange(len(name) - 3)
+            queries.append(name[start:start + rng.randint(3, 6)])
+        elif kind == 3:
+            position = rng.randrange(len(name) - 1)
+            queries.append(name[:position] + name[position + 1] + name[position] + name[position + 2:])
+        else:
+            queries.append(rng.choice(["questions", "everything", "knows", "answers"]))
+    return queries
+
+
+def linear_scan(personas: List[Dict[str, Any]]) -> Callable[[str], List[Dict[str, Any]]]:
+    """The previous search: a substring test against every lowercased name, unranked and unbounded."""
+    def search(query: str) -> List[Dict[str, Any]]:
+        return [persona for persona in personas if query.lower() in persona['name'].lower()]
+    return search
+
+
+def measure(search: Callable[[str], Any], queries: List[str]) -> Dict[str, float]:
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    latencies.sort()
+    return {
+        "p50 (us)": statistics.median(latencies),
+        "p99 (us)": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    personas = make_personas(args.personas)
+    queries = make_queries(personas, args.queries)
+
+    start = time.perf_counter()
+    index = PersonaIndex(personas)
+    print(f"index of {len(index)} personas built in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    for name, search in (("linear", linear_scan(personas)),
+                         ("index", lambda query: index.search(query, limit=PAGE_SIZE))):
+        stats = measure(search, queries)
+        print(f"{name:>7}: " + ", ".join(f"{key} = {value:.1f}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Persona search microbenchmark")
+    parser.add_argument("--personas", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=2000)
+    main(parser.parse_args())
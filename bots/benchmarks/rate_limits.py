@@ -0,0 +1,114 @@
+"""Throughput benchmark for the Bot API rate limiting.
+
+Starts a local fake Bot API (``benchmarks/fake_bot_api.py``) that enforces Telegram's flood
+limits and answers ``--answers`` questions spread over ``--chats`` private chats and
+``--groups`` groups, each answer a typing action followed by ``--parts`` messages, with
+each of these limiters:
+
+- ``aio-1/s``: the previous ``AIORateLimiter`` setting, one request per second overall and
+  no retries
+- ``none``: no rate limiting at all
+- ``token-bucket``: :class:`TokenBucketRateLimiter`
+
+By default the questions arrive faster than Telegram lets the bot answer. Every run stops
+after ``--timeout`` seconds. Reports messages/sec, how many answers were fully delivered,
+failed (a 429 that was not retried) or still pending, the 429s the fake API sent per limit,
+dropped typing actions and p50/p99 answer latency.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.rate_limits --chats 200 --groups 20 --timeout 30
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from telegram.ext import AIORateLimiter, BaseRateLimiter, ExtBot
+from telegram.request import HTTPXRequest
+
+from benchmarks.fake_bot_api import FakeBotApi
+from clients.telegram.rate_limiter import TokenBucketRateLimiter
+
+LIMITERS: Dict[str, Callable[[], Optional[BaseRateLimiter]]] = {
+    "aio-1/s": lambda: AIORateLimiter(overall_max_rate=1, overall_time_period=1, group_max_rate=1,
+                                      group_time_period=1, max_retries=0),
+    "none": lambda: None,
+    "token-bucket": TokenBucketRateLimiter,
+}
+
+
+async def run_limiter(args: argparse.Namespace, name: str) -> Dict[str, Any]:
+    api = FakeBotApi(("127.0.0.1", 0), latency=args.latency).start()
+    limiter = LIMITERS[name]()
+    bot = ExtBot("1:fake", base_url=f"{api.url}/bot", rate_limiter=limiter,
+                 request=HTTPXRequest(connection_pool_size=256, pool_timeout=30, http_version="1.1"))
+    await bot.initialize()
+
+    chats = list(range(1, args.chats + 1)) + [-i for i in range(1, args.groups + 1)]
+    rng = random.Random(0)
+    latencies: List[float] = []
+    outcome = {"delivered": 0, "failed": 0}
+
+    async def answer(chat_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        try:
+            await bot.send_chat_action(chat_id, "typing")
+            for part in range(args.parts):
+                await bot.send_message(chat_id, f"part {part} of the answer")
+        except Exception:  # pylint: disable=W0703
+            outcome["failed"] += 1
+            return
+        latencies.append(time.perf_counter() - start)
+        outcome["delivered"] += 1
+
+    # questions arrive over the first ``--spread`` seconds
+    tasks = [asyncio.ensure_future(answer(rng.choice(chats), rng.uniform(0, args.spread)))
+             for _ in range(args.answers)]
+    start = time.perf_counter()
+    done, pending = await asyncio.wait(tasks, timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await bot.shutdown()
+    api.shutdown()
+
+    latencies.sort()
+    stats = {
+        "messages/sec": api.counters["messages"] / elapsed,
+        "delivered": outcome["delivered"],
+        "failed": outcome["failed"],
+        "pending": len(pending),
+        "429s chat": api.rejected["chat"],
+        "429s overall": api.rejected["overall"],
+        "p50 (s)": statistics.median(latencies) if latencies else float("nan"),
+        "p99 (s)": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else float("nan"),
+    }
+    if isinstance(limiter, TokenBucketRateLimiter):
+        stats["typing dropped"] = limiter.stats["dropped"]
+    return stats
+
+
+async def main(args: argparse.Namespace) -> None:
+    for name in args.limiters:
+        stats = await run_limiter(args, name)
+        print(f"{name:>12}: " + ", ".join(
+            f"{key} = {value:.2f}" if isinstance(value, float) else f"{key} = {value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rate limiter benchmark against a fake Bot API")
+    parser.add_argument("--answers", type=int, default=600)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--parts", type=int, default=2, help="messages per answer")
+    parser.add_argument("--spread", type=float, default=10.0, help="seconds over which the questions arrive")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake API takes per request")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--limiters", nargs="+", choices=list(LIMITERS), default=list(LIMITERS))
+    asyncio.run(main(parser.parse_args()))
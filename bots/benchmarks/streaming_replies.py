@@ -0,0 +1,123 @@
+"""Time to first token benchmark for streamed replies.
+
+Starts a stub Inquire API (``benchmarks/stub_inquire_api.py``) returning partial results and
+a fake Bot API (``benchmarks/fake_bot_api.py``) enforcing Telegram's flood limits, then asks
+``--questions`` questions spread over ``--chats`` private chats and ``--groups`` groups.
+Answers are ``--answer-length`` characters long and take ``--latency`` seconds to write.
+Runs once replying when the inquiry is completed, like before, and once streaming the
+answer with :class:`ReplyStreamer`, and reports p50/p99 time to first token, p50/p99 time
+until the whole answer is shown, the messages and edits sent and the 429s the fake API sent.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.streaming_replies --questions 200 --answer-length 6000
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Any, Dict, List
+
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+from benchmarks.fake_bot_api import FakeBotApi
+from benchmarks.stub_inquire_api import StubInquireApi
+from clients.telegram.inquire import InquireClient
+from clients.telegram.outbound import split_markdown
+from clients.telegram.rate_limiter import TokenBucketRateLimiter
+from clients.telegram.streaming import ReplyStreamer
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(args: argparse.Namespace, stream: bool) -> Dict[str, Any]:
+    stub = StubInquireApi(("127.0.0.1", 0), latency=args.latency, jitter=args.jitter, stream=True,
+                          first_token=args.first_token, answer_length=args.answer_length).start()
+    api = FakeBotApi(("127.0.0.1", 0), latency=args.bot_latency).start()
+    bot = ExtBot("1:fake", base_url=f"{api.url}/bot", rate_limiter=TokenBucketRateLimiter(),
+                 request=HTTPXRequest(connection_pool_size=256, pool_timeout=30, http_version="1.1"))
+    await bot.initialize()
+    client = InquireClient(stub.url, "benchmark", max_connections=200)
+    streamer = ReplyStreamer(bot)
+
+    chats = list(range(1, args.chats + 1)) + [-i for i in range(1, args.groups + 1)]
+    rng = random.Random(0)
+    answered: List[float] = []
+    failed = 0
+
+    async def ask(chat_id: int, delay: float) -> None:
+        nonlocal failed
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+        try:
+            inquiry = await client.create_inquiry(chat_id, "chat", f"question {rng.random()}")
+            if stream:
+                reply = await streamer.start(chat_id, started=started)
+                try:
+                    inquiry = await client.wait_for_inquiry(
+                        inquiry['id'], timeout=args.timeout, on_partial=reply.feed_inquiry,
+                        partial_step=reply.interval)
+                    await reply.finish(inquiry['result'])
+                finally:
+                    await reply.close()
+            else:
+                inquiry = await client.wait_for_inquiry(inquiry['id'], timeout=args.timeout)
+                for part in split_markdown(inquiry['result']):
+                    await bot.send_message(chat_id, part, parse_mode="Markdown")
+                streamer.record_first_token(time.perf_counter() - started)
+        except Exception:  # pylint: disable=W0703
+            failed += 1
+            return
+        answered.append(time.perf_counter() - started)
+
+    try:
+        await asyncio.gather(*(ask(rng.choice(chats), rng.uniform(0, args.spread)) for _ in range(args.questions)))
+    finally:
+        await client.close()
+        await bot.shutdown()
+        stub.shutdown()
+        api.shutdown()
+
+    stats = streamer.stats()
+    return {
+        "answered": len(answered),
+        "failed": failed,
+        "p50 first token (s)": stats["p50_first_token_seconds"],
+        "p99 first token (s)": stats["p99_first_token_seconds"],
+        "p50 full answer (s)": statistics.median(answered) if answered else float("nan"),
+        "p99 full answer (s)": percentile(answered, 99),
+        "messages": api.counters["messages"],
+        "edits": stats["edits"],
+        "edits dropped": stats["dropped"],
+        "429s": api.counters["too_many_requests"],
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    for name, stream in (("complete", False), ("stream", True)):
+        stats = await run(args, stream)
+        print(f"{name:>8}: " + ", ".join(
+            f"{key} = {value:.2f}" if isinstance(value, float) else f"{key} = {value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streamed replies benchmark against stub Inquire and Bot APIs")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--spread", type=float, default=10.0, help="seconds over which the questions arrive")
+    parser.add_argument("--latency", type=float, default=8.0, help="seconds an answer takes to write")
+    parser.add_argument("--jitter", type=float, default=4.0)
+    parser.add_argument("--first-token", type=float, default=0.5, help="seconds until an answer's first words")
+    parser.add_argument("--answer-length", type=int, default=1500, help="characters of an answer")
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="seconds the fake Bot API takes per request")
+    parser.add_argument("--timeout", type=float, default=45.0)
+    asyncio.run(main(parser.parse_args()))
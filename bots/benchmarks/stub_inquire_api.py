@@ -0,0 +1,222 @@
+"""A local stand-in for the Inquire API, used by the benchmarks.
+
+Inquiries are answered with ``REQUESTED`` until ``latency`` seconds after they
+were created, then with ``COMPLETED`` and a canned result. With ``stream`` set the
+result is written while the inquiry is ``REQUESTED``: after ``first_token`` seconds
+``result`` holds a growing prefix of the final answer. With ``notify_url``
+set it also stands in for the inquiry pipeline's completion notifier and
+``POST``s every completed inquiry to ``<notify_url>/inquiries/<id>``.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+
+class StubInquireApi(ThreadingHTTPServer):
+    """Threaded HTTP server emulating the ``/inquiries`` endpoints of the Inquire API.
+
+    Args:
+        address (:obj:`tuple`): ``(host, port)`` to listen on, port ``0`` picks a free port.
+        latency (:obj:`float`, optional): Seconds an inquiry takes to complete.
+        jitter (:obj:`float`, optional): Random extra seconds added to ``latency``.
+        personas (:obj:`int`, optional): Number of personas returned by ``GET /inquiries``.
+        notify_url (:obj:`str`, optional): Base url of the bot's notification endpoint.
+        notify_secret (:obj:`str`, optional): Sent in the ``x-notify-secret`` header.
+        drop_rate (:obj:`float`, optional): Share of notifications to drop, to exercise the
+            bot's polling fallback.
+        batch (:obj:`bool`, optional): Whether ``GET /inquiries?ids=a,b`` returns the given
+            inquiries, otherwise the ids are ignored and personas are listed like the real API.
+        stream (:obj:`bool`, optional): Whether unfinished inquiries return partial results.
+        first_token (:obj:`float`, optional): Seconds until the first partial result.
+        answer_length (:obj:`int`, optional): Characters the answer is padded to, e.g. to exceed
+            a message.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address: Tuple[str, int], latency: float = 2.0, jitter: float = 0.0, personas: int = 100,
+                 notify_url: Optional[str] = None, notify_secret: Optional[str] = None, drop_rate: float = 0.0,
+                 batch: bool = False, stream: bool = False, first_token: float = 0.5, answer_length: int = 0):
+        super().__init__(address, StubInquireHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.notify_url = notify_url
+        self.notify_secret = notify_secret
+        self.drop_rate = drop_rate
+        self.batch = batch
+        self.stream = stream
+        self.first_token = first_token
+        self.answer_length = answer_length
+        self.personas = [
+            {"name": f"persona-{i}", "description": f"Stub persona number {i}"} for i in range(personas)
+        ]
+        self.inquiries: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.requests = {"POST": 0, "GET": 0}
+        self.notifications = {"sent": 0, "dropped": 0, "failed": 0}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, method: str) -> None:
+        with self.lock:
+            self.requests[method] += 1
+
+    def create_inquiry(self, fields: Dict[str, str]) -> Dict[str, Any]:
+        inquiry = {
+            "id": uuid4().hex,
+            "connectionType": fields.get("connectionType", "TELEGRAM"),
+            "connectionUserId": fields.get("connectionUserId", ""),
+            "queryType": fields.get("queryType", "chat"),
+            "query": fields.get("query", ""),
+            "status": "REQUESTED",
+            "result": None,
+            "createdAt": time.monotonic(),
+        }
+        inquiry["completesAt"] = inquiry["createdAt"] + self.latency + random.uniform(0, self.jitter)
+        with self.lock:
+            self.inquiries[inquiry["id"]] = inquiry
+        if self.notify_url:
+            timer = threading.Timer(inquiry["completesAt"] - time.monotonic(), self.notify, (inquiry["id"],))
+            timer.daemon = True
+            timer.start()
+        return inquiry
+
+    def answer(self, inquiry: Dict[str, Any]) -> str:
+        answer = f"The {inquiry['queryType']} persona answers: {inquiry['query']}"
+        words = 0
+        while len(answer) < self.answer_length:
+            # a line every twelve words, so that long answers can be split between lines
+            words += 1
+            answer += ("\n" if words % 12 == 0 else " ") + "word"
+        return answer
+
+    def _complete(self, inquiry: Dict[str, Any]) -> None:
+        if inquiry["status"] != "REQUESTED":
+            return
+        now = time.monotonic()
+        if now >= inquiry["completesAt"]:
+            inquiry["status"] = "COMPLETED"
+            inquiry["result"] = self.answer(inquiry)
+        elif self.stream:
+            # written at a steady pace from the first token on
+            first = inquiry["createdAt"] + min(self.first_token, inquiry["completesAt"] - inquiry["createdAt"])
+            if now >= first:
+                answer = self.answer(inquiry)
+                written = (now - first) / max(inquiry["completesAt"] - first, 1e-9)
+                inquiry["result"] = answer[:max(1, int(len(answer) * written))]
+
+    def get_inquiry(self, inquiry_id: str) -> Dict[str, Any]:
+        with self.lock:
+            inquiry = self.inquiries.get(inquiry_id)
+            if inquiry is not None:
+                self._complete(inquiry)
+            return inquiry
+
+    def notify(self, inquiry_id: str) -> None:
+        """Pushes a completed inquiry to the notification endpoint, like the inquiry pipeline does."""
+        with self.lock:
+            inquiry = dict(self.inquiries[inquiry_id])
+            self._complete(inquiry)
+            self.inquiries[inquiry_id] = inquiry
+            if random.random() < self.drop_rate:
+                self.notifications["dropped"] += 1
+                return
+
+        headers = {"Content-Type": "application/json"}
+        if self.notify_secret:
+            headers["x-notify-secret"] = self.notify_secret
+        request = Request(f"{self.notify_url}/inquiries/{inquiry_id}", method="POST", headers=headers,
+                          data=json.dumps({"data": inquiry}, default=str).encode())
+        try:
+            with urlopen(request, timeout=5) as response:
+                response.read()
+            outcome = "sent"
+        except OSError:
+            outcome = "failed"
+        with self.lock:
+            self.notifications[outcome] += 1
+
+    def start(self) -> "StubInquireApi":
+        """Serves requests from a daemon thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubInquireHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StubInquireApi
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _respond(self, status: int, body: Any) -> None:
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self) -> Dict[str, str]:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length).decode() if length else ""
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(raw or "{}")
+        return dict(parse_qsl(raw))
+
+    def do_POST(self) -> None:
+        self.server.count("POST")
+        if self.path.rstrip("/").endswith("/inquiries"):
+            return self._respond(200, {"data": self.server.create_inquiry(self._body())})
+        self._respond(404, {"code": "NOT_FOUND", "message": f"No route for {self.path}"})
+
+    def do_GET(self) -> None:
+        self.server.count("GET")
+        path, _, query = self.path.partition("?")
+        path = path.rstrip("/")
+        if path.endswith("/inquiries"):
+            ids = dict(parse_qsl(query)).get("ids")
+            if ids and self.server.batch:
+                found = (self.server.get_inquiry(inquiry_id) for inquiry_id in ids.split(","))
+                return self._respond(200, {"data": [inquiry for inquiry in found if inquiry is not None]})
+            return self._respond(200, {"data": self.server.personas})
+        inquiry_id = path.rsplit("/", 1)[-1]
+        inquiry = self.server.get_inquiry(inquiry_id)
+        if inquiry is None:
+            return self._respond(404, {"code": "NOT_FOUND", "message": f"Inquiry with id: {inquiry_id} not found"})
+        self._respond(200, {"data": inquiry})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--notify-url", help="bot notification endpoint, e.g. http://127.0.0.1:8081")
+    parser.add_argument("--notify-secret")
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--batch", action="store_true", help="support batch status lookups")
+    parser.add_argument("--stream", action="store_true", help="return partial results of unfinished inquiries")
+    parser.add_argument("--first-token", type=float, default=0.5)
+    parser.add_argument("--answer-length", type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubInquireApi((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                            notify_url=args.notify_url, notify_secret=args.notify_secret, drop_rate=args.drop_rate,
+                            batch=args.batch, stream=args.stream, first_token=args.first_token,
+                            answer_length=args.answer_length)
+    print(f"Stub Inquire API listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,264 @@
+"""Throughput benchmark for the webhook mode.
+
+Replays updates against :class:`TelegramWebhook` served by the bot's :class:`HttpServer`, the
+way Telegram delivers them: ``POST``s with the secret token header over ``--connections``
+HTTP/1.1 keep-alive connections, each connection sending its next update once the previous one was
+answered. The application runs against the fake Bot API (``benchmarks/fake_bot_api.py``) and
+handles every message by waiting ``--handler-latency`` seconds, standing in for an inquiry.
+
+With ``--shards`` the updates are posted to a :class:`ShardRouter` forwarding them to that
+many worker processes, each serving the webhook of its own application, ``0`` posts them to
+the webhook directly. ``--handler-cpu`` makes the handlers burn CPU, which only more
+processes can absorb.
+
+The updates are read from ``--updates``, a file with one update per line as returned by
+``getUpdates`` or posted to a webhook, or generated as text messages from ``--chats`` chats.
+Reports updates/sec accepted by the webhook and processed by the handlers, p50/p99 latency
+of the ``POST``s, how long draining the handlers still running took and how many updates a
+handler saw before an earlier update of the same chat.
+
+Run from the ``bots`` directory::
+
+    python -m benchmarks.webhook_replay --count 20000 --connections 1 10 40
+    python -m benchmarks.webhook_replay --count 20000 --connections 40 --handler-cpu 1 --shards 0 2 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, ExtBot, MessageHandler, filters
+from telegram.request import HTTPXRequest
+
+from benchmarks.fake_bot_api import FakeBotApi
+from clients.telegram.http_server import HttpServer
+from clients.telegram.sharding import ShardRouter
+from clients.telegram.webhook import SECRET_HEADER, TelegramWebhook
+
+SECRET = "replay-secret"
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def load_updates(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def generate_updates(count: int, chats: int) -> List[Dict[str, Any]]:
+    now = int(time.time())
+    return [{
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": now,
+            "chat": {"id": update_id % chats + 1, "type": "private", "first_name": "Replay"},
+            "from": {"id": update_id % chats + 1, "is_bot": False, "first_name": "Replay"},
+            "text": f"question {update_id}",
+        },
+    } for update_id in range(count)]
+
+
+def build_application(args: argparse.Namespace, api_url: str, counters: Dict[str, int]) -> Application:
+    """An application against the fake Bot API whose handler counts the updates, and how
+    many of them came after a later update of the same chat."""
+    bot = ExtBot("1:fake", base_url=f"{api_url}/bot", request=HTTPXRequest(http_version="1.1"))
+    application = Application.builder().bot(bot).concurrent_updates(args.concurrent_updates).build()
+    last_seen: Dict[int, int] = {}
+
+    async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id = update.effective_chat.id
+        if last_seen.get(chat_id, -1) > update.update_id:
+            counters["out of order"] += 1
+        last_seen[chat_id] = update.update_id
+        deadline = time.perf_counter() + args.handler_cpu / 1000
+        while time.perf_counter() < deadline:
+            pass
+        await asyncio.sleep(args.handler_latency)
+        counters["processed"] += 1
+
+    application.add_handler(MessageHandler(filters.ALL, handle))
+    return application
+
+
+async def serve_worker(args: argparse.Namespace, api_url: str, port: int, results: Any) -> None:
+    """Serves one shard until SIGTERM, then drains and reports its counters."""
+    counters = {"processed": 0, "out of order": 0}
+    application = build_application(args, api_url, counters)
+    webhook = TelegramWebhook(application, secret_token=SECRET)
+    server = HttpServer("127.0.0.1", port)
+    webhook.attach(server)
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+
+    await application.initialize()
+    await application.start()
+    await server.start()
+    await stop.wait()
+    await server.stop()
+    await application.stop()
+    await application.shutdown()
+    results.put(counters)
+
+
+def run_worker(args: argparse.Namespace, api_url: str, port: int, results: Any) -> None:
+    asyncio.run(serve_worker(args, api_url, port, results))
+
+
+async def post_updates(args: argparse.Namespace, port: int, path: str, updates: List[Dict[str, Any]],
+                       connections: int) -> Tuple[float, List[float]]:
+    """Posts the updates over ``connections`` keep-alive connections, returns the seconds it took
+    and the latency of every request."""
+    bodies: Iterator[bytes] = iter([json.dumps(update).encode() for update in updates])
+    latencies: List[float] = []
+    head = f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n{SECRET_HEADER}: {SECRET}\r\n"
+
+    async def connection() -> None:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            for body in bodies:
+                start = time.perf_counter()
+                writer.write(f"{head}Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line == b"\r\n":
+                        break
+                    name, _, value = line.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    raise RuntimeError(f"Update was answered with {status}")
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return time.perf_counter() - start, latencies
+
+
+async def replay(args: argparse.Namespace, api: FakeBotApi, updates: List[Dict[str, Any]],
+                 connections: int) -> Dict[str, Any]:
+    """Posts the updates to the bot's webhook."""
+    counters = {"processed": 0, "out of order": 0}
+    application = build_application(args, api.url, counters)
+    webhook = TelegramWebhook(application, secret_token=SECRET, max_connections=connections)
+    server = HttpServer("127.0.0.1", 0, max_connections=connections)
+    webhook.attach(server)
+
+    await application.initialize()
+    await application.start()
+    await server.start()
+
+    start = time.perf_counter()
+    accepted, latencies = await post_updates(args, server.port, webhook.path, updates, connections)
+
+    # stop as soon as everything was accepted, the drain waits for the handlers still running
+    drain_start = time.perf_counter()
+    await server.stop()
+    await application.stop()
+    await application.shutdown()
+    drained = time.perf_counter() - drain_start
+    elapsed = time.perf_counter() - start
+    return summary(updates, accepted, elapsed, drained, latencies, counters)
+
+
+async def replay_sharded(args: argparse.Namespace, api: FakeBotApi, updates: List[Dict[str, Any]],
+                         connections: int, shards: int) -> Dict[str, Any]:
+    """Posts the updates to a :class:`ShardRouter` forwarding them to ``shards`` worker processes."""
+    results = multiprocessing.Queue()
+    ports = [args.base_port + shard for shard in range(shards)]
+    workers = [multiprocessing.Process(target=run_worker, args=(args, api.url, port, results)) for port in ports]
+    for worker in workers:
+        worker.start()
+    for port in ports:
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+
+    router = ShardRouter([f"http://127.0.0.1:{port}/telegram" for port in ports], secret_token=SECRET)
+    server = HttpServer("127.0.0.1", 0, max_connections=connections)
+    router.attach(server)
+    await router.start()
+    await server.start()
+
+    start = time.perf_counter()
+    accepted, latencies = await post_updates(args, server.port, router.path, updates, connections)
+
+    drain_start = time.perf_counter()
+    await server.stop()
+    await router.stop()
+    for worker in workers:
+        os.kill(worker.pid, signal.SIGTERM)
+    counters = {"processed": 0, "out of order": 0}
+    for _ in workers:
+        for key, value in (await asyncio.get_running_loop().run_in_executor(None, results.get)).items():
+            counters[key] += value
+    for worker in workers:
+        worker.join()
+    drained = time.perf_counter() - drain_start
+    elapsed = time.perf_counter() - start
+    return summary(updates, accepted, elapsed, drained, latencies, counters)
+
+
+def summary(updates: List[Dict[str, Any]], accepted: float, elapsed: float, drained: float,
+            latencies: List[float], counters: Dict[str, int]) -> Dict[str, Any]:
+    return {
+        "accepted/sec": len(updates) / accepted,
+        "processed/sec": counters["processed"] / elapsed,
+        "processed": counters["processed"],
+        "out of order": counters["out of order"],
+        "p50 (ms)": percentile(latencies, 50) * 1000,
+        "p99 (ms)": percentile(latencies, 99) * 1000,
+        "drain (s)": drained,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    updates = load_updates(args.updates) if args.updates else generate_updates(args.count, args.chats)
+    api = FakeBotApi(("127.0.0.1", 0), latency=0).start()
+    try:
+        for shards in args.shards:
+            for connections in args.connections:
+                if shards:
+                    stats = await replay_sharded(args, api, updates, connections, shards)
+                else:
+                    stats = await replay(args, api, updates, connections)
+                print(f"{shards:>2} shards, {connections:>4} connections: " + ", ".join(
+                    f"{key} = {value:.2f}" if isinstance(value, float) else f"{key} = {value}"
+                    for key, value in stats.items()))
+    finally:
+        api.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays updates against the webhook")
+    parser.add_argument("--updates", help="file with one recorded update per line, generated if not set")
+    parser.add_argument("--count", type=int, default=10000, help="updates to generate")
+    parser.add_argument("--chats", type=int, default=1000, help="chats the generated updates come from")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 10, 40],
+                        help="concurrent connections delivering the updates, like Telegram's max_connections")
+    parser.add_argument("--handler-latency", type=float, default=0.05, help="seconds a handler waits per update")
+    parser.add_argument("--handler-cpu", type=float, default=0, help="milliseconds of CPU a handler burns per update")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0],
+                        help="worker processes behind a shard router, 0 posts to the webhook directly")
+    parser.add_argument("--base-port", type=int, default=8600, help="port of the first worker")
+    parser.add_argument("--concurrent-updates", type=int, default=256, help="updates handled at once")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,149 @@
+"""This module contains the InquiryAdmission class, which caps the inquiries running against the
+Inquire API, and the AdmissionRejected error it raises when it sheds load."""
+
+import asyncio
+import contextlib
+import logging
+import statistics
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Hashable
+
+
+class AdmissionRejected(Exception):
+    """Raised when an inquiry is not admitted.
+
+    The argument is the reason: ``"user"`` if the user has too many inquiries already,
+    ``"full"`` if too many inquiries are waiting and ``"timeout"`` if the inquiry waited too long.
+    """
+
+    @property
+    def reason(self) -> str:
+        return self.args[0]
+
+
+class InquiryAdmission:
+    """Admits at most ``max_inflight`` inquiries at once, and at most ``max_per_user`` per user.
+
+    Further inquiries wait in order of arrival, a freed slot is handed to the first of them.
+    Inquiries are shed with :class:`AdmissionRejected` instead of piling up: when the user has
+    ``max_per_user`` inquiries running or waiting already, when ``max_waiting`` inquiries are
+    waiting already and when an inquiry waited ``wait_timeout`` seconds without getting a slot.
+    Records how long admitted inquiries waited.
+
+    Args:
+        max_inflight (:obj:`int`, optional): Inquiries running at once, ``0`` for no limit.
+        max_per_user (:obj:`int`, optional): Inquiries of a user running or waiting at once,
+            ``0`` for no limit.
+        max_waiting (:obj:`int`, optional): Inquiries waiting for a slot at most.
+        wait_timeout (:obj:`float`, optional): Seconds an inquiry waits for a slot at most.
+        samples (:obj:`int`, optional): Number of recent inquiries the wait time is computed from.
+    """
+
+    def __init__(self, max_inflight: int = 64, max_per_user: int = 3, max_waiting: int = 256,
+                 wait_timeout: float = 10.0, samples: int = 1000) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.max_inflight = max_inflight
+        self.max_per_user = max_per_user
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.inflight = 0
+        # futures of the waiting inquiries, resolved when they are handed a slot
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._users: Dict[Hashable, int] = {}
+        self._waits: Deque[float] = deque(maxlen=samples)
+        self.counters = {"admitted": 0, "queued": 0, "rejected_user": 0, "rejected_full": 0, "timed_out": 0,
+                         "max_inflight_seen": 0, "max_waiting_seen": 0}
+
+    @property
+    def waiting(self) -> int:
+        """Number of inquiries waiting for a slot."""
+        return len(self._waiters)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user: Hashable) -> AsyncIterator[None]:
+        """
+        Holds a slot while the block runs, waiting for one if all are taken
+        :param user: Id of the user the inquiry is for
+        :raises AdmissionRejected: If the inquiry is shed
+        """
+        users = self._users.get(user, 0)
+        if self.max_per_user and users >= self.max_per_user:
+            self.counters["rejected_user"] += 1
+            raise AdmissionRejected("user")
+        self._users[user] = users + 1
+        try:
+            await self._acquire()
+            try:
+                yield
+            finally:
+                self._release()
+        finally:
+            self._users[user] -= 1
+            if not self._users[user]:
+                del self._users[user]
+
+    async def _acquire(self) -> None:
+        if not self.max_inflight or (self.inflight < self.max_inflight and not self._waiters):
+            self._admitted(0.0)
+            return
+
+        if len(self._waiters) >= self.max_waiting:
+            self.counters["rejected_full"] += 1
+            raise AdmissionRejected("full")
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        self.counters["queued"] += 1
+        self.counters["max_waiting_seen"] = max(self.counters["max_waiting_seen"], len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.wait_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.done():
+                # the slot handed over meanwhile goes to the next waiter
+                self._release()
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            with contextlib.suppress(ValueError):
+                self._waiters.remove(waiter)
+        if not waiter.done():
+            waiter.cancel()
+            self.counters["timed_out"] += 1
+            raise AdmissionRejected("timeout")
+        self._waits.append(loop.time() - start)
+        self.counters["admitted"] += 1
+
+    def _admitted(self, seconds: float) -> None:
+        self.inflight += 1
+        self.counters["admitted"] += 1
+        self.counters["max_inflight_seen"] = max(self.counters["max_inflight_seen"], self.inflight)
+        self._waits.append(seconds)
+
+    def _release(self) -> None:
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        """Hands free slots to the first waiting inquiries."""
+        while self._waiters and self.inflight < self.max_inflight:
+            waiter = self._waiters.popleft()
+            self.inflight += 1
+            self.counters["max_inflight_seen"] = max(self.counters["max_inflight_seen"], self.inflight)
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return dict(
+            self.counters,
+            inflight=self.inflight,
+            waiting=self.waiting,
+            users=len(self._users),
+            p50_wait_seconds=statistics.median(waits) if waits else 0.0,
+            p99_wait_seconds=waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+        )
@@ -0,0 +1,113 @@
+"""This module contains the AnswerCache class, which shares the answers of personas to identical
+questions instead of starting an inquiry for each of them."""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple, Type
+
+from clients.telegram.cache import TTLCache
+from clients.telegram.persona_index import normalize
+
+Inquiry = Dict[str, Any]
+
+
+def normalize_question(query: str) -> str:
+    """Case folds a question and collapses its whitespace. Unlike :func:`normalize` punctuation is
+    kept, ``what is 2+2`` and ``what is 2*2`` are different questions."""
+    return " ".join(query.casefold().split())
+
+
+class AnswerCache:
+    """Answers a question with the completed inquiry of the same persona and question, keyed by
+    persona and question, ignoring case and whitespace.
+
+    Questions arriving while an inquiry for the same question is running wait for that inquiry
+    (single-flight) and completed inquiries are kept for ``ttl`` seconds. Failed inquiries are
+    not kept, their error is raised for every question that waited for them, except for errors
+    of the ``unshared`` types, e.g. the user asking being turned away, and cancellations: then the
+    questions that waited ask again, one of them starting an inquiry of its own. Only the personas
+    opted in are cached, their answers must not depend on the user asking. The answer is billed
+    to the user whose question started the inquiry.
+
+    Args:
+        personas (Iterable[:obj:`str`]): Names of the personas whose answers are shared, ``*``
+            shares the answers of all personas.
+        maxsize (:obj:`int`, optional): Maximum number of answers kept.
+        ttl (:obj:`float`, optional): Seconds an answer is kept.
+        unshared (Tuple[:obj:`type`], optional): Errors of the question starting an inquiry
+            that are not raised for the questions waiting for it.
+    """
+
+    def __init__(self, personas: Iterable[str], maxsize: int = 1024, ttl: float = 60,
+                 unshared: Tuple[Type[BaseException], ...] = ()) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        personas = {persona.strip() for persona in personas} - {""}
+        self.all_personas = "*" in personas
+        self.personas = frozenset(normalize(persona) for persona in personas)
+        self._answers: TTLCache[Inquiry] = TTLCache(maxsize, ttl)
+        self.unshared = unshared
+        # the finished inquiry, None if the waiting questions have to ask again
+        self._inflight: Dict[Hashable, "asyncio.Future[Optional[Inquiry]]"] = {}
+        self.stats = {"lookups": 0, "hits": 0, "coalesced": 0, "inquiries": 0, "bypassed": 0}
+
+    def enabled(self, persona: str) -> bool:
+        return self.all_personas or normalize(persona) in self.personas
+
+    async def answer(self, persona: str, query: str, inquire: Callable[[], Awaitable[Inquiry]]) -> Inquiry:
+        """
+        Returns the finished inquiry answering a question
+        :param persona: Persona asked
+        :param query: The question
+        :param inquire: Coroutine function starting an inquiry and waiting until it is finished
+        :return: The finished inquiry, a shared one if the persona's answers are cached
+        """
+        if not self.enabled(persona):
+            self.stats["bypassed"] += 1
+            return await inquire()
+
+        self.stats["lookups"] += 1
+        key = (normalize(persona), normalize_question(query))
+        inquiry = self._answers.get(key)
+        if inquiry is not None:
+            self.stats["hits"] += 1
+            return inquiry
+
+        pending = self._inflight.get(key)
+        while pending is not None:
+            # a waiting question being cancelled does not cancel the shared inquiry
+            inquiry = await asyncio.shield(pending)
+            if inquiry is not None:
+                self.stats["coalesced"] += 1
+                return inquiry
+            # the question it waited for was turned away or cancelled, another one may have asked again meanwhile
+            pending = self._inflight.get(key)
+
+        pending = self._inflight[key] = asyncio.get_running_loop().create_future()
+        self.stats["inquiries"] += 1
+        try:
+            inquiry = await inquire()
+        except BaseException as excp:
+            if isinstance(excp, (asyncio.CancelledError, *self.unshared)):
+                pending.set_result(None)
+            else:
+                pending.set_exception(excp)
+                # retrieved even if no other question waited for it
+                pending.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+        if inquiry.get('status') == 'COMPLETED':
+            self._answers.set(key, inquiry)
+        pending.set_result(inquiry)
+        return inquiry
+
+    def hit_rate(self) -> float:
+        """Share of the cached personas' questions answered without an inquiry of their own."""
+        lookups = self.stats["lookups"]
+        return (self.stats["hits"] + self.stats["coalesced"]) / lookups if lookups else 0.0
+
+    def info(self) -> Dict[str, Any]:
+        return dict(self.stats, size=len(self._answers), hit_rate=self.hit_rate(),
+                    evictions=self._answers.stats["evictions"], expired=self._answers.stats["expired"])
@@ -1,63 +1,136 @@
+from clients.telegram.chat_dispatch import ChatOrderedApplication
 from clients.telegram.commands import Commands
-
+from clients.telegram.inquire import InquireClient
+from clients.telegram.http_server import HttpServer
+from clients.telegram.metrics import REGISTRY
+from clients.telegram.notifications import InquiryNotifier
+from clients.telegram.persona_registry import PersonaRegistry
+from clients.telegram.rate_limiter import OVERALL_BURST, OVERALL_RATE, TokenBucketRateLimiter
+from clients.telegram.tracing import TRACER, OtlpFileExporter
+from clients.telegram.webhook import TelegramWebhook
+
+import asyncio
 import os
 import logging
+import signal
 
+import tempfile
 import traceback
 
-import requests
 from typing import Optional, Tuple
 import json
 
 from telegram import ChatMember, ChatMemberUpdated, Chat, Update
-from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, AIORateLimiter, MessageHandler, filters, InlineQueryHandler, ChatMemberHandler
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, filters, InlineQueryHandler, ChatMemberHandler
+from clients.telegram.persistence import IncrementalPersistence
 from clients.telegram.mysqlpersistence import MySQLPersistence
+from clients.telegram.sqlitepersistence import SQLitePersistence
+from clients.telegram.filepersistence import FilePersistence
 
 
 class Telegram:
-    def __init__(self):
+    def __init__(self, webhook: bool = False, shard: Optional[Tuple[int, int]] = None):
 
         self.logger = logging.getLogger(__name__)
+        # (index, count) when running as a worker of a sharded bot, see clients.telegram.sharding
+        self.shard = shard
 
         # enviroment variables
         self.telegramApiKey = os.environ.get('TELEGRAM_API_KEY')
         self.inquireApiKey = os.environ.get('INQUIRE_API_KEY')
         self.inquireApi = os.environ.get('INQUIRE_API')
         self.dbURI = os.environ.get('DB_URI')
-
-        # load all personas from the db
-        url = self.inquireApi + "/inquiries"
-        headers = {
-            "x-api-key": self.inquireApiKey,
-        }
-
-        response = requests.get(url, headers=headers)
-
-        # handle api errors
-        if response.status_code != 200:
-            self.logger.error('Error loading personas: %s', response.text)
-            raise Exception(response.status_code, response.text)
-
-        self.personas = response.json()['data']
-
-        # write personas to file this can be send to @botfather for the /setcommands
-        with open('./personas.txt', 'w') as f:
-            # set base commands
-            f.write(f"""
-help - Show a help message
-chat - Directly chat with the bot
-random - Show random personas
-persona - Show the current persona
-set - Set the persona to talk to
-""")
-            for persona in self.personas:
-                f.write(f"""{persona['name']} - {persona['description']}\n""")
-            self.logger.info("Personas loaded")
+        # store one row per chat/user instead of the single Persistence row
+        self.dbNormalized = os.environ.get('DB_NORMALIZED', 'false').lower() == 'true'
+        # write persistence changes in the background every DB_FLUSH_INTERVAL seconds
+        self.dbFlushInterval = os.environ.get('DB_FLUSH_INTERVAL')
+        self.dbFlushThreshold = int(os.environ.get('DB_FLUSH_THRESHOLD', 500))
+        # load chat and user data on first access instead of at startup, needs DB_NORMALIZED
+        self.dbLazyLoad = os.environ.get('DB_LAZY_LOAD', 'false').lower() == 'true'
+        # connection pool of the persistence engine
+        self.dbPoolSize = int(os.environ.get('DB_POOL_SIZE', 5))
+        self.dbPoolMaxOverflow = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+        self.dbPoolRecycle = int(os.environ.get('DB_POOL_RECYCLE', 3600))
+        # optional port for inquiry completion notifications, polling is used when unset, the secret is required
+        self.notifyPort = os.environ.get('INQUIRY_NOTIFY_PORT')
+        self.notifyHost = os.environ.get('INQUIRY_NOTIFY_HOST', '127.0.0.1')
+        self.notifySecret = os.environ.get('INQUIRY_NOTIFY_SECRET')
+        # ids per batch inquiry status lookup, 0 polls inquiries one by one
+        self.pollBatchSize = int(os.environ.get('INQUIRY_POLL_BATCH_SIZE', 0))
+        # seconds inline query answers are cached by the bot and by Telegram, and answers kept by the bot
+        self.inlineCacheTime = int(os.environ.get('INLINE_CACHE_TIME', 300))
+        self.inlineCacheSize = int(os.environ.get('INLINE_CACHE_SIZE', 1024))
+        # seconds between persona catalog refreshes, and the file the last catalog is cached in
+        self.personaRefreshInterval = float(os.environ.get('PERSONA_REFRESH_INTERVAL', 300))
+        self.personaCacheFile = os.environ.get(
+            'PERSONA_CACHE_FILE', os.path.join(tempfile.gettempdir(), 'inquire-personas.json'))
+        # webhook mode, the public URL is registered with Telegram at startup if set
+        self.webhookUrl = os.environ.get('WEBHOOK_URL')
+        self.webhookListen = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+        self.webhookPort = int(os.environ.get('WEBHOOK_PORT', 8443))
+        self.webhookPath = os.environ.get('WEBHOOK_PATH', '/telegram')
+        self.webhookSecret = os.environ.get('WEBHOOK_SECRET')
+        self.webhookMaxConnections = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+        # seconds a webhook connection may take to send an update, or stay idle, before it is closed
+        self.webhookIdleTimeout = float(os.environ.get('WEBHOOK_IDLE_TIMEOUT', 30))
+        # comma separated personas whose answers are shared by identical questions, * for all, and
+        # how many answers are kept for how many seconds
+        self.answerCachePersonas = os.environ.get('ANSWER_CACHE_PERSONAS', '').split(',')
+        self.answerCacheSize = int(os.environ.get('ANSWER_CACHE_SIZE', 1024))
+        self.answerCacheTtl = float(os.environ.get('ANSWER_CACHE_TTL', 60))
+        # updates of a chat are handled in order, at most this many wait while one is handled
+        self.chatQueueSize = int(os.environ.get('CHAT_QUEUE_SIZE', 16))
+        # answers are shown while they are written, if the Inquire API returns partial results
+        self.streamAnswers = os.environ.get('STREAM_ANSWERS', 'false').lower() == 'true'
+        # inquiries running at once overall (0 for no limit) and per user, and how many questions wait for
+        # how many seconds at most before they are turned away
+        self.inquiryMaxInflight = int(os.environ.get('INQUIRY_MAX_INFLIGHT', 64))
+        self.inquiryMaxPerUser = int(os.environ.get('INQUIRY_MAX_PER_USER', 3))
+        self.inquiryMaxWaiting = int(os.environ.get('INQUIRY_MAX_WAITING', 256))
+        self.inquiryWaitTimeout = float(os.environ.get('INQUIRY_WAIT_TIMEOUT', 10))
+        # optional port serving Prometheus metrics on /metrics, local only unless METRICS_HOST is set
+        self.metricsPort = os.environ.get('METRICS_PORT')
+        self.metricsHost = os.environ.get('METRICS_HOST', '127.0.0.1')
+        # log a line per finished span of an update, and append the spans as OTLP JSON to a file
+        self.traceSpans = os.environ.get('TRACE_SPANS', 'false').lower() == 'true'
+        self.traceOtlpFile = os.environ.get('TRACE_OTLP_FILE')
+
+        # spans of the handled updates, log lines carry their ids either way
+        TRACER.configure(log_spans=self.traceSpans,
+                         exporter=OtlpFileExporter(self.traceOtlpFile) if self.traceOtlpFile else None)
+
+        # local endpoint the inquiry pipeline notifies when an inquiry is finished
+        self.notifier = None
+        self.http_server = None
+        if self.notifyPort:
+            # anyone reaching the port could otherwise answer the questions of waiting users
+            if not self.notifySecret:
+                raise ValueError("INQUIRY_NOTIFY_SECRET must be set when INQUIRY_NOTIFY_PORT is set")
+            self.notifier = InquiryNotifier(secret=self.notifySecret)
+            self.http_server = HttpServer(self.notifyHost, int(self.notifyPort))
+            self.notifier.attach(self.http_server)
+        self.metrics_server = None
+        if self.metricsPort:
+            self.metrics_server = HttpServer(self.metricsHost, int(self.metricsPort))
+            REGISTRY.attach(self.metrics_server)
+
+        # shared async client for inquiries, closed when the application shuts down
+        self.inquire = InquireClient(
+            self.inquireApi, self.inquireApiKey, notifier=self.notifier, batch_size=self.pollBatchSize)
+
+        # persona catalog, loaded once the application is initialized and refreshed in the background
+        self.personas = PersonaRegistry(
+            self.inquire, cache_file=self.personaCacheFile, refresh_interval=self.personaRefreshInterval)
 
         # Create the Application and pass it your bot's token.
-        self.application = Application.builder().token(self.telegramApiKey).rate_limiter(AIORateLimiter(
-            overall_max_rate=1, overall_time_period=1, group_max_rate=1, group_time_period=1, max_retries=0
-        )).concurrent_updates(True).arbitrary_callback_data(True).persistence(MySQLPersistence(url=self.dbURI)).build()
+        # Telegram's flood limits per chat and overall, answers before typing indicators. A chat belongs to
+        # one worker of a sharded bot, but the overall limit is the bot's, so the workers share it
+        shards = shard[1] if shard is not None else 1
+        self.rate_limiter = TokenBucketRateLimiter(
+            overall_rate=OVERALL_RATE / shards, overall_burst=max(1.0, OVERALL_BURST / shards))
+        self.application = Application.builder().token(self.telegramApiKey).rate_limiter(
+            self.rate_limiter).concurrent_updates(True).application_class(
+            ChatOrderedApplication, kwargs={"max_chat_queue": self.chatQueueSize}).arbitrary_callback_data(True).persistence(self.create_persistence()).post_init(self.post_init).post_shutdown(self.post_shutdown).build()
 
         # direct handlers
         self.application.add_handler(
@@ -65,7 +138,18 @@ set - Set the persona to talk to
         # Create a new set of commands for each distinct chat
         base_persona = "chat"
         self.commands = Commands(self.application, base_persona,
-                                 self.personas, (self.inquireApiKey, self.inquireApi))
+                                 self.personas, self.inquire,
+                                 inline_cache_size=self.inlineCacheSize, inline_cache_time=self.inlineCacheTime,
+                                 answer_cache_personas=self.answerCachePersonas,
+                                 answer_cache_size=self.answerCacheSize, answer_cache_ttl=self.answerCacheTtl,
+                                 stream_answers=self.streamAnswers,
+                                 inquiry_max_inflight=self.inquiryMaxInflight,
+                                 inquiry_max_per_user=self.inquiryMaxPerUser,
+                                 inquiry_max_waiting=self.inquiryMaxWaiting,
+                                 inquiry_wait_timeout=self.inquiryWaitTimeout)
+        # sent messages hide the typing indicator
+        self.rate_limiter.add_observer(self.commands.typing.observe)
+        self.export_stats()
 
         # add handlers
         # direct handlers
@@ -107,8 +191,123 @@ set - Set the persona to talk to
         # Register error handlers
         self.application.add_error_handler(self.error_handler)
 
-        # Run the bot until the user presses Ctrl-C
-        self.application.run_polling()
+        # Run the bot until the user presses Ctrl-C or the process is terminated
+        if webhook:
+            # the webhook of a sharded bot is registered by the ingress
+            self.webhook = TelegramWebhook(
+                self.application, url=None if shard else self.webhookUrl, path=self.webhookPath,
+                secret_token=self.webhookSecret, max_connections=self.webhookMaxConnections)
+            self.webhook_server = HttpServer(
+                self.webhookListen, self.webhookPort, max_connections=self.webhookMaxConnections,
+                idle_timeout=self.webhookIdleTimeout)
+            self.webhook.attach(self.webhook_server)
+            REGISTRY.add_stats("bot_webhook", "Webhook", lambda: self.webhook.stats)
+            # the application's queue and locks bind to the loop they are first used on, which takes Python 3.10
+            asyncio.run(self.serve_webhook())
+        else:
+            self.application.run_polling()
+
+    # Create the persistence configured by the environment
+    def create_persistence(self) -> IncrementalPersistence:
+        """
+        Creates the persistence for chat, user and bot data, the backend is picked by the scheme of DB_URI:
+        mysql://, sqlite:///<file> or file://<directory>
+        :return: IncrementalPersistence object
+        """
+        options = {
+            "flush_interval": float(self.dbFlushInterval) if self.dbFlushInterval else None,
+            "flush_threshold": self.dbFlushThreshold,
+            "shard": self.shard,
+        }
+        scheme = self.dbURI.split("://", 1)[0]
+        if scheme == "file":
+            # the log can't be shared between processes, every shard keeps its own
+            url = self.dbURI if self.shard is None else f"{self.dbURI.rstrip('/')}/shard-{self.shard[0]}"
+            return FilePersistence(url=url, **options)
+
+        options.update(
+            lazy=self.dbLazyLoad,
+            pool_size=self.dbPoolSize,
+            max_overflow=self.dbPoolMaxOverflow,
+            pool_recycle=self.dbPoolRecycle,
+        )
+        if scheme == "sqlite":
+            return SQLitePersistence(url=self.dbURI, **options)
+        return MySQLPersistence(url=self.dbURI, normalized=self.dbNormalized, **options)
+
+    # Export the statistics of the components with the metrics
+    def export_stats(self) -> None:
+        """
+        Adds the stats of the rate limiter, persistence, caches, dispatcher and inquiry pipeline to the metrics
+        """
+        REGISTRY.add_stats("bot_rate_limiter", "Rate limiter", lambda: self.rate_limiter.stats)
+        REGISTRY.add_stats("bot_persistence", "Persistence", self.application.persistence.stats)
+        REGISTRY.add_stats("bot_chat_dispatch", "Chat ordered dispatch", self.application.chat_dispatcher.stats)
+        REGISTRY.add_stats("bot_inquiry_poller", "Inquiry poller", lambda: self.inquire.poller.stats)
+        REGISTRY.add_stats("bot_personas", "Persona registry", lambda: self.personas.stats)
+        REGISTRY.add_stats("bot_admission", "Inquiry admission", self.commands.admission.stats)
+        REGISTRY.add_stats("bot_answer_cache", "Shared answers", self.commands.answers.info)
+        REGISTRY.add_stats("bot_inline_cache", "Inline query cache", self.commands.inline_cache.info)
+        REGISTRY.add_stats("bot_streaming", "Streamed replies", self.commands.streamer.stats)
+        REGISTRY.add_stats("bot_outbound", "Outbound messages", self.commands.outbound.stats)
+        REGISTRY.add_stats("bot_typing", "Typing indicator", lambda: self.commands.typing.stats)
+        REGISTRY.add_stats("bot_tracing", "Tracing", lambda: TRACER.counters)
+        if self.notifier is not None:
+            REGISTRY.add_stats("bot_notifications", "Inquiry notifications", lambda: self.notifier.stats)
+
+    # Serve updates pushed to the webhook instead of polling for them
+    async def serve_webhook(self) -> None:
+        """
+        Serves the webhook until SIGINT or SIGTERM, then drains: stops taking updates, waits for the
+        queued updates and running handlers, including their inquiries, and flushes the persistence
+        """
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        await self.application.initialize()
+        await self.application.post_init(self.application)
+        await self.application.start()
+        try:
+            await self.webhook_server.start()
+            await self.webhook.register()
+            await stop.wait()
+        finally:
+            self.logger.info("Draining, waiting for pending updates and inquiries")
+            await self.webhook_server.stop()
+            # processes the queued updates, waits for the handlers and updates the persistence
+            await self.application.stop()
+            # flushes the persistence
+            await self.application.shutdown()
+            await self.application.post_shutdown(self.application)
+            self.logger.info("Drained, webhook stats: %s", self.webhook.stats)
+
+    # Start the local services once the application is initialized
+    async def post_init(self, application: Application) -> None:
+        """
+        Loads the personas, starts their background refresh and the local HTTP endpoints
+        :param application: Application object
+        """
+        await self.personas.start()
+        if self.http_server is not None:
+            await self.http_server.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+    # Release connections once the application is shut down
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Stops the persona refresh, the local HTTP endpoints, closes the Inquire API client and writes the spans
+        :param application: Application object
+        """
+        await self.personas.stop()
+        if self.http_server is not None:
+            await self.http_server.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await self.inquire.close()
+        TRACER.close()
 
     # Start command handler
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -121,7 +320,7 @@ set - Set the persona to talk to
         if update.effective_chat.type == "ChatType.PRIVATE":
             await self.application.bot.set_chat_menu_button(update.effective_chat.id)
 
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
+        await self.commands.typing.ping(update.effective_chat.id)
 
         # check if an persona was set via a deep link
         command = update.message.text.split(" ")
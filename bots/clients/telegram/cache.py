@@ -0,0 +1,61 @@
+"""This module contains the TTLCache class, a small LRU cache whose entries expire."""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """Least recently used cache whose entries expire ``ttl`` seconds after they were stored.
+
+    Args:
+        maxsize (:obj:`int`): Maximum number of entries, the least recently used one is evicted
+            when a new entry would exceed it.
+        ttl (:obj:`float`): Seconds an entry is served for.
+        timer (:obj:`callable`, optional): Clock returning seconds, :func:`time.monotonic` by default.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """Returns the value stored for the key, :obj:`None` if there is none or it expired."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self._timer():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value
+            del self._entries[key]
+            self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key: Hashable, value: V) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._entries[key] = (self._timer() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def info(self) -> Dict[str, Any]:
+        return dict(self.stats, size=len(self._entries), hit_rate=self.hit_rate())
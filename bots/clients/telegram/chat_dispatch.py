@@ -0,0 +1,163 @@
+"""This module contains the ChatDispatcher class and the ChatOrderedApplication using it, which
+handle the updates of a chat one after another while different chats are handled concurrently."""
+
+import asyncio
+import logging
+import statistics
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+from clients.telegram.tracing import TRACER
+
+
+class ChatDispatcher:
+    """Runs callbacks one after another per key and concurrently across keys.
+
+    The first callback of a key runs right away and then runs the callbacks queued for the key
+    meanwhile, in the order they were dispatched, so an idle key costs nothing and a busy key
+    holds one task. At most ``max_depth`` callbacks wait per key, further ones are dropped.
+    Records how long callbacks waited for their key.
+
+    Args:
+        max_depth (:obj:`int`, optional): Callbacks that may wait per key.
+        chats (:obj:`int`, optional): Number of keys wait times are kept for.
+        samples (:obj:`int`, optional): Number of recent callbacks the overall wait time is computed from.
+    """
+
+    def __init__(self, max_depth: int = 16, chats: int = 10000, samples: int = 1000) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.max_depth = max_depth
+        self.chats = chats
+        # callbacks waiting per key, a key is present while one of its callbacks is running
+        self._mailboxes: Dict[Hashable, Deque[Tuple[float, Callable[[], Awaitable[Any]]]]] = {}
+        self._chat_stats: "OrderedDict[Hashable, Dict[str, float]]" = OrderedDict()
+        self._waits: Deque[float] = deque(maxlen=samples)
+        self.counters = {"dispatched": 0, "queued": 0, "dropped": 0, "max_depth_seen": 0}
+
+    @property
+    def busy(self) -> int:
+        """Number of keys with a running callback."""
+        return len(self._mailboxes)
+
+    @property
+    def waiting(self) -> int:
+        """Number of callbacks waiting for their key."""
+        return sum(len(mailbox) for mailbox in self._mailboxes.values())
+
+    async def dispatch(self, key: Optional[Hashable], callback: Callable[[], Awaitable[Any]]) -> bool:
+        """
+        Runs a callback once the callbacks dispatched before for the same key are done
+        :param key: Key to serialize on, :obj:`None` runs the callback right away
+        :param callback: Coroutine function to run
+        :return: Whether the callback was run or queued, :obj:`False` if it was dropped
+        """
+        self.counters["dispatched"] += 1
+        if key is None:
+            await callback()
+            return True
+
+        now = asyncio.get_running_loop().time()
+        mailbox = self._mailboxes.get(key)
+        if mailbox is not None:
+            if len(mailbox) >= self.max_depth:
+                self.counters["dropped"] += 1
+                self.logger.warning("Dropped an update for %s, %d updates are waiting already", key, len(mailbox))
+                return False
+            # run by the task handling the key right now
+            mailbox.append((now, callback))
+            self.counters["queued"] += 1
+            self.counters["max_depth_seen"] = max(self.counters["max_depth_seen"], len(mailbox))
+            return True
+
+        mailbox = self._mailboxes[key] = deque()
+        try:
+            await self._run(key, now, callback)
+            while mailbox:
+                queued_at, callback = mailbox.popleft()
+                await self._run(key, queued_at, callback)
+        finally:
+            del self._mailboxes[key]
+        return True
+
+    async def _run(self, key: Hashable, queued_at: float, callback: Callable[[], Awaitable[Any]]) -> None:
+        self._record(key, asyncio.get_running_loop().time() - queued_at)
+        try:
+            await callback()
+        except Exception as excp:  # pylint: disable=W0703
+            # the callbacks queued behind it still run
+            self.logger.error("Error in a callback dispatched for %s", key, exc_info=excp)
+
+    def _record(self, key: Hashable, seconds: float) -> None:
+        self._waits.append(seconds)
+
+        stats = self._chat_stats.pop(key, None)
+        if stats is None:
+            stats = {"updates": 0, "wait_seconds_total": 0.0, "max_wait_seconds": 0.0}
+        stats["updates"] += 1
+        stats["wait_seconds_total"] += seconds
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], seconds)
+        self._chat_stats[key] = stats
+        if len(self._chat_stats) > self.chats:
+            self._chat_stats.popitem(last=False)
+
+    def chat_stats(self, key: Hashable) -> Optional[Dict[str, float]]:
+        """Returns how long the updates of a chat waited, :obj:`None` if it had no updates recently."""
+        stats = self._chat_stats.get(key)
+        if stats is None:
+            return None
+        return dict(stats, mean_wait_seconds=stats["wait_seconds_total"] / stats["updates"])
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return dict(
+            self.counters,
+            busy=self.busy,
+            waiting=self.waiting,
+            p50_wait_seconds=statistics.median(waits) if waits else 0.0,
+            p99_wait_seconds=waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+        )
+
+
+class ChatOrderedApplication(Application):
+    """Application handling the updates of a chat in order, even with ``concurrent_updates``.
+
+    Updates are dispatched by :class:`ChatDispatcher` keyed by their chat, e.g. a question sent
+    right after ``/set`` is only handled once the persona is set. Updates without a chat, like
+    inline queries, are handled right away. An update waiting for its chat does not take one of
+    the ``concurrent_updates`` slots. Every update is handled in an ``update`` span, the root of
+    its trace. Pass it to :meth:`telegram.ext.ApplicationBuilder.application_class`.
+
+    Args:
+        max_chat_queue (:obj:`int`, optional): Updates that may wait per chat, further updates
+            of the chat are dropped.
+        **kwargs (:obj:`dict`): Arguments of :class:`telegram.ext.Application`.
+    """
+
+    def __init__(self, *, max_chat_queue: int = 16, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.chat_dispatcher = ChatDispatcher(max_depth=max_chat_queue)
+
+    async def process_update(self, update: object) -> None:
+        key = None
+        attributes = {}
+        if isinstance(update, Update):
+            attributes["update_id"] = update.update_id
+            if update.effective_chat is not None:
+                key = attributes["chat_id"] = update.effective_chat.id
+            if update.effective_user is not None:
+                attributes["user_id"] = update.effective_user.id
+        dispatched = asyncio.get_running_loop().time()
+
+        async def handle() -> None:
+            # the span starts when the update is handled, the time it waited for its chat is an attribute
+            with TRACER.span("update", parent=None, **attributes) as span:
+                span.set(queued_ms=round((asyncio.get_running_loop().time() - dispatched) * 1000, 3))
+                await super(ChatOrderedApplication, self).process_update(update)
+
+        # queued updates return right away and are handled by the task of the chat's first update,
+        # which Application.stop waits for
+        await self.chat_dispatcher.dispatch(key, handle)
@@ -1,11 +1,9 @@
+import asyncio
+import hashlib
 import logging
-import requests
-from uuid import uuid4
 
 import random
 import time
-import json
-import polling2
 
 from telegram import __version__ as TG_VER
 
@@ -23,21 +21,68 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import ContextTypes
 
+from clients.telegram.admission import AdmissionRejected, InquiryAdmission
+from clients.telegram.answer_cache import AnswerCache
+from clients.telegram.cache import TTLCache
+from clients.telegram.metrics import REGISTRY, timed
+from clients.telegram.persona_index import normalize
+from clients.telegram.outbound import Outbound, split_markdown
+from clients.telegram.persona_listing import render_commands
+from clients.telegram.streaming import ReplyStreamer
+from clients.telegram.tracing import TRACER
+from clients.telegram.typing_indicator import TypingIndicator
+
+
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Seconds spent handling an update, by handler", ["handler"])
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors", "Updates whose handler raised, by handler", ["handler"])
+
+
+# result ids sent to Telegram may be at most 64 bytes
+def result_id(name: str) -> str:
+    """
+    Returns the id of a persona's inline query result, the same for every query and restart
+    :param name: Name of the persona
+    :return: Result id
+    """
+    return hashlib.blake2b(name.encode("utf-8"), digest_size=16).hexdigest()
+
 
 class Commands:
-    def __init__(self, application, persona, personas, api_keys):
+    def __init__(self, application, persona, registry, inquire, inline_cache_size=1024, inline_cache_time=300,
+                 answer_cache_personas=(), answer_cache_size=1024, answer_cache_ttl=60, stream_answers=False,
+                 inquiry_max_inflight=64, inquiry_max_per_user=3, inquiry_max_waiting=256, inquiry_wait_timeout=10):
         # Enable logging
         self.logger = logging.getLogger(__name__)
 
         self.application = application
-        self.personas = personas
-        self.persona_list = list()
-        for persona in self.personas:
-            self.persona_list.append(persona['name'])
+        # at most one typing indicator per chat
+        self.typing = TypingIndicator(application.bot)
+        # sends replies, long ones in several messages paced by the bot's rate limiter
+        self.outbound = Outbound(application.bot, typing=self.typing, pause=0)
+        # shows answers while they are written if stream_answers is set, and tracks the time to first token
+        self.stream_answers = stream_answers
+        self.streamer = ReplyStreamer(application.bot)
+        # persona catalog, refreshed in the background
+        self.registry = registry
+        # /all as ready to send messages, rendered for every catalog version
+        self.listing_parts = []
+        self.registry.add_listener(self.render_listing)
+        # built inline query answers by catalog version, normalized query and offset. The results are
+        # the same for every user, so Telegram may also serve them to other users for inline_cache_time seconds
+        self.inline_cache_time = inline_cache_time
+        self.inline_cache = TTLCache(inline_cache_size, inline_cache_time)
         # setting initial persona to `chat`
         self.persona = persona
 
-        (self.inquireApiKey, self.inquireApi) = api_keys
+        # shared async client for the Inquire API
+        self.inquire = inquire
+        # answers of the opted in personas, shared by identical questions asked at the same time or shortly after
+        # a question turned away doesn't turn away the questions waiting for its answer
+        self.answers = AnswerCache(answer_cache_personas, maxsize=answer_cache_size, ttl=answer_cache_ttl,
+                                   unshared=(AdmissionRejected,))
+        # caps the inquiries running at once overall and per user, the questions over the caps are turned away
+        self.admission = InquiryAdmission(max_inflight=inquiry_max_inflight, max_per_user=inquiry_max_per_user,
+                                          max_waiting=inquiry_max_waiting, wait_timeout=inquiry_wait_timeout)
 
         # Help text
         self.help_text = f"""
@@ -50,48 +95,24 @@ If you are in a group chat you will need to preface your inquiry with `/chat`
 Learn more about Inquire at https://inquire.run
         """
 
+    # Render the /all listing of a persona catalog
+    def render_listing(self, catalog) -> None:
+        """
+        Renders the commands and personas of a catalog into the messages sent by /all
+        :param catalog: PersonaCatalog object
+        """
+        self.listing_parts = split_markdown(render_commands(catalog.personas))
+
     # Send a message to a chat
     async def send_message(self, update: Update, text: str, **kwargs):
-        self.logger.info("Sending message")
-
         """
         Send a message to a chat, splitting it into multiple messages if it's too long see https://github.com/python-telegram-bot/python-telegram-bot/issues/768
         :param update: Update object
-        :param chat_id: Chat ID
         :param text: Text to send
+        :return: The last message sent
         """
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
-
-        MAX_TEXT_LENGTH = 4096
-        if len(text) <= MAX_TEXT_LENGTH:
-            self.logger.info("Message is below max length. Sending reply")
-            msg = await update.message.reply_text(text, **kwargs, parse_mode="Markdown")
-            self.logger.info("Reply sent")
-            return msg
-
-        self.logger.info("Message is above max size. Sending in parts.")
-        parts = []
-        while len(text) > 0:
-            if len(text) > MAX_TEXT_LENGTH:
-                part = text[:MAX_TEXT_LENGTH]
-                first_lnbr = part.rfind('\n')
-                if first_lnbr != -1:
-                    parts.append(part[:first_lnbr])
-                    text = text[first_lnbr:]
-                else:
-                    parts.append(part)
-                    text = text[MAX_TEXT_LENGTH:]
-            else:
-                parts.append(text)
-                break
-
-        msg = None
-        for part in parts:
-            msg = await self.send_message(update, part, **kwargs)
-            self.logger.info("Message sent")
-            time.sleep(1)
-        self.logger.info("All message parts sent")
-        return msg  # return only the last message
+        self.logger.info("Sending message")
+        return await self.outbound.reply(update, text, **kwargs)
 
     # Put chat related data https://github.com/python-telegram-bot/python-telegram-bot/wiki/Storing-bot,-user-and-chat-related-data
     async def put(self, data, update, context):
@@ -132,13 +153,14 @@ Learn more about Inquire at https://inquire.run
     # Chat Commands
 
     # Help command handler
+    @timed(HANDLER_SECONDS, "help", errors=HANDLER_ERRORS)
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Sends the help text to the user
         :param update: Update object
         :param context: CallbackContext object
         """
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
+        await self.typing.ping(update.effective_chat.id)
 
         await update.message.reply_text(self.help_text, parse_mode="Markdown")
 
@@ -150,7 +172,7 @@ Learn more about Inquire at https://inquire.run
         :param update: Update object
         :param context: CallbackContext object
         """
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
+        await self.typing.ping(update.effective_chat.id)
 
         # set the persona
         await self.put(new_persona, update, context)
@@ -162,6 +184,7 @@ Learn more about Inquire at https://inquire.run
         self.logger.info('Deep link persona set')
 
     # Sets the persona for a chat
+    @timed(HANDLER_SECONDS, "set", errors=HANDLER_ERRORS)
     async def set_persona_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Sets the persona for a chat, used to query the correct persona
@@ -170,7 +193,7 @@ Learn more about Inquire at https://inquire.run
         """
         self.logger.info('Setting persona')
 
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
+        await self.typing.ping(update.effective_chat.id)
 
         chat_data = update.message.text.split('/')[1].split(' ')
 
@@ -197,7 +220,10 @@ Learn more about Inquire at https://inquire.run
         persona = await self.get(update, context)
 
         # check to see if persona exists
-        if persona not in self.persona_list:
+        with TRACER.span("persona.lookup", persona=persona) as span:
+            found = persona in self.registry
+            span.set(found=found)
+        if not found:
             await update.message.reply_text(f"Sorry, {persona} is not a valid persona")
             return
 
@@ -212,6 +238,7 @@ Learn more about Inquire at https://inquire.run
         self.logger.info('Persona set')
 
     # List a random 10 personas for the user
+    @timed(HANDLER_SECONDS, "random", errors=HANDLER_ERRORS)
     async def random_personas_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         List a random 10 personas for the user
@@ -221,22 +248,16 @@ Learn more about Inquire at https://inquire.run
         self.logger.info('Setting random persona')
 
         keyboard = []
-        persona_count = 0
-
-        # randomise the personas
-        random.shuffle(self.personas)
-
-        for key in self.personas:
-            if persona_count < 10:
-                keyboard.append(
-                    [
-                        InlineKeyboardButton(
-                            key['name'], callback_data=key["name"]),
-                    ],
-                )
-                persona_count += 1
-            else:
-                break
+
+        # pick 10 random personas
+        personas = self.registry.catalog.personas
+        for key in random.sample(personas, min(10, len(personas))):
+            keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        key['name'], callback_data=key["name"]),
+                ],
+            )
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text("List of 10 Random Personas", reply_markup=reply_markup)
@@ -244,19 +265,20 @@ Learn more about Inquire at https://inquire.run
         self.logger.info('Random persona sets')
 
     # List all commands and personas that can be used
+    @timed(HANDLER_SECONDS, "all", errors=HANDLER_ERRORS)
     async def list_all_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         List all commands and personas that can be used
         :param update: Update object
         :param context: CallbackContext object
         """
-        with open("personas.txt", "r") as f:
-            await self.send_message(update, f.read())
-            # await update.message.reply_text(f.read())
+        # the list assigned by the last catalog refresh, even if another one happens meanwhile
+        await self.outbound.reply_parts(update, self.listing_parts)
 
         self.logger.info('List command message sent')
 
     # Sends the current persona to the user
+    @timed(HANDLER_SECONDS, "persona", errors=HANDLER_ERRORS)
     async def current_persona_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Sends the current persona to the user
@@ -276,13 +298,14 @@ Learn more about Inquire at https://inquire.run
         self.logger.info('Sent current persona message')
 
     # When a user selects a persona from the list set it
+    @timed(HANDLER_SECONDS, "set_callback", errors=HANDLER_ERRORS)
     async def set_persona_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Sets the persona for a chat, used to query the correct persona
         :param update: Update object
         :param context: CallbackContext object
         """
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
+        await self.typing.ping(update.effective_chat.id)
 
         query = update.callback_query
 
@@ -298,13 +321,8 @@ Learn more about Inquire at https://inquire.run
 
         await query.edit_message_text(text=f"You are now chatting with a {persona} bot, any chat will be returned with an answer")
 
-    # check if the response is correct
-    def is_correct_response(self, response):
-        """Check if the API returns 'COMPLETED'"""
-        content = json.loads(response.content)
-        return content['data']['status'] == 'COMPLETED'
-
     # Call the Inquire API to query the persona
+    @timed(HANDLER_SECONDS, "query_persona", errors=HANDLER_ERRORS)
     async def query_persona(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Call the Inquire API to query the persona
@@ -313,8 +331,6 @@ Learn more about Inquire at https://inquire.run
         """
         self.logger.info('Completing inquiry')
 
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
-
         query = update.message.text
 
         # if the user is using the `/chat` command then remove it
@@ -326,49 +342,81 @@ Learn more about Inquire at https://inquire.run
 
         query = update.message.text
 
-        url = self.inquireApi + "/inquiries"
-        headers = {
-            "x-api-key": self.inquireApiKey,
-        }
-
         # get the persona
-        persona = await self.get(update, context)
-
-        payload = {
-            "connectionType": "TELEGRAM",
-            "connectionUserId": update.message.from_user.id,
-            "queryType": persona,
-            "query": query
-        }
+        with TRACER.span("persona.lookup") as span:
+            persona = await self.get(update, context)
+            span.set(persona=persona)
+        started = time.perf_counter()
+
+        # a placeholder edited as partial results arrive
+        reply = None
+        if self.stream_answers:
+            reply = await self.streamer.start(update.effective_chat.id, update.message.message_id, started=started)
+
+        async def inquire():
+            # waits for a free slot, shared answers don't take one
+            async with self.admission.admit(update.message.from_user.id):
+                inquiry = await self.inquire.create_inquiry(update.message.from_user.id, persona, query)
+
+                self.logger.info('Inquiry completion started')
+
+                # wait for the response without blocking other updates
+                self.logger.info('Waiting for inquiry')
+                if reply is None:
+                    return await self.inquire.wait_for_inquiry(inquiry['id'], timeout=45)
+                return await self.inquire.wait_for_inquiry(
+                    inquiry['id'], timeout=45, on_partial=reply.feed_inquiry, partial_step=reply.interval)
 
-        response = requests.post(url, headers=headers, data=payload)
-        content = json.loads(response.content)
+        try:
+            # one typing indicator for the chat, renewed until the inquiry is finished
+            try:
+                async with self.typing.typing(update.effective_chat.id):
+                    inquiry = await self.answers.answer(persona, query, inquire)
+            except asyncio.TimeoutError:
+                await self.send_answer(update, reply, 'Sorry, I am having trouble answering your question. Please try again later.', answer=False)
+                raise Exception("Timeout waiting for response")
+            except AdmissionRejected as excp:
+                # shedding load is expected under a spike, not an error
+                self.logger.warning('Inquiry not admitted: %s', excp.reason)
+                if excp.reason == 'user':
+                    text = 'I am still answering your previous questions, please wait for them before asking more.'
+                else:
+                    text = 'I am answering a lot of questions right now. Please try again in a minute.'
+                await self.send_answer(update, reply, text, answer=False)
+                return
 
-        self.logger.info('Inquiry completion started')
+            if inquiry['status'] != 'COMPLETED':
+                await self.send_answer(update, reply, 'Sorry, I am having trouble answering your question. Please try again later.', answer=False)
+                raise Exception("Inquiry failed")
 
-        # poll the API until the response is ready
-        poll_url = self.inquireApi + "/inquiries/" + content['data']['id']
-
-        self.logger.info('Begin polling inquiry status')
-        try:
-            poll = polling2.poll(
-                lambda: requests.get(
-                    poll_url,
-                    headers=headers
-                ),
-                check_success=self.is_correct_response,
-                step=0.5,
-                timeout=45
-            )
-            self.logger.info('Inquiry polling completed')
-            await self.send_message(update, poll.json()['data']['result'])
-        except polling2.TimeoutException:
-            await self.send_message(update, 'Sorry, I am having trouble answering your question. Please try again later.')
-            raise Exception("Timeout waiting for response")
+            self.logger.info('Inquiry completed')
+            await self.send_answer(update, reply, inquiry['result'], started=started)
+        finally:
+            if reply is not None:
+                await reply.close()
 
         self.logger.info('Sent completed inquiry')
 
+    # Send the answer to a question
+    async def send_answer(self, update: Update, reply, text: str, answer: bool = True, started: float = None):
+        """
+        Send the answer to a question, by finishing the streamed reply if there is one
+        :param update: Update object
+        :param reply: StreamingReply object or None
+        :param text: Text to send
+        :param answer: Whether the text is the answer and not an apology
+        :param started: time.perf_counter() when the question was received, to record the time to first token
+        :return: The last message sent
+        """
+        if reply is not None:
+            return await reply.finish(text, answer=answer)
+        msg = await self.send_message(update, text)
+        if answer and started is not None:
+            self.streamer.record_first_token(time.perf_counter() - started)
+        return msg
+
     # Chat command to handle chats in groups
+    @timed(HANDLER_SECONDS, "chat", errors=HANDLER_ERRORS)
     async def chat_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Chat command to handle chats in groups
@@ -376,7 +424,7 @@ Learn more about Inquire at https://inquire.run
         :param context: CallbackContext object
         """
         self.logger.info('Handling chat command')
-        await self.application.bot.send_chat_action(update.effective_chat.id, "typing")
+        await self.typing.ping(update.effective_chat.id)
 
         # get the persona
         persona = await self.get(update, context)
@@ -389,6 +437,7 @@ Learn more about Inquire at https://inquire.run
         self.logger.info('Chat command completed')
 
     # Handle the inline query
+    @timed(HANDLER_SECONDS, "inline_query", errors=HANDLER_ERRORS)
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle the inline query. This is run when you type: @botusername <query>
@@ -401,20 +450,28 @@ Learn more about Inquire at https://inquire.run
         if query == "":
             return
 
-        # search personas for the query
-        results = []
-        for key in self.personas:
-            if query.lower() in key['name'].lower():
+        catalog = self.registry.catalog
+        key = (catalog.version, normalize(query), update.inline_query.offset)
+        answer = self.inline_cache.get(key)
+        if answer is None:
+            # search personas for the query, one page of at most 50 ranked results at a time
+            personas, next_offset = catalog.index.search(query, update.inline_query.offset)
+            results = []
+            for persona in personas:
                 results.append(
                     InlineQueryResultArticle(
-                        id=str(uuid4()),
-                        title=key['name'],
+                        id=result_id(persona['name']),
+                        title=persona['name'],
                         input_message_content=InputTextMessageContent(
-                            f"/set {key['name']}"),
-                        description=f"{key['description']}",
+                            f"/set {persona['name']}"),
+                        description=f"{persona['description']}",
                     ),
                 )
+            answer = (results, next_offset)
+            self.inline_cache.set(key, answer)
 
-        await update.inline_query.answer(results)
+        results, next_offset = answer
+        await update.inline_query.answer(
+            results, cache_time=self.inline_cache_time, is_personal=False, next_offset=next_offset)
 
         self.logger.info('Inline query handled')
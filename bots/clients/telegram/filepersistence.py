@@ -0,0 +1,174 @@
+"""This module contains the FilePersistence class, storing the bot's data as an append-only log
+plus a periodic snapshot in a local directory."""
+
+import asyncio
+import os
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple
+
+from clients.telegram.persistence import IncrementalPersistence, _dumps, _loads
+
+SNAPSHOT_FILE = "snapshot.jsonl"
+LOG_FILE = "log.jsonl"
+
+
+class FilePersistence(IncrementalPersistence):
+    """Stores the bot's data in a local directory, for single-node deployments and for measuring
+    persistence cost without a database server.
+
+    Every flush appends one ``[kind, id, data]`` json line per changed key to ``log.jsonl``, a
+    ``null`` data removes the key. Once the log holds ``snapshot_threshold`` records, and on
+    shutdown, all keys are written to a new ``snapshot.jsonl`` and the log is truncated.
+    On startup the snapshot is read and the log replayed on top of it.
+
+    Args:
+        url (:obj:`str`): the directory, ``file://<path>``. It is created if needed.
+        snapshot_threshold (:obj:`int`, optional): log records after which a snapshot is written.
+        fsync (:obj:`bool`, optional): whether to fsync the log after every write, otherwise
+            a crash of the machine may lose the last writes.
+        **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to the
+            :class:`clients.telegram.persistence.IncrementalPersistence` constructor, e.g.
+            ``on_flush`` or ``flush_interval``. Lazy loading is not supported.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        snapshot_threshold: int = 100000,
+        fsync: bool = True,
+        **kwargs: Any,
+    ) -> None:
+        if not url.startswith("file://"):
+            raise TypeError(f"{url} isn't a valid file URL.")
+        if kwargs.get("lazy") or kwargs.get("normalized") is False:
+            raise TypeError("FilePersistence always loads all data and stores one entry per key.")
+
+        self.directory = url[len("file://"):]
+        self.snapshot_threshold = snapshot_threshold
+        self.fsync = fsync
+        # serialized data of every stored key, only touched by the writer thread after loading
+        self._entries: Dict[Tuple[str, str], str] = {}
+        self._log: Optional[IO[str]] = None
+        self._log_records = 0
+        # whether a failed write may have left a partial line at the end of the log
+        self._log_torn = False
+        self._file_stats = {"log_records": 0, "snapshots": 0}
+        super().__init__(**kwargs)
+
+    @property
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    @property
+    def _log_path(self) -> str:
+        return os.path.join(self.directory, LOG_FILE)
+
+    def _read_records(self, path: str) -> Iterator[List[Any]]:
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as file:
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield _loads(line)
+                except ValueError:
+                    # a write interrupted by a crash, the key is written again with the next change
+                    self.logger.warning("Skipping unreadable record %s:%s", path, number)
+
+    def _load(self) -> Dict[str, Any]:
+        os.makedirs(self.directory, exist_ok=True)
+
+        for kind, key, data in self._read_records(self._snapshot_path):
+            self._entries[(kind, key)] = data
+        for kind, key, data in self._read_records(self._log_path):
+            self._log_records += 1
+            if data is None:
+                self._entries.pop((kind, key), None)
+            else:
+                self._entries[(kind, key)] = data
+        self._file_stats["log_records"] = self._log_records
+        if os.path.exists(self._log_path) and os.path.getsize(self._log_path):
+            with open(self._log_path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                self._log_torn = file.read() != b"\n"
+
+        data = self._decode_entries((kind, key, value) for (kind, key), value in self._entries.items())
+        if data is None:
+            return {"chat_data": None, "user_data": None, "bot_data": "",
+                    "callback_data": "", "conversations": ""}
+        return data
+
+    def _write_changes(self, upserts: List[Dict[str, str]], deletes: List[Dict[str, str]]) -> bool:
+        if not upserts and not deletes:
+            return True
+
+        records = [[row["kind"], row["id"], row["data"]] for row in upserts]
+        records.extend([row["kind"], row["id"], None] for row in deletes)
+        try:
+            if self._log is None:
+                self._log = open(self._log_path, "a", encoding="utf-8")
+            # start on a fresh line if the last write was cut off
+            self._log.write(("\n" if self._log_torn else "") + "".join(_dumps(record) + "\n" for record in records))
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._log_torn = False
+        except OSError as excp:
+            self._log_torn = True
+            self._last_error = repr(excp)
+            self.logger.warning("Failed to append to %s", self._log_path, exc_info=excp)
+            return False
+
+        for kind, key, data in records:
+            if data is None:
+                self._entries.pop((kind, key), None)
+            else:
+                self._entries[(kind, key)] = data
+        self._log_records += len(records)
+        self._file_stats["log_records"] = self._log_records
+
+        if self._log_records >= self.snapshot_threshold:
+            self._snapshot()
+        return True
+
+    def _snapshot(self) -> None:
+        """Writes all keys to a new snapshot and truncates the log. Runs in the writer thread."""
+        temporary = self._snapshot_path + ".tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as file:
+                for (kind, key), data in self._entries.items():
+                    file.write(_dumps([kind, key, data]) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self._snapshot_path)
+
+            # replaying the log onto the new snapshot is harmless, so a crash before the
+            # truncation loses nothing
+            if self._log is not None:
+                self._log.close()
+            self._log = open(self._log_path, "w", encoding="utf-8")
+        except OSError as excp:
+            # the log still holds everything, the next write tries again
+            self.logger.warning("Failed to write snapshot %s", self._snapshot_path, exc_info=excp)
+            return
+
+        self._log_records = 0
+        self._log_torn = False
+        self._file_stats["log_records"] = 0
+        self._file_stats["snapshots"] += 1
+
+    def _close(self) -> None:
+        if self._log_records:
+            self._snapshot()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _backend_stats(self) -> Dict[str, Any]:
+        return dict(self._file_stats)
+
+    async def flush(self) -> None:
+        """Writes everything that is still dirty, then compacts the log into a snapshot so the
+        next start does not need to replay it."""
+        await super().flush()
+        await asyncio.get_running_loop().run_in_executor(self._writer, self._close)
@@ -0,0 +1,211 @@
+"""This module contains a minimal asyncio HTTP/1.1 server for the bot's local endpoints."""
+
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+HttpResponse = Tuple[int, Any]
+HttpHandler = Callable[["HttpRequest"], Awaitable[HttpResponse]]
+
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized",
+           404: "Not Found", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HttpError(Exception):
+    """Raised while reading a request that cannot be served, args are ``(status, message)``."""
+
+
+class HttpRequest:
+    """A parsed HTTP request.
+
+    Attributes:
+        method (:obj:`str`): Upper-case request method.
+        path (:obj:`str`): Request path without the query string.
+        headers (:obj:`dict`): Request headers with lower-case names.
+        body (:obj:`bytes`): Raw request body.
+    """
+
+    __slots__ = ("method", "path", "headers", "body")
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> None:
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Any:
+        return json.loads(self.body or b"null")
+
+
+class HttpServer:
+    """Serves a handful of routes on a local port without pulling in a web framework.
+
+    Handlers are coroutines receiving a :class:`HttpRequest` and returning
+    ``(status, body)``; ``dict``/``list`` bodies are sent as JSON, ``str``/``bytes`` as text.
+
+    Args:
+        host (:obj:`str`): Address to listen on.
+        port (:obj:`int`): Port to listen on, ``0`` picks a free port.
+        max_body_size (:obj:`int`, optional): Requests with a larger body are rejected.
+        max_connections (:obj:`int`, optional): Connections beyond this many are answered with
+            ``503`` and closed, unlimited by default.
+        idle_timeout (:obj:`float`, optional): Seconds a connection may take to send a request,
+            or wait for the next one, before it is closed.
+        max_headers (:obj:`int`, optional): Requests with more header lines are rejected.
+    """
+
+    def __init__(self, host: str, port: int, max_body_size: int = 1 << 20,
+                 max_connections: Optional[int] = None, idle_timeout: float = 30.0,
+                 max_headers: int = 100) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_headers = max_headers
+        self._routes: List[Tuple[str, str, HttpHandler]] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        # open connections and whether they are serving a request
+        self._connections: Dict[asyncio.StreamWriter, bool] = {}
+        self._closing = False
+
+    def route(self, method: str, prefix: str, handler: HttpHandler) -> None:
+        """
+        Registers a handler for all paths starting with ``prefix``, first match wins
+        :param method: HTTP method to match
+        :param prefix: Path prefix to match
+        :param handler: Coroutine handling the request
+        """
+        self._routes.append((method.upper(), prefix, handler))
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.logger.info("HTTP server listening on %s:%s", self.host, self.port)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Stops accepting connections, lets requests in progress finish and closes all connections
+        :param timeout: Seconds to wait for requests in progress
+        """
+        if self._server is None:
+            return
+        self._closing = True
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while any(self._connections.values()) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        # idle keep-alive connections are waiting for a request that won't be served
+        for writer in list(self._connections):
+            writer.close()
+        self._closing = False
+
+    @staticmethod
+    async def _readline(reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            # longer than the reader's limit of 64 KiB
+            raise HttpError(431, "Request line or header too long")
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[HttpRequest]:
+        request_line = await self._readline(reader)
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+
+        headers = {}
+        for _ in range(self.max_headers + 1):
+            line = await self._readline(reader)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HttpError(431, f"More than {self.max_headers} headers")
+
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(400, "Invalid Content-Length header")
+        if length > self.max_body_size:
+            raise HttpError(413, f"Request body of {length} bytes is too large")
+        body = await reader.readexactly(length) if length else b""
+
+        return HttpRequest(method.upper(), target.split("?", 1)[0], headers, body)
+
+    async def _dispatch(self, request: HttpRequest) -> HttpResponse:
+        for method, prefix, handler in self._routes:
+            if request.method == method and request.path.startswith(prefix):
+                try:
+                    return await handler(request)
+                except Exception as excp:  # pylint: disable=W0703
+                    self.logger.error("Error handling %s %s", request.method, request.path, exc_info=excp)
+                    return 500, {"code": "INTERNAL_SERVER_ERROR", "message": str(excp)}
+        return 404, {"code": "NOT_FOUND", "message": f"No route for {request.method} {request.path}"}
+
+    def _encode(self, status: int, body: Any, keep_alive: bool) -> bytes:
+        if isinstance(body, (dict, list)):
+            payload, content_type = json.dumps(body).encode(), "application/json"
+        elif isinstance(body, bytes):
+            payload, content_type = body, "text/plain; charset=utf-8"
+        else:
+            payload, content_type = str(body or "").encode(), "text/plain; charset=utf-8"
+
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        return head.encode("latin-1") + payload
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if self.max_connections is not None and len(self._connections) >= self.max_connections:
+            writer.write(self._encode(503, {"code": "SERVICE_UNAVAILABLE", "message": "Too many connections"}, False))
+            writer.close()
+            return
+
+        self._connections[writer] = False
+        try:
+            while True:
+                try:
+                    # idle or slow connections would hold a slot of max_connections
+                    request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except HttpError as excp:
+                    status, message = excp.args
+                    code = REASONS.get(status, "Bad Request").upper().replace(" ", "_")
+                    writer.write(self._encode(status, {"code": code, "message": message}, False))
+                    break
+                if request is None:
+                    break
+
+                self._connections[writer] = True
+                status, body = await self._dispatch(request)
+                # the client reconnects elsewhere once the server is closing
+                keep_alive = request.headers.get("connection", "").lower() != "close" and not self._closing
+                writer.write(self._encode(status, body, keep_alive))
+                await writer.drain()
+                self._connections[writer] = False
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._connections[writer]
+            writer.close()
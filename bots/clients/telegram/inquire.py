@@ -0,0 +1,202 @@
+"""This module contains the InquireClient class, an asyncio client for the Inquire API."""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from clients.telegram.inquiry_poller import InquiryPoller
+from clients.telegram.metrics import REGISTRY
+from clients.telegram.notifications import InquiryNotifier
+from clients.telegram.tracing import TRACER
+
+API_SECONDS = REGISTRY.histogram(
+    "bot_inquire_api_request_seconds", "Seconds an Inquire API request took, by call: create (POST), poll, "
+    "batch_poll or personas", ["call"])
+API_RESPONSES = REGISTRY.counter(
+    "bot_inquire_api_responses", "Inquire API responses by call and status code, 0 if the request failed", ["call", "code"])
+
+
+class InquireApiError(Exception):
+    """Raised when the Inquire API answers with a non 2xx status code.
+
+    The arguments are ``(status_code, response_text)`` so the bot's error handler
+    can decode the API error code from the response body.
+    """
+
+
+class InquireClient:
+    """Asyncio client for the Inquire API backed by a single pooled :class:`httpx.AsyncClient`.
+
+    Args:
+        api_url (:obj:`str`): Base url of the Inquire API, e.g. ``https://inquire.run/api/v1``.
+        api_key (:obj:`str`): Key sent in the ``x-api-key`` header.
+        max_connections (:obj:`int`, optional): Size of the shared connection pool.
+        timeout (:obj:`float`, optional): Timeout in seconds for a single HTTP request.
+        notifier (:class:`InquiryNotifier`, optional): When set, inquiries are awaited through
+            completion notifications and only polled every ``fallback_step`` seconds in case a
+            notification was missed.
+        fallback_step (:obj:`float`, optional): Seconds between fallback polls in notification mode.
+        batch_size (:obj:`int`, optional): Ids per batch status lookup
+            (``GET /inquiries?ids=...``), ``0`` disables batch lookups.
+        **poller_kwargs (:obj:`dict`): Arbitrary keyword arguments passed to :class:`InquiryPoller`.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        api_key: str,
+        max_connections: int = 100,
+        timeout: float = 10.0,
+        notifier: Optional[InquiryNotifier] = None,
+        fallback_step: float = 5.0,
+        batch_size: int = 0,
+        **poller_kwargs: Any,
+    ) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.api_url = api_url
+        self.notifier = notifier
+        self.fallback_step = fallback_step
+        # one poller shared by all pending inquiries
+        self.poller = InquiryPoller(self, batch_size=batch_size, **poller_kwargs)
+        self._client = httpx.AsyncClient(
+            base_url=api_url,
+            headers={"x-api-key": api_key},
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    async def _request(self, call: str, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """Sends a request, recording its latency and status code under ``call``."""
+        start = time.perf_counter()
+        code = 0
+        try:
+            response = await self._client.request(method, url, **kwargs)
+            code = response.status_code
+            return response
+        finally:
+            API_SECONDS.labels(call).observe(time.perf_counter() - start)
+            API_RESPONSES.labels(call, code).inc()
+
+    def _content(self, response: httpx.Response) -> Dict[str, Any]:
+        """Returns the decoded body of a response, raising on API errors."""
+        if response.is_error:
+            raise InquireApiError(response.status_code, response.text)
+        return response.json()
+
+    async def create_inquiry(self, connection_user_id: int, persona: str, query: str) -> Dict[str, Any]:
+        """
+        Starts a new inquiry
+        :param connection_user_id: Telegram user id the inquiry is billed to
+        :param persona: Persona to query
+        :param query: Text of the inquiry
+        :return: The created inquiry
+        """
+        payload = {
+            "connectionType": "TELEGRAM",
+            "connectionUserId": connection_user_id,
+            "queryType": persona,
+            "query": query
+        }
+
+        parent = TRACER.current()
+        with TRACER.span("inquiry.create", persona=persona) as span:
+            response = await self._request("create", "POST", "/inquiries", data=payload)
+            inquiry = self._content(response)['data']
+            span.set(status_code=response.status_code)
+        # the lines logged for the update from now on carry the inquiry id
+        if parent is not None:
+            parent.set(inquiry_id=inquiry['id'])
+        return inquiry
+
+    async def get_inquiry(self, inquiry_id: str) -> Dict[str, Any]:
+        """
+        Fetches the current state of an inquiry
+        :param inquiry_id: Id of the inquiry
+        :return: The inquiry
+        """
+        response = await self._request("poll", "GET", f"/inquiries/{inquiry_id}")
+        return self._content(response)['data']
+
+    async def get_inquiries(self, inquiry_ids: List[str]) -> Optional[List[Dict[str, Any]]]:
+        """
+        Fetches the current state of several inquiries with one request
+        :param inquiry_ids: Ids of the inquiries
+        :return: The inquiries, or None if the API does not support batch lookups
+        """
+        response = await self._request("batch_poll", "GET", "/inquiries", params={"ids": ",".join(inquiry_ids)})
+        if response.status_code in (400, 404, 405):
+            return None
+        inquiries = self._content(response)['data']
+
+        # older APIs ignore the ids and list personas instead
+        if not all(isinstance(inquiry, dict) and 'status' in inquiry for inquiry in inquiries):
+            return None
+        return inquiries
+
+    async def list_personas(
+        self, etag: Optional[str] = None, last_modified: Optional[str] = None,
+    ) -> Optional[Tuple[List[Dict[str, Any]], Optional[str], Optional[str]]]:
+        """
+        Fetches the persona catalog, conditionally if the validators of a previous response are given
+        :param etag: ``ETag`` header of the previous response
+        :param last_modified: ``Last-Modified`` header of the previous response
+        :return: The personas with the ``ETag`` and ``Last-Modified`` headers of the response,
+            or None if the catalog did not change
+        """
+        headers = {}
+        if etag:
+            headers["if-none-match"] = etag
+        if last_modified:
+            headers["if-modified-since"] = last_modified
+
+        response = await self._request("personas", "GET", "/inquiries", headers=headers)
+        if response.status_code == 304:
+            return None
+        personas = self._content(response)['data']
+        return personas, response.headers.get("etag"), response.headers.get("last-modified")
+
+    async def wait_for_inquiry(self, inquiry_id: str, timeout: float = 45,
+                               on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+                               partial_step: float = 1.0) -> Dict[str, Any]:
+        """
+        Waits until an inquiry is completed or failed, without blocking other updates
+        :param inquiry_id: Id of the inquiry
+        :param timeout: Seconds after which :class:`asyncio.TimeoutError` is raised
+        :param on_partial: Called with the unfinished inquiry whenever the API returned a partial
+            ``result`` for it, the inquiry is then polled every ``partial_step`` seconds
+        :param partial_step: Seconds between polls for partial results
+        :return: The finished inquiry
+        """
+        if self.notifier is not None:
+            future = self.notifier.register(inquiry_id)
+            # the poller only covers for missed notifications
+            min_delay = self.fallback_step
+        else:
+            future = asyncio.get_running_loop().create_future()
+            min_delay = None
+
+        # partial results are only polled for, notifications are only sent for finished inquiries
+        step = partial_step if on_partial is not None else None
+        with TRACER.span("inquiry.wait", inquiry_id=inquiry_id) as span:
+            # the polls are children of this span
+            self.poller.track(inquiry_id, future, min_delay=min_delay, step=step, on_partial=on_partial)
+            try:
+                inquiry = await asyncio.wait_for(asyncio.shield(future), timeout)
+                span.set(status=inquiry.get('status'))
+                return inquiry
+            finally:
+                self.poller.untrack(inquiry_id)
+                if self.notifier is not None:
+                    self.notifier.discard(inquiry_id)
+
+    async def close(self, *args: Optional[object]) -> None:
+        """Stops polling and closes the underlying connection pool."""
+        await self.poller.stop()
+        await self._client.aclose()
@@ -0,0 +1,282 @@
+"""This module contains the InquiryPoller class, a single scheduler polling all pending inquiries."""
+
+import asyncio
+import heapq
+import logging
+import random
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from clients.telegram.metrics import REGISTRY
+from clients.telegram.notifications import FINAL_STATUSES
+from clients.telegram.tracing import TRACER, Span
+
+# points of the observed completion time distribution that polls are scheduled at
+QUANTILES = (0.1, 0.25, 0.4, 0.5, 0.6, 0.75, 0.9, 0.95, 0.99)
+
+INQUIRY_POLLS = REGISTRY.histogram(
+    "bot_inquiry_polls", "Times a finished inquiry was looked up while it was pending",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50))
+INQUIRY_SECONDS = REGISTRY.histogram("bot_inquiry_seconds", "Seconds from tracking an inquiry until it was finished")
+
+
+class _Pending:
+    __slots__ = ("inquiry_id", "future", "created", "attempts", "polls", "min_delay", "step", "on_partial", "span")
+
+    def __init__(self, inquiry_id: str, future: asyncio.Future, created: float, min_delay: float,
+                 step: Optional[float] = None,
+                 on_partial: Optional[Callable[[Dict[str, Any]], None]] = None, span: Optional[Span] = None) -> None:
+        self.inquiry_id = inquiry_id
+        self.future = future
+        self.created = created
+        self.attempts = 0
+        # lookups, including the one that found the inquiry finished
+        self.polls = 0
+        self.min_delay = min_delay
+        self.step = step
+        self.on_partial = on_partial
+        # span of the waiting update, the parent of the poll spans
+        self.span = span
+
+
+class InquiryPoller:
+    """Polls every pending inquiry from one background task.
+
+    Each inquiry gets its own jittered schedule: polls are placed at the quantiles of recently
+    observed completion times, so most inquiries are checked shortly after they usually finish,
+    and back off exponentially past the tail of the distribution. Until enough completions were
+    observed a plain exponential backoff from ``min_step`` is used. Due inquiries are looked up
+    in background tasks, at most ``max_concurrent_polls`` at once, so a slow lookup does not
+    hold up the polls due after it.
+
+    Args:
+        client (:class:`clients.telegram.inquire.InquireClient`): Client used for the lookups.
+        min_step (:obj:`float`, optional): Minimum seconds between two polls of an inquiry.
+        max_step (:obj:`float`, optional): Maximum seconds between two polls of an inquiry.
+        factor (:obj:`float`, optional): Growth factor of the exponential backoff.
+        jitter (:obj:`float`, optional): Relative random spread applied to every delay.
+        batch_size (:obj:`int`, optional): Ids per batch status lookup, ``0`` polls every
+            inquiry with its own request.
+        samples (:obj:`int`, optional): Number of recent completion times to tune from.
+        max_concurrent_polls (:obj:`int`, optional): Rounds of lookups running at once.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        min_step: float = 0.5,
+        max_step: float = 5.0,
+        factor: float = 1.5,
+        jitter: float = 0.2,
+        batch_size: int = 0,
+        samples: int = 500,
+        max_concurrent_polls: int = 4,
+    ) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.client = client
+        self.min_step = min_step
+        self.max_step = max_step
+        self.factor = factor
+        self.jitter = jitter
+        self.batch_size = batch_size
+
+        self._pending: Dict[str, _Pending] = {}
+        self._schedule: List[Tuple[float, int, str]] = []
+        self._sequence = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.max_concurrent_polls = max_concurrent_polls
+        self._poll_slots: Optional[asyncio.Semaphore] = None
+        self._polls: Set[asyncio.Task] = set()
+
+        self._durations: Deque[float] = deque(maxlen=samples)
+        self._quantiles: Optional[List[float]] = None
+        self._new_samples = 0
+
+        self.stats = {"requests": 0, "lookups": 0, "resolved": 0, "errors": 0}
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def track(self, inquiry_id: str, future: asyncio.Future, min_delay: Optional[float] = None,
+              step: Optional[float] = None, on_partial: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        """
+        Polls an inquiry until it is finished and resolves ``future`` with it
+        :param inquiry_id: Id of the inquiry
+        :param future: Future to resolve, may also be resolved by someone else
+        :param min_delay: Minimum seconds between polls, e.g. when completions are also notified
+        :param step: Seconds between polls instead of the tuned schedule, e.g. while streaming
+        :param on_partial: Called with the inquiry whenever a poll finds it unfinished with a partial result
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._poll_slots = asyncio.Semaphore(self.max_concurrent_polls)
+            self._task = loop.create_task(self._run())
+
+        pending = _Pending(inquiry_id, future, loop.time(), min_delay or self.min_step, step, on_partial,
+                           TRACER.current())
+        self._pending[inquiry_id] = pending
+        future.add_done_callback(lambda f: self._on_done(pending, f))
+        self._schedule_next(pending, loop.time())
+
+    def untrack(self, inquiry_id: str) -> None:
+        """Stops polling an inquiry."""
+        self._pending.pop(inquiry_id, None)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._polls):
+            task.cancel()
+        await asyncio.gather(*self._polls, return_exceptions=True)
+
+    def _on_done(self, pending: _Pending, future: asyncio.Future) -> None:
+        self._pending.pop(pending.inquiry_id, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        duration = future.get_loop().time() - pending.created
+        INQUIRY_POLLS.observe(pending.polls)
+        INQUIRY_SECONDS.observe(duration)
+        self._durations.append(duration)
+        self._new_samples += 1
+        if self._new_samples >= 50 or (self._quantiles is None and len(self._durations) >= 20):
+            ordered = sorted(self._durations)
+            self._quantiles = [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES]
+            self._new_samples = 0
+
+    def _delay(self, pending: _Pending, now: float) -> float:
+        if pending.step is not None:
+            return pending.step * random.uniform(1 - self.jitter, 1 + self.jitter)
+        backoff = self.min_step * self.factor ** pending.attempts
+        delay = backoff
+        if self._quantiles is not None:
+            age = now - pending.created
+            upcoming = [q - age for q in self._quantiles if q > age]
+            # past the tail of the distribution the exponential backoff applies
+            if upcoming:
+                delay = upcoming[0]
+        delay = min(max(delay, pending.min_delay), max(self.max_step, pending.min_delay))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule_next(self, pending: _Pending, now: float) -> None:
+        self._sequence += 1
+        heapq.heappush(self._schedule, (now + self._delay(pending, now), self._sequence, pending.inquiry_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        # started by the first inquiry tracked, but polls for all of them
+        TRACER.detach()
+        loop = asyncio.get_running_loop()
+        while True:
+            # while all slots are taken, the inquiries falling due meanwhile are polled together
+            await self._poll_slots.acquire()
+            now = loop.time()
+            due: List[_Pending] = []
+            while self._schedule and self._schedule[0][0] <= now:
+                _, _, inquiry_id = heapq.heappop(self._schedule)
+                pending = self._pending.get(inquiry_id)
+                if pending is not None and not pending.future.done():
+                    due.append(pending)
+
+            if not due:
+                self._poll_slots.release()
+                # skip entries of inquiries that are no longer pending
+                while self._schedule and self._schedule[0][2] not in self._pending:
+                    heapq.heappop(self._schedule)
+                # sleep until the next poll is due or a new inquiry is tracked
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # the loop goes on firing the polls due meanwhile
+            task = loop.create_task(self._poll(due))
+            self._polls.add(task)
+            task.add_done_callback(self._poll_done)
+
+    def _poll_done(self, task: asyncio.Task) -> None:
+        self._polls.discard(task)
+        self._poll_slots.release()
+
+    def _start_poll_span(self, pending: _Pending, **attributes: Any) -> Span:
+        return TRACER.start_span("inquiry.poll", parent=pending.span, inquiry_id=pending.inquiry_id,
+                                 attempt=pending.polls + 1, **attributes)
+
+    async def _get(self, pending: _Pending) -> Dict[str, Any]:
+        span = self._start_poll_span(pending)
+        try:
+            inquiry = await self.client.get_inquiry(pending.inquiry_id)
+        except Exception as excp:
+            span.end(excp)
+            raise
+        span.set(status=inquiry.get('status'))
+        span.end()
+        return inquiry
+
+    async def _poll(self, due: List[_Pending]) -> None:
+        ids = [pending.inquiry_id for pending in due]
+        inquiries: Dict[str, Dict[str, Any]] = {}
+        try:
+            if self.batch_size:
+                for start in range(0, len(ids), self.batch_size):
+                    batch = due[start:start + self.batch_size]
+                    self.stats["requests"] += 1
+                    # one request polls every inquiry of the batch, it is a span of each of their traces
+                    spans = [self._start_poll_span(pending, batch=len(batch)) for pending in batch]
+                    try:
+                        found = await self.client.get_inquiries([pending.inquiry_id for pending in batch])
+                    except Exception as excp:
+                        for span in spans:
+                            span.end(excp)
+                        raise
+                    for span in spans:
+                        span.end()
+                    if found is None:
+                        self.logger.warning("Batch inquiry lookups are not supported, polling one by one")
+                        self.batch_size = 0
+                        break
+                    inquiries.update((inquiry['id'], inquiry) for inquiry in found)
+            if not self.batch_size:
+                missing = [pending for pending in due if pending.inquiry_id not in inquiries]
+                self.stats["requests"] += len(missing)
+                results = await asyncio.gather(*(self._get(pending) for pending in missing), return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        self.stats["errors"] += 1
+                        self.logger.warning("Failed to poll inquiry: %s", result)
+                    else:
+                        inquiries[result['id']] = result
+        except Exception as excp:  # pylint: disable=W0703
+            self.stats["errors"] += 1
+            self.logger.warning("Failed to poll inquiries: %s", excp)
+
+        self.stats["lookups"] += len(ids)
+        now = asyncio.get_running_loop().time()
+        for pending in due:
+            pending.polls += 1
+            inquiry = inquiries.get(pending.inquiry_id)
+            if pending.future.done():
+                continue
+            if inquiry is not None and inquiry['status'] in FINAL_STATUSES:
+                self.stats["resolved"] += 1
+                pending.future.set_result(inquiry)
+            elif pending.inquiry_id in self._pending:
+                if inquiry is not None and inquiry.get('result') and pending.on_partial is not None:
+                    try:
+                        pending.on_partial(inquiry)
+                    except Exception as excp:  # pylint: disable=W0703
+                        self.logger.warning("Failed to handle a partial result: %s", excp)
+                pending.attempts += 1
+                self._schedule_next(pending, now)
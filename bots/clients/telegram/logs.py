@@ -0,0 +1,201 @@
+"""This module contains the JsonFormatter class writing log records as JSON lines, the
+SamplingFilter keeping a share of the chatty per-message lines and the QueueLogging class
+writing the log lines from a background thread, so that the event loop never waits for stdout.
+"""
+
+import json
+import logging
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# attributes every LogRecord has, the others were passed as ``extra`` or added by a filter
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object with ``level``, ``time`` (milliseconds since the
+    epoch the record was created at), ``msg`` and ``name``, followed by the ``extra`` fields of
+    the record, e.g. the ids added by :class:`clients.telegram.tracing.TraceContextFilter`, the
+    traceback as ``exc_info`` and the ``static_fields``. Serialized with orjson if it is installed.
+
+    Args:
+        static_fields (:obj:`dict`, optional): Fields added to every line, e.g. ``{"app": "bots"}``.
+    """
+
+    def __init__(self, static_fields: Optional[Dict[str, Any]] = None) -> None:
+        super().__init__()
+        self.static_fields = static_fields or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            "level": record.levelname,
+            "time": int(record.created * 1000),
+            "msg": record.getMessage(),
+            "name": record.name,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                fields[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            fields["exc_info"] = record.exc_text
+        if record.stack_info:
+            fields["stack_info"] = self.formatStack(record.stack_info)
+        fields.update(self.static_fields)
+        return _dumps(fields)
+
+
+def _dumps(fields: Dict[str, Any]) -> str:
+    """Encodes a log line, using orjson if it is installed, values json can't encode are written as strings."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(fields, default=str).decode()
+        except TypeError:
+            # e.g. integers past 64 bits, the json module handles them
+            pass
+    return json.dumps(fields, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of the records of some loggers, e.g. ``{"clients.telegram.outbound": 0.1}``
+    keeps about every tenth line of the outbound logger and of its children. Only lines below
+    ``min_level`` are sampled, warnings and errors are always kept.
+
+    Args:
+        rates (:obj:`dict`): Share of the records kept, between ``0`` and ``1``, by logger name.
+        min_level (:obj:`int`, optional): Level from which on every record is kept.
+    """
+
+    def __init__(self, rates: Dict[str, float], min_level: int = logging.WARNING) -> None:
+        super().__init__()
+        self.rates = dict(rates)
+        self.min_level = min_level
+        # rate by logger name, including the loggers inheriting the rate of a parent
+        self._resolved: Dict[str, float] = {}
+        self.stats = {"kept": 0, "dropped": 0}
+
+    @classmethod
+    def parse(cls, spec: str, **kwargs: Any) -> "SamplingFilter":
+        """
+        Creates the filter from comma separated ``logger=rate`` pairs
+        :param spec: E.g. ``clients.telegram.commands=0.1,clients.telegram.tracing=0.01``
+        :return: SamplingFilter object
+        """
+        rates = {}
+        for pair in spec.split(","):
+            if pair.strip():
+                name, rate = pair.split("=", 1)
+                rates[name.strip()] = float(rate)
+        return cls(rates, **kwargs)
+
+    def rate(self, name: str) -> float:
+        """Returns the share of the records of a logger that is kept."""
+        rate = self._resolved.get(name)
+        if rate is None:
+            parent = name
+            while parent not in self.rates and "." in parent:
+                parent = parent.rsplit(".", 1)[0]
+            rate = self._resolved[name] = self.rates.get(parent, 1.0)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.min_level:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1.0:
+            return True
+        if random.random() < rate:
+            self.stats["kept"] += 1
+            return True
+        self.stats["dropped"] += 1
+        return False
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Queues records, dropping them when the queue is full instead of blocking."""
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the arguments may change once the call returned, the JSON is written on the listener's thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # waits for room in a full queue, the records before it are written
+        self.queue.put(self._sentinel)
+
+
+class QueueLogging:
+    """Writes log lines from a background thread: a :class:`logging.handlers.QueueHandler` on the
+    root logger queues the records and a :class:`logging.handlers.QueueListener` formats and
+    writes them with ``handlers``. The ``filters`` run on the logging thread, where the context of
+    the record is known, e.g. the current span. When ``max_queue`` records are waiting, further
+    records are dropped rather than block the event loop.
+
+    Args:
+        handlers (Iterable[:class:`logging.Handler`]): Handlers writing the records.
+        filters (Iterable[:class:`logging.Filter`], optional): Filters applied before a record is queued.
+        max_queue (:obj:`int`, optional): Records waiting at most, ``0`` writes them right away
+            from the logging thread instead.
+    """
+
+    def __init__(self, handlers: Iterable[logging.Handler], filters: Iterable[logging.Filter] = (),
+                 max_queue: int = 10000) -> None:
+        self.handlers: List[logging.Handler] = list(handlers)
+        self.queue: Optional["queue.Queue[logging.LogRecord]"] = None
+        self.listener: Optional[QueueListener] = None
+        self._handler: Optional[_DroppingQueueHandler] = None
+        if max_queue:
+            self.queue = queue.Queue(max_queue)
+            self._handler = _DroppingQueueHandler(self.queue)
+            self.listener = _Listener(self.queue, *self.handlers, respect_handler_level=True)
+        for handler in [self._handler] if self._handler is not None else self.handlers:
+            for log_filter in filters:
+                handler.addFilter(log_filter)
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self, level: int = logging.INFO) -> None:
+        """Makes the queue the only handler of the root logger and starts writing."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        logging.basicConfig(level=level, handlers=[self._handler] if self._handler else self.handlers, force=True)
+        if self.listener is not None:
+            self.listener.start()
+
+    def stop(self) -> None:
+        """Writes the queued records and stops the background thread."""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        if self.listener is not None:
+            self.listener.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        if self.queue is None:
+            return {"queued": 0, "dropped": 0}
+        return {"queued": self.queue.qsize(), "dropped": self._handler.dropped}
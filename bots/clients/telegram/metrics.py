@@ -0,0 +1,301 @@
+"""This module contains a small Prometheus metrics registry, the counters, gauges and histograms it
+holds, and the ``/metrics`` endpoint rendering them in the text exposition format.
+
+Metrics are created once at import time on the shared :data:`REGISTRY`, like with the official
+client, and updated from the code paths they measure. The ``stats()`` of the bot's components
+are exported as they are with :meth:`MetricsRegistry.add_stats`.
+"""
+
+import bisect
+import contextlib
+import functools
+import math
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from clients.telegram.http_server import HttpRequest, HttpResponse, HttpServer
+
+# seconds, from a fast Bot API call to a slow inquiry
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Sample = Tuple[str, Dict[str, str], float]
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class _Metric:
+    """Base class of the metric kinds, one child per combination of label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        # children may be created from several threads
+        self._lock = threading.Lock()
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, *values: Any) -> Any:
+        """
+        Returns the child of the metric with the given label values
+        :param values: One value per label name, in order
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _unlabeled(self) -> Any:
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels, use labels() first")
+        return self.labels()
+
+    def samples(self) -> Iterator[Sample]:
+        for key, child in list(self._children.items()):
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, dict(zip(self.labelnames, key), **extra), value
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        yield "_total", {}, self.value
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. requests sent. ``name`` must not end in ``_total``,
+    which is added when the counter is rendered."""
+
+    kind = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._unlabeled().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        yield "", {}, self.value
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. inquiries in flight."""
+
+    kind = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self._unlabeled().set(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._unlabeled().dec(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        """Observes the seconds the block took, also if it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        cumulative = 0
+        for bound, count in zip(list(self.bounds) + [math.inf], self.counts):
+            cumulative += count
+            yield "_bucket", {"le": _format_value(bound)}, cumulative
+        yield "_sum", {}, self.sum
+        yield "_count", {}, self.count
+
+
+class Histogram(_Metric):
+    """Observations counted into buckets, e.g. request latencies.
+
+    Args:
+        name (:obj:`str`): Name of the metric.
+        documentation (:obj:`str`): Help text of the metric.
+        labelnames (Sequence[:obj:`str`], optional): Names of the labels.
+        buckets (Sequence[:obj:`float`], optional): Upper bounds of the buckets, ``+Inf`` is added.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._unlabeled().observe(value)
+
+    def time(self) -> Any:
+        return self._unlabeled().time()
+
+
+def timed(histogram: Histogram, *labels: Any, errors: Optional[Counter] = None) -> Callable[[F], F]:
+    """
+    Decorates a coroutine function to observe how long its calls take
+    :param histogram: Histogram to observe the seconds in
+    :param labels: Label values of the histogram and of ``errors``
+    :param errors: Counter of the calls that raised
+    """
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.labels(*labels).inc()
+                raise
+            finally:
+                histogram.labels(*labels).observe(time.perf_counter() - start)
+        return wrapper  # type: ignore[return-value]
+    return decorator
+
+
+class MetricsRegistry:
+    """Holds the metrics of the process and renders them for Prometheus to scrape.
+
+    Besides the metrics created with :meth:`counter`, :meth:`gauge` and :meth:`histogram`,
+    every numeric value of the dicts returned by the callbacks added with :meth:`add_stats` is
+    rendered as an untyped metric when the registry is scraped.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._stats: List[Tuple[str, str, Callable[[], Dict[str, Any]]]] = []
+
+    def _register(self, metric: _Metric) -> Any:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f"Metric {metric.name} is registered already with other labels or kind")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_stats(self, prefix: str, documentation: str, callback: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Exports the numeric values of a stats dict as ``<prefix>_<key>``
+        :param prefix: Prefix of the metric names
+        :param documentation: Help text of the metrics, followed by the key
+        :param callback: Returns the stats when scraped, e.g. a component's ``stats`` method
+        """
+        self._stats.append((prefix, documentation, callback))
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            name = metric.name + ("_total" if metric.kind == "counter" else "")
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for sample_name, labels, value in metric.samples():
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+
+        for prefix, documentation, callback in self._stats:
+            try:
+                stats = callback()
+            except Exception:  # pylint: disable=W0703
+                continue
+            for key, value in stats.items():
+                # bools are ints, which is fine, None and strings are not exported
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {documentation}: {key}")
+                lines.append(f"# TYPE {name} untyped")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def handle_metrics(self, request: HttpRequest) -> HttpResponse:
+        return 200, self.render()
+
+    def attach(self, server: HttpServer, path: str = "/metrics") -> None:
+        """Registers the metrics route on a :class:`HttpServer`."""
+        server.route("GET", path, self.handle_metrics)
+
+
+# metrics of this process
+REGISTRY = MetricsRegistry()
@@ -19,28 +19,43 @@
 """This module contains MysqlPersistence class, based on schema defined in /web/prisma/schema.prisma."""
 
 
-import json
-import logging
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from typing import Any, Dict, List, Optional
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.sql import text
-from telegram.ext import DictPersistence
 
-CDCData = Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]
+from clients.telegram.persistence import DATA_KINDS, IncrementalPersistence, _dumps, _loads, _with_int_keys
 
+# rows fetched per round trip while streaming the normalized table at startup
+LOAD_BATCH_SIZE = 10000
 
-class MySQLPersistence(DictPersistence):
+
+class MySQLPersistence(IncrementalPersistence):
     """Using MySQL database to make user/chat/bot data persistent across reboots.
 
     Args:
         url (:obj:`str`, Optional) the mysql database url.
         session (:obj:`scoped_session`, Optional): sqlalchemy scoped session.
-        on_flush (:obj:`bool`, optional): if set to :obj:`True` :class:`MySQLPersistence`
-            will only update bot/chat/user data when :meth:flush is called.
-        **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to
-            the DictPersistence constructor.
+        normalized (:obj:`bool`, optional): if set to :obj:`True` data is stored in the
+            ``PersistenceEntry`` table with one row per chat/user id (plus one row for bot data,
+            callback data and each conversation handler) and only changed rows are written.
+            On first start the legacy ``Persistence`` row is migrated into it.
+        lazy (:obj:`bool`, optional): if set to :obj:`True` chat and user data are not loaded
+            at startup but per key, the first time an update for the chat or user is handled.
+            Requires ``normalized``.
+        pool_size (:obj:`int`, optional): connections kept open by the engine created from ``url``.
+        max_overflow (:obj:`int`, optional): connections opened on top of ``pool_size`` under load.
+        pool_recycle (:obj:`int`, optional): seconds after which a connection is replaced, keep
+            it below MySQL's ``wait_timeout``.
+        pool_pre_ping (:obj:`bool`, optional): test connections before using them, so
+            connections closed by the server are replaced instead of failing the write.
+        pool_timeout (:obj:`float`, optional): seconds to wait for a free connection.
+        **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to the
+            :class:`clients.telegram.persistence.IncrementalPersistence` constructor, e.g.
+            ``on_flush``, ``flush_interval`` or ``max_retries``.
 
     Attributes:
         store_data (:class:`PersistenceInput`): Specifies which kinds of data will be saved by this
@@ -51,14 +66,28 @@ class MySQLPersistence(DictPersistence):
         self,
         url: str = None,
         session: scoped_session = None,
-        on_flush: bool = False,
+        normalized: bool = False,
+        lazy: bool = False,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_recycle: int = 3600,
+        pool_pre_ping: bool = True,
+        pool_timeout: float = 30,
         **kwargs: Any,
     ) -> None:
 
+        if lazy and not normalized:
+            raise TypeError("lazy loading is only supported with normalized storage.")
+
         if url:
-            if not url.startswith("mysql://"):
-                raise TypeError(f"{url} isn't a valid MySQL database URL.")
-            engine = create_engine(url)
+            engine = self._create_engine(
+                url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=pool_pre_ping,
+                pool_timeout=pool_timeout,
+            )
             self._session = scoped_session(
                 sessionmaker(bind=engine, autoflush=False))
 
@@ -71,82 +100,120 @@ class MySQLPersistence(DictPersistence):
         else:
             raise TypeError("You must need to provide either url or session.")
 
-        self.logger = logging.getLogger(__name__)
+        self._pool_wait = {"last_pool_wait_seconds": 0.0, "pool_wait_seconds_total": 0.0}
+        super().__init__(normalized=normalized, lazy=lazy, **kwargs)
 
-        self.on_flush = on_flush
-        self.__init_database()
-        try:
-            self.logger.info("Loading database....")
-
-            # chat data
-            chat_data_ = self._session.execute(
-                text("SELECT chat_data FROM Persistence")).first()
-            chat_data = chat_data_[0] if chat_data_ is not None else {}
-            chat_data_json = json.loads(chat_data) if chat_data else {}
-
-            # user data
-            user_data_ = self._session.execute(
-                text("SELECT user_data FROM Persistence")).first()
-            user_data = user_data_[0] if user_data_ is not None else {}
-            user_data_json = json.loads(user_data) if user_data else {}
-
-            # bot data
-            bot_data_ = self._session.execute(
-                text("SELECT bot_data FROM Persistence")).first()
-            bot_data = bot_data_[0] if bot_data_ is not None else {}
-            bot_data_json = json.loads(bot_data) if bot_data else {}
-
-            # conversations data
-            # converstations is always "null" in the database
-            conversations_data_ = self._session.execute(
-                text("SELECT conversations FROM Persistence")).first()
-            conversations_data = conversations_data_[
-                0] if conversations_data_ is not None else {}
-            conversations_json_data = {}
-
-            # callback data
-            callback_data_ = self._session.execute(
-                text("SELECT callback_data FROM Persistence")).first()
-            callback_data = callback_data_[
-                0] if callback_data_ is not None else {}
-            callback_data_json = json.loads(
-                callback_data) if callback_data else {}
-
-            self.logger.info("Database loaded successfully!")
-
-            # if it is a fresh setup we'll add some placeholder data so we
-            # can perform `UPDATE` operations on it, cause SQL only allows
-            # `UPDATE` operations if column have some data already present inside it.
-            if not chat_data:
-                insert_qry = "INSERT INTO Persistence (chat_data) VALUES ('{}')"
-                self._session.execute(text(insert_qry))
-            if not user_data:
-                insert_qry = "INSERT INTO Persistence (user_data) VALUES ('{}')"
-                self._session.execute(text(insert_qry))
-            if not bot_data:
-                insert_qry = "INSERT INTO Persistence (bot_data) VALUES ('{}')"
-                self._session.execute(text(insert_qry))
-            if not conversations_data:
-                insert_qry = "INSERT INTO Persistence (conversations) VALUES ('{}')"
-                self._session.execute(text(insert_qry))
-            if not callback_data:
-                insert_qry = "INSERT INTO Persistence (callback_data) VALUES ('{}')"
-                self._session.execute(text(insert_qry))
+    def _create_engine(self, url: str, **pool_options: Any) -> Engine:
+        if not url.startswith("mysql://"):
+            raise TypeError(f"{url} isn't a valid MySQL database URL.")
+        return create_engine(url, **pool_options)
 
-            self._session.commit()
-
-            super().__init__(
-                **kwargs,
-                chat_data_json=chat_data_json,
-                user_data_json=user_data_json,
-                bot_data_json=bot_data_json,
-                callback_data_json=callback_data_json,
-                conversations_json=conversations_json_data,
-            )
+    def _load(self) -> Dict[str, Any]:
+        self._init_database()
+        try:
+            if self.normalized:
+                return self._load_entries()
+            return self._load_legacy()
         finally:
             self._session.close()
 
-    def __init_database(self) -> None:
+    def _load_legacy(self) -> Dict[str, Any]:
+        """Loads the json blobs of the single-row ``Persistence`` table.
+
+        Returns:
+            :obj:`dict`: decoded ``chat_data`` and ``user_data`` and the json of the other kinds.
+        """
+        row = self._session.execute(
+            text(f"SELECT {', '.join(DATA_KINDS)} FROM Persistence")).first()
+        values = dict(zip(DATA_KINDS, row)) if row is not None else dict.fromkeys(DATA_KINDS)
+        del row
+
+        # if it is a fresh setup we'll add some placeholder data so we
+        # can perform `UPDATE` operations on it, cause SQL only allows
+        # `UPDATE` operations if column have some data already present inside it.
+        for kind in DATA_KINDS:
+            if not values[kind]:
+                insert_qry = f"INSERT INTO Persistence ({kind}) VALUES ('{{}}')"
+                self._session.execute(text(insert_qry))
+
+        self._session.commit()
+
+        return self._decode_legacy(values)
+
+    def _decode_legacy(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Decodes the legacy columns, dropping each raw blob from ``values`` once it is decoded
+        to keep the peak memory down."""
+        data = {}
+        for kind in ("chat_data", "user_data"):
+            value = self._stored_value(values.pop(kind))
+            data[kind] = {int(key): _with_int_keys(value.pop(key)) for key in list(value)} if value else None
+            del value
+        for kind in ("bot_data", "callback_data"):
+            value = self._stored_value(values.pop(kind))
+            data[kind] = _dumps(value) if value else ""
+        # converstations are not restored
+        data["conversations"] = ""
+        return data
+
+    @staticmethod
+    def _stored_value(value: Any) -> Any:
+        """Decodes a legacy column, :obj:`None` if it only holds a placeholder."""
+        decoded = _loads(value) if value else None
+        # the blobs are written as json encoded strings
+        if isinstance(decoded, str):
+            decoded = _loads(decoded)
+        return decoded or None
+
+    def _load_entries(self) -> Dict[str, Any]:
+        """Streams the rows of the normalized ``PersistenceEntry`` table, migrating the legacy
+        ``Persistence`` row into it if the table is still empty. In lazy mode chat and user
+        rows are skipped.
+
+        Returns:
+            :obj:`dict`: decoded ``chat_data`` and ``user_data`` and the json of the other kinds.
+        """
+        if self.lazy:
+            if self._session.execute(text("SELECT 1 FROM PersistenceEntry LIMIT 1")).first() is None:
+                return self._migrate_legacy()
+            query = "SELECT kind, id, data FROM PersistenceEntry WHERE kind NOT IN ('chat_data', 'user_data')"
+        else:
+            query = "SELECT kind, id, data FROM PersistenceEntry"
+
+        rows = self._session.execute(text(query), execution_options={"yield_per": LOAD_BATCH_SIZE})
+
+        data = self._decode_entries(rows)
+        if data is None:
+            if self.lazy:
+                return {"chat_data": {}, "user_data": {}, "bot_data": "",
+                        "callback_data": "", "conversations": ""}
+            return self._migrate_legacy()
+        return data
+
+    def _migrate_legacy(self) -> Dict[str, Any]:
+        """Copies the legacy ``Persistence`` row into ``PersistenceEntry``, one row per key.
+        The legacy row is left untouched so it is possible to switch back."""
+        row = self._session.execute(
+            text(f"SELECT {', '.join(DATA_KINDS)} FROM Persistence")).first()
+        values = dict(zip(DATA_KINDS, row)) if row is not None else dict.fromkeys(DATA_KINDS)
+        del row
+        data = self._decode_legacy(values)
+
+        entries = []
+        for kind in ("chat_data", "user_data"):
+            for key, value in (data[kind] or {}).items():
+                entries.append({"kind": kind, "id": str(key), "data": _dumps(value)})
+        for kind in ("bot_data", "callback_data"):
+            if data[kind]:
+                entries.append({"kind": kind, "id": "", "data": data[kind]})
+
+        if entries:
+            self.logger.info(
+                "Migrating %s entries from the legacy Persistence table", len(entries))
+            self._session.execute(text(self._upsert_query()), entries)
+        self._session.commit()
+        return data
+
+    def _init_database(self) -> None:
         """
         creates table for storing the data if table
         doesn't exist already inside database.
@@ -166,115 +233,84 @@ class MySQLPersistence(DictPersistence):
         # self._session.execute(text(create_table_qry))
         # self._session.commit()
 
-    def _dump_into_json(self) -> Any:
-        """Dumps data into json format for inserting in db."""
+        # normalized storage, see PersistenceEntry in /web/prisma/schema.prisma
+        # create_entry_table_qry = """
+        #         CREATE TABLE PersistenceEntry (
+        #         kind varchar(32) NOT NULL,
+        #         id varchar(191) NOT NULL,
+        #         data json NOT NULL,
+        #         PRIMARY KEY (kind, id)
+        #     );"""
+
+    def _upsert_query(self) -> str:
+        """Returns the statement inserting or replacing one ``PersistenceEntry`` row."""
+        if self._session.get_bind().dialect.name == "mysql":
+            return ("INSERT INTO PersistenceEntry (kind, id, data) VALUES (:kind, :id, :data) "
+                    "ON DUPLICATE KEY UPDATE data = VALUES(data)")
+        return ("INSERT INTO PersistenceEntry (kind, id, data) VALUES (:kind, :id, :data) "
+                "ON CONFLICT (kind, id) DO UPDATE SET data = excluded.data")
 
-        to_dump = {
-            "chat_data": self.chat_data_json,
-            "user_data": self.user_data_json,
-            "bot_data": self.bot_data_json,
-            "conversations": self.conversations_json,
-            "callback_data": self.callback_data_json,
-        }
-        self.logger.debug("Dumping %s", to_dump)
-        return json.dumps(to_dump)
+    def _write_changes(self, upserts: List[Dict[str, str]], deletes: List[Dict[str, str]]) -> bool:
+        """Writes collected changes to the database. Blocking, runs in the writer thread.
+
+        Returns:
+            :obj:`bool`: Whether the changes were committed.
+        """
+        if not upserts and not deletes:
+            return True
 
-    def _update_database(self) -> None:
         self.logger.debug("Updating database...")
         try:
-            # update chat data
-            insert_qry = "UPDATE Persistence SET chat_data = :jsondata"
-            params = {"jsondata": json.dumps(self.chat_data_json)}
-            self._session.execute(text(insert_qry), params)
-
-            # update user data
-            insert_qry = "UPDATE Persistence SET user_data = :jsondata"
-            params = {"jsondata": json.dumps(self.user_data_json)}
-            self._session.execute(text(insert_qry), params)
-
-            # update bot data
-            insert_qry = "UPDATE Persistence SET bot_data = :jsondata"
-            params = {"jsondata": json.dumps(self.bot_data_json)}
-            self._session.execute(text(insert_qry), params)
-
-            # update conversations data
-            insert_qry = "UPDATE Persistence SET conversations = :jsondata"
-            params = {"jsondata": json.dumps(self.conversations_json)}
-            self._session.execute(text(insert_qry), params)
-
-            # update callback data
-            insert_qry = "UPDATE Persistence SET callback_data = :jsondata"
-            params = {"jsondata": json.dumps(self.callback_data_json)}
-            self._session.execute(text(insert_qry), params)
+            # checks out (and pre-pings) the connection, which waits if the pool is exhausted
+            start = time.perf_counter()
+            self._session.connection()
+            wait = time.perf_counter() - start
+            self._pool_wait["last_pool_wait_seconds"] = wait
+            self._pool_wait["pool_wait_seconds_total"] += wait
+
+            if not self.normalized:
+                for upsert in upserts:
+                    insert_qry = f"UPDATE Persistence SET {upsert['kind']} = :jsondata"
+                    self._session.execute(text(insert_qry), {"jsondata": upsert["data"]})
+            else:
+                if upserts:
+                    self._session.execute(text(self._upsert_query()), upserts)
+                if deletes:
+                    self._session.execute(
+                        text("DELETE FROM PersistenceEntry WHERE kind = :kind AND id = :id"), deletes)
 
             self._session.commit()
+            return True
         except Exception as excp:  # pylint: disable=W0703
             self._session.close()
-            self.logger.error(
+            self._last_error = repr(excp)
+            self.logger.warning(
                 "Failed to save data in the database.\nLogging exception: ",
                 exc_info=excp,
             )
+            return False
 
-    async def update_conversation(
-        self, name: str, key: Tuple[int, ...], new_state: Optional[object]
-    ) -> None:
-        """Will update the conversations for the given handler.
-
-        Args:
-            name (:obj:`str`): The handler's name.
-            key (:obj:`tuple`): The key the state is changed for.
-            new_state (:obj:`tuple` | :obj:`any`): The new state for the given key.
-        """
-        await super().update_conversation(name, key, new_state)
-        if not self.on_flush:
-            await self.flush()
-
-    async def update_user_data(self, user_id: int, data: Dict) -> None:
-        """Will update the user_data (if changed).
-        Args:
-            user_id (:obj:`int`): The user the data might have been changed for.
-            data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.user_data` ``[user_id]``.
-        """
-        await super().update_user_data(user_id, data)
-        if not self.on_flush:
-            await self.flush()
-
-    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
-        """Will update the chat_data (if changed).
-        Args:
-            chat_id (:obj:`int`): The chat the data might have been changed for.
-            data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.chat_data` ``[chat_id]``.
-        """
-        await super().update_chat_data(chat_id, data)
-        if not self.on_flush:
-            await self.flush()
-
-    async def update_bot_data(self, data: Dict) -> None:
-        """Will update the bot_data (if changed).
-        Args:
-            data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.bot_data`.
-        """
-        await super().update_bot_data(data)
-        if not self.on_flush:
-            await self.flush()
-
-    async def update_callback_data(self, data: CDCData) -> None:
-        """Will update the callback_data (if changed).
-
-        Args:
-            data (Tuple[List[Tuple[:obj:`str`, :obj:`float`, Dict[:obj:`str`, :class:`object`]]], \
-                Dict[:obj:`str`, :obj:`str`]]): The relevant data to restore
-                :class:`telegram.ext.CallbackDataCache`.
-        """
-        await super().update_callback_data(data)
-        if not self.on_flush:
-            await self.flush()
-
-    async def flush(self) -> None:
-        """Will be called by :class:`telegram.ext.Updater` upon receiving a stop signal. Gives the
-        Persistence a chance to finish up saving or close a database connection gracefully.
-        """
-        self._update_database()
-        if not self.on_flush:
-            pass
-            # self.logger.info("Closing database...")
+    def _read_entry(self, kind: str, key: int) -> Optional[Dict[Any, Any]]:
+        """Reads and decodes one chat or user row. Blocking, runs in the writer thread so it
+        sees all writes queued before it."""
+        try:
+            row = self._session.execute(
+                text("SELECT data FROM PersistenceEntry WHERE kind = :kind AND id = :id"),
+                {"kind": kind, "id": str(key)}).first()
+            self._session.commit()
+        except Exception:
+            self._session.close()
+            raise
+        return None if row is None else _with_int_keys(_loads(row[0]))
+
+    def _backend_stats(self) -> Dict[str, Any]:
+        pool = self._session.get_bind().pool
+        stats = {}
+        # not every pool implementation keeps these counters, e.g. SQLite's
+        for name in ("size", "checkedout", "overflow", "checkedin"):
+            counter = getattr(pool, name, None)
+            if counter is not None:
+                stats[f"pool_{name}"] = counter()
+        # time spent checking out a connection
+        stats.update(self._pool_wait)
+        return stats
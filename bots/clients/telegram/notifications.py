@@ -0,0 +1,116 @@
+"""This module contains the InquiryNotifier class, which resolves pending inquiries from
+completion notifications pushed by the inquiry pipeline."""
+
+import asyncio
+import hmac
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from clients.telegram.http_server import HttpRequest, HttpResponse, HttpServer
+
+FINAL_STATUSES = ('COMPLETED', 'FAILED')
+
+
+class InquiryNotifier:
+    """Registry of pending inquiry futures keyed by inquiry id.
+
+    The inquiry pipeline ``POST``s ``{"data": <inquiry>}`` to ``/inquiries/<id>`` once the
+    inquiry reached a final status, which resolves the matching future. Notifications that
+    arrive before the bot registered the inquiry are kept for ``unclaimed_ttl`` seconds, at most
+    ``max_unclaimed`` of them, the oldest are dropped first.
+
+    Args:
+        secret (:obj:`str`, optional): Expected value of the ``x-notify-secret`` header.
+        unclaimed_ttl (:obj:`float`, optional): Seconds to keep notifications nobody waits for.
+        max_unclaimed (:obj:`int`, optional): Notifications nobody waits for kept at most.
+    """
+
+    def __init__(self, secret: Optional[str] = None, unclaimed_ttl: float = 60, max_unclaimed: int = 1000) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.secret = secret
+        self.unclaimed_ttl = unclaimed_ttl
+        self.max_unclaimed = max_unclaimed
+        self._pending: Dict[str, asyncio.Future] = {}
+        # in order of arrival, so the oldest notifications come first
+        self._unclaimed: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self.stats = {"notifications": 0, "unclaimed": 0, "unclaimed_dropped": 0, "rejected": 0}
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def attach(self, server: HttpServer) -> None:
+        """Registers the notification route on a :class:`HttpServer`."""
+        server.route("POST", "/inquiries/", self.handle_notification)
+
+    def register(self, inquiry_id: str) -> asyncio.Future:
+        """
+        Returns a future resolved with the inquiry once its completion is notified
+        :param inquiry_id: Id of the inquiry
+        """
+        future = self._pending.get(inquiry_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[inquiry_id] = future
+
+        unclaimed = self._unclaimed.pop(inquiry_id, None)
+        if unclaimed is not None and not future.done():
+            future.set_result(unclaimed[1])
+        return future
+
+    def discard(self, inquiry_id: str) -> None:
+        """Stops waiting for an inquiry, e.g. after it was resolved by polling."""
+        future = self._pending.pop(inquiry_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    def resolve(self, inquiry: Dict[str, Any]) -> bool:
+        """
+        Resolves the future waiting for an inquiry
+        :param inquiry: The inquiry as returned by the Inquire API
+        :return: Whether a handler was waiting for the inquiry
+        """
+        future = self._pending.pop(inquiry['id'], None)
+        if future is None:
+            self._expire_unclaimed()
+            while self._unclaimed and len(self._unclaimed) >= self.max_unclaimed:
+                del self._unclaimed[next(iter(self._unclaimed))]
+                self.stats["unclaimed_dropped"] += 1
+            # a repeated notification moves to the end
+            self._unclaimed.pop(inquiry['id'], None)
+            if self.max_unclaimed > 0:
+                self._unclaimed[inquiry['id']] = (time.monotonic(), inquiry)
+            self.stats["unclaimed"] += 1
+            return False
+        if not future.done():
+            future.set_result(inquiry)
+        return True
+
+    def _expire_unclaimed(self) -> None:
+        deadline = time.monotonic() - self.unclaimed_ttl
+        while self._unclaimed:
+            inquiry_id = next(iter(self._unclaimed))
+            if self._unclaimed[inquiry_id][0] >= deadline:
+                break
+            del self._unclaimed[inquiry_id]
+
+    async def handle_notification(self, request: HttpRequest) -> HttpResponse:
+        if self.secret and not hmac.compare_digest(request.headers.get("x-notify-secret", ""), self.secret):
+            self.stats["rejected"] += 1
+            return 401, {"code": "UNAUTHORIZED", "message": "Invalid notification secret"}
+
+        try:
+            inquiry = request.json()['data']
+            inquiry_id = inquiry['id']
+        except (ValueError, KeyError, TypeError):
+            return 400, {"code": "BAD_REQUEST", "message": "Expected a body of the form {\"data\": <inquiry>}"}
+
+        if inquiry.get('status') not in FINAL_STATUSES:
+            return 202, {"data": {"id": inquiry_id, "waiting": inquiry_id in self._pending}}
+
+        self.stats["notifications"] += 1
+        waiting = self.resolve(inquiry)
+        self.logger.debug("Inquiry %s notified, waiting: %s", inquiry_id, waiting)
+        return 200, {"data": {"id": inquiry_id, "waiting": waiting}}
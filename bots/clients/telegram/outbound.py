@@ -0,0 +1,206 @@
+"""This module contains the Outbound class sending replies, and the Markdown aware message splitting it uses."""
+
+import asyncio
+import bisect
+import logging
+import re
+import statistics
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from telegram import Message, Update
+
+from clients.telegram.tracing import TRACER
+
+# Telegram rejects messages longer than this
+MAX_TEXT_LENGTH = 4096
+
+# entities of Telegram's legacy Markdown, they can't be nested. ``[`` starts a link, which can't
+# be closed and reopened around a split
+_ENTITY = re.compile(r"\\.|```|[`*_\[]")
+_CLOSING = {"```": "```", "`": "`", "*": "*", "_": "_", "[": ")"}
+# a code block continued in the next message starts on its own line
+_REOPENING = {"```": "```\n", "`": "`", "*": "*", "_": "_"}
+
+
+def _entity_changes(text: str) -> Tuple[List[int], List[Optional[str]]]:
+    """Scans the text once and returns the positions where the open entity changes and the
+    entity open from each of them on, :obj:`None` outside of entities."""
+    positions: List[int] = [0]
+    states: List[Optional[str]] = [None]
+    open_entity = None
+    position = 0
+    while True:
+        if open_entity is None:
+            match = _ENTITY.search(text, position)
+            if match is None:
+                break
+            token = match.group()
+            position = match.end()
+            if token.startswith("\\"):
+                continue
+            open_entity = token
+            positions.append(match.start())
+        else:
+            end = text.find(_CLOSING[open_entity], position)
+            if end == -1:
+                break
+            position = end + len(_CLOSING[open_entity])
+            open_entity = None
+            positions.append(position)
+        states.append(open_entity)
+    return positions, states
+
+
+def split_markdown(text: str, limit: int = MAX_TEXT_LENGTH) -> List[str]:
+    """
+    Splits a Markdown text into messages of at most ``limit`` characters in one pass. Messages
+    end at the last line break that fits and is outside of an entity or in a code block. Entities
+    that have to be cut are closed at the end of one message and opened again in the next, links
+    are never cut.
+    :param text: Text to split
+    :param limit: Maximum length of a message
+    :return: The messages
+    """
+    if len(text) <= limit:
+        return [text] if text else []
+
+    positions, states = _entity_changes(text)
+    breaks = [match.start() for match in re.finditer("\n", text)]
+
+    def entity_at(position: int) -> Optional[str]:
+        return states[bisect.bisect_right(positions, position) - 1]
+
+    parts = []
+    start, reopen = 0, ""
+    while len(text) - start + len(reopen) > limit:
+        # room for the reopened entity and for closing the longest one, a code block
+        end = start + limit - len(reopen) - len("```")
+        # the last line break outside of an entity or in a code block, which can be reopened
+        cut = end
+        index = bisect.bisect_right(breaks, end) - 1
+        while index >= 0 and breaks[index] > start:
+            if entity_at(breaks[index]) in (None, "```", "`"):
+                cut = breaks[index]
+                break
+            index -= 1
+        entity = entity_at(cut)
+        if entity == "[":
+            # move the cut in front of the link unless the link fills the whole message
+            link_start = positions[bisect.bisect_right(positions, cut) - 1]
+            if link_start > start:
+                cut, entity = link_start, None
+            else:
+                entity = None
+
+        closing = _CLOSING[entity] if entity is not None else ""
+        parts.append(reopen + text[start:cut] + closing)
+        reopen = _REOPENING[entity] if entity is not None else ""
+        # a line break the message ended at is not repeated
+        start = cut + 1 if cut < len(text) and text[cut] == "\n" else cut
+    if start < len(text):
+        parts.append(reopen + text[start:])
+    return parts
+
+
+class Outbound:
+    """Sends replies to chats. Long texts are split with :func:`split_markdown`, the parts are
+    sent one after another with ``pause`` seconds in between, awaited so that other chats are
+    served meanwhile. Records the time it takes to send a reply per chat.
+
+    Args:
+        bot (:class:`telegram.Bot`): Bot to send with.
+        typing (:class:`clients.telegram.typing_indicator.TypingIndicator`, optional): Shows the
+            typing indicator before a reply, unless it is shown already.
+        pause (:obj:`float`, optional): Seconds between two parts of a reply.
+        chats (:obj:`int`, optional): Number of chats send latencies are kept for.
+        samples (:obj:`int`, optional): Number of recent replies the overall latency is computed from.
+    """
+
+    def __init__(self, bot: Any, typing: Any = None, pause: float = 1.0, chats: int = 10000,
+                 samples: int = 1000) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.bot = bot
+        self.typing = typing
+        self.pause = pause
+        self.chats = chats
+        self._chat_stats: "OrderedDict[int, Dict[str, float]]" = OrderedDict()
+        self._latencies: Deque[float] = deque(maxlen=samples)
+        self.counters = {"replies": 0, "parts": 0, "errors": 0}
+
+    async def reply(self, update: Update, text: str, parse_mode: Optional[str] = "Markdown",
+                    **kwargs: Any) -> Optional[Message]:
+        """
+        Replies to the message of an update, in several messages if the text is too long
+        :param update: Update object
+        :param text: Text to send
+        :param parse_mode: Parse mode of the text
+        :return: The last message sent
+        """
+        parts = split_markdown(text) if parse_mode == "Markdown" else [
+            text[i:i + MAX_TEXT_LENGTH] for i in range(0, len(text), MAX_TEXT_LENGTH)]
+        return await self.reply_parts(update, parts, parse_mode=parse_mode, **kwargs)
+
+    async def reply_parts(self, update: Update, parts: Sequence[str], parse_mode: Optional[str] = "Markdown",
+                          **kwargs: Any) -> Optional[Message]:
+        """
+        Replies to the message of an update with already split messages
+        :param update: Update object
+        :param parts: Messages of at most 4096 characters
+        :param parse_mode: Parse mode of the messages
+        :return: The last message sent
+        """
+        chat_id = update.effective_chat.id
+        start = time.perf_counter()
+        if self.typing is not None:
+            await self.typing.ping(chat_id)
+        else:
+            await self.bot.send_chat_action(chat_id, "typing")
+
+        msg = None
+        try:
+            for i, part in enumerate(parts):
+                if i:
+                    await asyncio.sleep(self.pause)
+                with TRACER.span("message.send", part=i + 1, parts=len(parts), chars=len(part)):
+                    msg = await update.message.reply_text(part, parse_mode=parse_mode, **kwargs)
+                self.counters["parts"] += 1
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        self._record(chat_id, time.perf_counter() - start)
+        self.logger.info("Reply of %s parts sent", len(parts))
+        return msg
+
+    def _record(self, chat_id: int, seconds: float) -> None:
+        self.counters["replies"] += 1
+        self._latencies.append(seconds)
+
+        stats = self._chat_stats.pop(chat_id, None)
+        if stats is None:
+            stats = {"replies": 0, "seconds_total": 0.0, "last_seconds": 0.0, "max_seconds": 0.0}
+        stats["replies"] += 1
+        stats["seconds_total"] += seconds
+        stats["last_seconds"] = seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        self._chat_stats[chat_id] = stats
+        if len(self._chat_stats) > self.chats:
+            self._chat_stats.popitem(last=False)
+
+    def chat_stats(self, chat_id: int) -> Optional[Dict[str, float]]:
+        """Returns the send latency of the replies to a chat, :obj:`None` if nothing was sent to it recently."""
+        stats = self._chat_stats.get(chat_id)
+        if stats is None:
+            return None
+        return dict(stats, mean_seconds=stats["seconds_total"] / stats["replies"])
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+        return dict(
+            self.counters,
+            chats=len(self._chat_stats),
+            p50_seconds=statistics.median(latencies) if latencies else 0.0,
+            p99_seconds=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0,
+        )
@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+#
+# A library containing community-based extension for the python-telegram-bot library
+# Copyright (C) 2020-2022
+# The ptbcontrib developers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Lesser Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+"""This module contains the IncrementalPersistence class, the base of the bot's persistence backends."""
+
+
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from telegram.ext import DictPersistence
+
+from clients.telegram.metrics import REGISTRY
+from clients.telegram.sharding import shard_for
+from clients.telegram.tracing import TRACER
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CDCData = Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]
+
+# columns of the legacy single-row table, also the kinds of rows in the normalized table
+DATA_KINDS = ("chat_data", "user_data", "bot_data", "callback_data", "conversations")
+
+FLUSH_SECONDS = REGISTRY.histogram(
+    "bot_persistence_flush_seconds", "Seconds a flush took to write the changed keys, retries included, by backend",
+    ["backend"])
+BYTES_WRITTEN = REGISTRY.counter(
+    "bot_persistence_written_bytes", "Bytes of serialized data written, by backend", ["backend"])
+ROWS_WRITTEN = REGISTRY.counter("bot_persistence_written_rows", "Rows upserted or deleted, by backend", ["backend"])
+FAILED_FLUSHES = REGISTRY.counter(
+    "bot_persistence_failed_flushes", "Flushes that failed after all retries, by backend", ["backend"])
+
+
+def _loads(value: Any) -> Any:
+    """Decodes json, using orjson if it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # e.g. integers orjson can't represent, the json module handles them
+            pass
+    return json.loads(value)
+
+
+def _dumps(value: Any) -> str:
+    """Encodes json, using orjson if it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(value)
+
+
+def _with_int_keys(data: Dict[str, Any]) -> Dict[Any, Any]:
+    """Converts the keys of decoded chat or user data back to ints where possible, like
+    :class:`DictPersistence` does."""
+    return {_int_key(key): value for key, value in data.items()}
+
+
+def _int_key(key: str) -> Any:
+    digits = key[1:] if key[:1] == "-" else key
+    return int(key) if digits.isdecimal() else key
+
+
+def _copy_decoded(data: Dict[int, Dict[Any, Any]]) -> Dict[int, Dict[Any, Any]]:
+    """Copies chat or user data decoded from json. A json round trip is a lot faster than
+    :func:`copy.deepcopy`, which is used if the data is not json serializable."""
+    try:
+        return {key: _with_int_keys(_loads(_dumps(value))) for key, value in data.items()}
+    except (TypeError, ValueError, AttributeError):
+        return deepcopy(data)
+
+
+class IncrementalPersistence(DictPersistence):
+    """Base class of the bot's persistences. Keeps all data in memory like
+    :class:`DictPersistence` and writes only the keys that changed to a backend, off the event
+    loop on a single writer thread, optionally batched in the background (write-behind).
+
+    Backends implement :meth:`_load`, :meth:`_write_changes` and, to support lazy loading,
+    :meth:`_read_entry`.
+
+    Args:
+        on_flush (:obj:`bool`, optional): if set to :obj:`True` data is only written when
+            :meth:`flush` is called.
+        normalized (:obj:`bool`, optional): whether data is stored with one entry per chat/user
+            id (plus one for bot data, callback data and each conversation handler), otherwise
+            every change rewrites the whole kind of data.
+        flush_interval (:obj:`float`, optional): if set, updates only mark keys dirty and a
+            background task writes them every ``flush_interval`` seconds (write-behind).
+        flush_threshold (:obj:`int`, optional): in write-behind mode, number of dirty keys that
+            triggers a write before the interval elapsed.
+        lazy (:obj:`bool`, optional): if set to :obj:`True` chat and user data are not loaded
+            at startup but per key, the first time an update for the chat or user is handled.
+        max_retries (:obj:`int`, optional): times a failed write is retried before its keys are
+            left for the next flush.
+        retry_backoff (:obj:`float`, optional): seconds before the first retry, doubled for
+            every further retry.
+        shard (:obj:`tuple`, optional): ``(index, count)`` of the worker when the bot runs as
+            sharded workers, see :mod:`clients.telegram.sharding`. Only the chat and user data of
+            the shard is loaded and written, bot data, callback data and conversations are kept
+            per shard. Requires ``normalized``.
+        **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to
+            the DictPersistence constructor.
+    """
+
+    def __init__(
+        self,
+        on_flush: bool = False,
+        normalized: bool = True,
+        flush_interval: Optional[float] = None,
+        flush_threshold: int = 500,
+        lazy: bool = False,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        shard: Optional[Tuple[int, int]] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.logger = logging.getLogger(type(self).__module__)
+
+        if shard is not None and not normalized:
+            raise TypeError("sharding is only supported with normalized storage.")
+
+        self.on_flush = on_flush
+        self.shard = shard
+        self.normalized = normalized
+        self.lazy = lazy
+        # lazy mode: keys looked up in the database and lookups in flight
+        self._loaded: Set[Tuple[str, int]] = set()
+        self._loading: Dict[Tuple[str, int], asyncio.Future] = {}
+        # keys changed since the last write, as (kind, key) pairs
+        self._dirty = set()
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._consecutive_failures = 0
+        self._last_error: Optional[str] = None
+        # writes run one after the other on a single thread, off the event loop
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_event: Optional[asyncio.Event] = None
+        self._write_behind_task: Optional[asyncio.Task] = None
+        # hash of the last written serialization of every (kind, key)
+        self._fingerprints: Dict[Tuple[str, Hashable], Optional[int]] = {}
+        self._stats = {"updates": 0, "rows_written": 0, "bytes_written": 0, "writes_skipped": 0, "flushes": 0,
+                       "last_flush_seconds": 0.0, "flush_seconds_total": 0.0, "lazy_loads": 0,
+                       "retries": 0, "failed_flushes": 0}
+
+        self.logger.info("Loading database....")
+        data = self._load()
+        if shard is not None:
+            # e.g. data migrated from the legacy row holds all chats
+            for kind in ("chat_data", "user_data"):
+                if data[kind]:
+                    data[kind] = {key: value for key, value in data[kind].items() if self._owns(key)}
+        self.logger.info("Database loaded successfully!")
+
+        super().__init__(
+            **kwargs,
+            bot_data_json=data["bot_data"],
+            callback_data_json=data["callback_data"],
+            conversations_json=data["conversations"],
+        )
+        # chat and user data are decoded directly instead of being passed as json strings,
+        # which DictPersistence would parse a second time
+        self._chat_data = data["chat_data"]
+        self._user_data = data["user_data"]
+
+    def _load(self) -> Dict[str, Any]:
+        """Loads the stored data. Blocking, called once from the constructor.
+
+        Returns:
+            :obj:`dict`: decoded ``chat_data`` and ``user_data`` (:obj:`None` or dicts with int
+            keys, empty in lazy mode) and the json of ``bot_data``, ``callback_data`` and
+            ``conversations`` (empty strings if there is none).
+        """
+        raise NotImplementedError
+
+    def _owns(self, key: int) -> bool:
+        """Whether the chat or user data of ``key`` belongs to this shard."""
+        return self.shard is None or shard_for(key, self.shard[1]) == self.shard[0]
+
+    def _entry_id(self, kind: str, key: Hashable) -> str:
+        """Id of the entry a key is stored in, bot data, callback data and conversations are
+        stored per shard."""
+        if self.shard is None or kind in ("chat_data", "user_data"):
+            return str(key)
+        return f"{key}@shard{self.shard[0]}"
+
+    def _shared_key(self, entry_id: str) -> Tuple[Optional[str], bool]:
+        """Returns the key of a bot data, callback data or conversations entry, :obj:`None` if
+        it was written by another shard, or by any shard when the bot is not sharded, and
+        whether it is this shard's own entry rather than one written before the bot was sharded."""
+        if self.shard is not None and entry_id.endswith(f"@shard{self.shard[0]}"):
+            return entry_id.rpartition("@")[0], True
+        if "@shard" in entry_id:
+            return None, False
+        return entry_id, self.shard is None
+
+    def _decode_entries(self, rows: Iterable[Tuple[str, str, str]]) -> Optional[Dict[str, Any]]:
+        """Decodes ``(kind, id, data)`` entries as returned by :meth:`_collect_changes` into the
+        format returned by :meth:`_load`, ``None`` if there were no entries at all. Sharded,
+        entries of other shards are skipped and unsharded ones only used if the shard has none."""
+        data: Dict[str, Any] = {"chat_data": {}, "user_data": {}}
+        shared: Dict[Tuple[str, str], Tuple[bool, str]] = {}
+        empty = True
+        for kind, key, value in rows:
+            empty = False
+            if kind in ("chat_data", "user_data"):
+                key = int(key)
+                if self._owns(key):
+                    data[kind][key] = _with_int_keys(_loads(value))
+                continue
+            name, own = self._shared_key(key)
+            if name is not None and (own or (kind, name) not in shared):
+                shared[(kind, name)] = (own, value)
+
+        if empty:
+            return None
+
+        conversations = {}
+        for (kind, _), (_, value) in shared.items():
+            if kind == "conversations":
+                conversations.update(_loads(value))
+            else:
+                data[kind] = value
+
+        data.setdefault("bot_data", "")
+        data.setdefault("callback_data", "")
+        data["conversations"] = _dumps(conversations) if conversations else ""
+        return data
+
+    def _write_changes(self, upserts: List[Dict[str, str]], deletes: List[Dict[str, str]]) -> bool:
+        """Writes collected changes to the backend. Blocking, runs in the writer thread.
+
+        Args:
+            upserts (List[:obj:`dict`]): ``kind``, ``id`` and the json ``data`` of the entries to
+                write. Without ``normalized`` every upsert holds one whole kind of data.
+            deletes (List[:obj:`dict`]): ``kind`` and ``id`` of the entries to delete.
+
+        Returns:
+            :obj:`bool`: Whether the changes were committed.
+        """
+        raise NotImplementedError
+
+    def _read_entry(self, kind: str, key: int) -> Optional[Dict[Any, Any]]:
+        """Reads and decodes one chat or user entry for lazy loading. Blocking, runs in the
+        writer thread so it sees all writes queued before it."""
+        raise NotImplementedError
+
+    def _backend_stats(self) -> Dict[str, Any]:
+        """Counters of the backend included in :meth:`health` and :meth:`stats`."""
+        return {}
+
+    def _mark_dirty(self, kind: str, key: Hashable = "", changed: bool = True) -> None:
+        """Marks a key to be written on the next update of the database, unless the update
+        did not change it."""
+        self._stats["updates"] += 1
+        if not changed:
+            self._stats["writes_skipped"] += 1
+            return
+        if kind in ("chat_data", "user_data") and not self._owns(key):
+            # e.g. the user data of a group member owned by another shard, only kept in memory
+            self._stats["writes_skipped"] += 1
+            return
+        self._dirty.add((kind, key if self.normalized else ""))
+
+        if self.flush_interval is not None:
+            self._start_write_behind()
+            if len(self._dirty) >= self.flush_threshold:
+                self._flush_event.set()
+
+    def _entry_data(self, kind: str, key: Hashable) -> Optional[str]:
+        """Serializes the current value of a key, :obj:`None` if the key was dropped."""
+        if kind == "chat_data":
+            value = (self.chat_data or {}).get(key)
+            return None if value is None else _dumps(value)
+        if kind == "user_data":
+            value = (self.user_data or {}).get(key)
+            return None if value is None else _dumps(value)
+        if kind == "conversations":
+            value = (self.conversations or {}).get(key)
+            return None if value is None else self._encode_conversations_to_json({key: value})
+        if kind == "bot_data":
+            return self.bot_data_json
+        return self.callback_data_json
+
+    def _collect_changes(self) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], Dict[Tuple[str, Hashable], Optional[int]]]:
+        """Serializes all dirty keys and resets them. Keys whose serialized value has the same
+        fingerprint as the last written one are skipped.
+
+        Returns:
+            Tuple[List[:obj:`dict`], List[:obj:`dict`], :obj:`dict`]: parameters of the rows to
+            upsert, parameters of the rows to delete and the fingerprints to remember once they
+            are written. In the legacy layout every upsert is one column of the ``Persistence`` row.
+        """
+        dirty, self._dirty = self._dirty, set()
+
+        upserts, deletes, fingerprints = [], [], {}
+        for kind, key in dirty:
+            try:
+                if self.normalized:
+                    data = self._entry_data(kind, key)
+                else:
+                    # the blobs are written as json encoded strings
+                    data = json.dumps(getattr(self, f"{kind}_json"))
+            except (TypeError, ValueError) as excp:
+                self.logger.error(
+                    "Failed to serialize %s %s, skipping it", kind, key, exc_info=excp)
+                continue
+
+            fingerprint = None if data is None else hash(data)
+            if (kind, key) in self._fingerprints and self._fingerprints[(kind, key)] == fingerprint:
+                self._stats["writes_skipped"] += 1
+                continue
+            fingerprints[(kind, key)] = fingerprint
+
+            if data is None:
+                deletes.append({"kind": kind, "id": self._entry_id(kind, key)})
+            else:
+                upserts.append({"kind": kind, "id": self._entry_id(kind, key), "data": data})
+        return upserts, deletes, fingerprints
+
+    def _written(self, rows: int, fingerprints: Dict[Tuple[str, Hashable], Optional[int]]) -> None:
+        self._fingerprints.update(fingerprints)
+        self._stats["rows_written"] += rows
+
+    async def _flush_dirty(self) -> None:
+        """Serializes the dirty keys on the event loop and writes them from the writer thread.
+        Failed writes are retried with exponential backoff; if all retries fail or the flush is
+        cancelled the keys are marked dirty again so the next flush writes them."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            upserts, deletes, fingerprints = self._collect_changes()
+            if not upserts and not deletes:
+                return
+
+            backend = type(self).__name__
+            span = TRACER.start_span("persistence.flush", backend=backend, rows=len(upserts) + len(deletes))
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            retries = 0
+            try:
+                written = await loop.run_in_executor(self._writer, self._write_changes, upserts, deletes)
+                for attempt in range(self.max_retries):
+                    if written:
+                        break
+                    retries += 1
+                    self._stats["retries"] += 1
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                    written = await loop.run_in_executor(self._writer, self._write_changes, upserts, deletes)
+            except asyncio.CancelledError as excp:
+                # e.g. flush() stopping the write-behind task during a backoff, the keys are
+                # written again by the next flush
+                self._dirty.update(fingerprints)
+                span.end(excp)
+                raise
+            elapsed = time.perf_counter() - start
+            FLUSH_SECONDS.labels(backend).observe(elapsed)
+
+            if written:
+                self._written(len(upserts) + len(deletes), fingerprints)
+                self._consecutive_failures = 0
+                written_bytes = sum(len(upsert["data"].encode()) for upsert in upserts)
+                self._stats["bytes_written"] += written_bytes
+                BYTES_WRITTEN.labels(backend).inc(written_bytes)
+                ROWS_WRITTEN.labels(backend).inc(len(upserts) + len(deletes))
+                span.set(bytes=written_bytes, retries=retries)
+                span.end()
+            else:
+                span.set(retries=retries)
+                span.end(RuntimeError(f"Failed to save {len(fingerprints)} rows"))
+                FAILED_FLUSHES.labels(backend).inc()
+                self._dirty.update(fingerprints)
+                self._consecutive_failures += 1
+                self._stats["failed_flushes"] += 1
+                self.logger.error(
+                    "Failed to save %s rows after %s retries, keeping them for the next flush",
+                    len(fingerprints), self.max_retries)
+            self._stats["flushes"] += 1
+            self._stats["last_flush_seconds"] = elapsed
+            self._stats["flush_seconds_total"] += elapsed
+
+    def _start_write_behind(self) -> None:
+        if self._write_behind_task is None or self._write_behind_task.done():
+            self._flush_event = asyncio.Event()
+            self._write_behind_task = asyncio.get_running_loop().create_task(self._write_behind())
+
+    async def _write_behind(self) -> None:
+        """Flushes dirty keys every ``flush_interval`` seconds or once ``flush_threshold``
+        keys are dirty."""
+        # flushes the changes of every update, not of the one it was started by
+        TRACER.detach()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self._flush_dirty()
+            except Exception as excp:  # pylint: disable=W0703
+                self.logger.error("Write-behind flush failed", exc_info=excp)
+
+    async def _after_update(self) -> None:
+        # in write-behind mode the background task picks the change up
+        if self.flush_interval is None and not self.on_flush:
+            await self._flush_dirty()
+
+    async def _load_key(self, kind: str, key: int, target: Dict[Any, Any]) -> None:
+        """Lazy mode: loads a chat or user row into the persistence and into ``target``, the
+        data the application holds for it, unless it was looked up before. Concurrent lookups
+        of the same key share one query."""
+        loaded = getattr(self, f"_{kind}")
+        if key in loaded or (kind, key) in self._loaded:
+            return
+
+        pending = self._loading.get((kind, key))
+        if pending is not None:
+            await pending
+            return
+
+        pending = asyncio.get_running_loop().run_in_executor(self._writer, self._read_entry, kind, key)
+        self._loading[(kind, key)] = pending
+        try:
+            value = await pending
+        finally:
+            del self._loading[(kind, key)]
+
+        self._loaded.add((kind, key))
+        self._stats["lazy_loads"] += 1
+        if value is not None and key not in loaded:
+            loaded[key] = value
+            target.update(deepcopy(value))
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        """Returns a copy of the chat_data, empty in lazy mode.
+
+        Returns:
+            :obj:`dict`: The restored chat data.
+        """
+        if self.chat_data is None:
+            self._chat_data = {}
+        return _copy_decoded(self.chat_data)
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        """Returns a copy of the user_data, empty in lazy mode.
+
+        Returns:
+            :obj:`dict`: The restored user data.
+        """
+        if self.user_data is None:
+            self._user_data = {}
+        return _copy_decoded(self.user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        """In lazy mode loads the chat's data on first access.
+        Args:
+            chat_id (:obj:`int`): The chat ID this :attr:`chat_data` is associated with.
+            chat_data (:obj:`dict`): The ``chat_data`` of a single chat.
+        """
+        if self.lazy:
+            await self._load_key("chat_data", chat_id, chat_data)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        """In lazy mode loads the user's data on first access.
+        Args:
+            user_id (:obj:`int`): The user ID this :attr:`user_data` is associated with.
+            user_data (:obj:`dict`): The ``user_data`` of a single user.
+        """
+        if self.lazy:
+            await self._load_key("user_data", user_id, user_data)
+
+    def health(self) -> Dict[str, Any]:
+        """Returns the state of the backend.
+
+        Returns:
+            :obj:`dict`: ``healthy`` (whether the last flush was written), ``consecutive_failures``
+            (flushes that failed even after retrying), ``last_error``, ``queue_depth`` and the
+            counters of the backend, e.g. the connection pool of SQL backends.
+        """
+        return {
+            "healthy": self._consecutive_failures == 0,
+            "consecutive_failures": self._consecutive_failures,
+            "last_error": self._last_error,
+            "queue_depth": len(self._dirty),
+            **self._backend_stats(),
+        }
+
+    def stats(self) -> Dict[str, float]:
+        """Returns counters about the writes of this persistence.
+
+        Returns:
+            :obj:`dict`: ``queue_depth`` (dirty keys not yet written), ``updates`` (calls updating
+            a key), ``rows_written``, ``bytes_written`` (serialized data), ``writes_skipped`` (updates or rows skipped because nothing
+            changed), ``flushes``, ``last_flush_seconds``, ``flush_seconds_total``,
+            ``coalesced_write_ratio`` (updates per written row), ``lazy_loads`` (keys looked
+            up on first access in lazy mode), ``retries``, ``failed_flushes`` (flushes that
+            failed after all retries) and the counters of the backend, see :meth:`health`.
+        """
+        stats = dict(self._stats)
+        stats.update(self._backend_stats())
+        stats["queue_depth"] = len(self._dirty)
+        stats["coalesced_write_ratio"] = stats["updates"] / max(stats["rows_written"], 1)
+        return stats
+
+    async def update_conversation(
+        self, name: str, key: Tuple[int, ...], new_state: Optional[object]
+    ) -> None:
+        """Will update the conversations for the given handler.
+
+        Args:
+            name (:obj:`str`): The handler's name.
+            key (:obj:`tuple`): The key the state is changed for.
+            new_state (:obj:`tuple` | :obj:`any`): The new state for the given key.
+        """
+        changed = (self.conversations or {}).get(name, {}).get(key) != new_state
+        await super().update_conversation(name, key, new_state)
+        self._mark_dirty("conversations", name, changed)
+        await self._after_update()
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        """Will update the user_data (if changed).
+        Args:
+            user_id (:obj:`int`): The user the data might have been changed for.
+            data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.user_data` ``[user_id]``.
+        """
+        changed = (self.user_data or {}).get(user_id) != data
+        await super().update_user_data(user_id, data)
+        self._mark_dirty("user_data", user_id, changed)
+        await self._after_update()
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        """Will update the chat_data (if changed).
+        Args:
+            chat_id (:obj:`int`): The chat the data might have been changed for.
+            data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.chat_data` ``[chat_id]``.
+        """
+        changed = (self.chat_data or {}).get(chat_id) != data
+        await super().update_chat_data(chat_id, data)
+        self._mark_dirty("chat_data", chat_id, changed)
+        await self._after_update()
+
+    async def update_bot_data(self, data: Dict) -> None:
+        """Will update the bot_data (if changed).
+        Args:
+            data (:obj:`dict`): The :attr:`telegram.ext.Dispatcher.bot_data`.
+        """
+        changed = self.bot_data != data
+        await super().update_bot_data(data)
+        self._mark_dirty("bot_data", changed=changed)
+        await self._after_update()
+
+    async def update_callback_data(self, data: CDCData) -> None:
+        """Will update the callback_data (if changed).
+
+        Args:
+            data (Tuple[List[Tuple[:obj:`str`, :obj:`float`, Dict[:obj:`str`, :class:`object`]]], \
+                Dict[:obj:`str`, :obj:`str`]]): The relevant data to restore
+                :class:`telegram.ext.CallbackDataCache`.
+        """
+        changed = self.callback_data != data
+        await super().update_callback_data(data)
+        self._mark_dirty("callback_data", changed=changed)
+        await self._after_update()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        """Will delete the specified key from the chat_data.
+        Args:
+            chat_id (:obj:`int`): The chat id to delete from the persistence.
+        """
+        # in lazy mode the chat may only exist in the database
+        changed = self.lazy or chat_id in (self.chat_data or {})
+        if self.lazy:
+            self._loaded.add(("chat_data", chat_id))
+        await super().drop_chat_data(chat_id)
+        self._mark_dirty("chat_data", chat_id, changed)
+        await self._after_update()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        """Will delete the specified key from the user_data.
+        Args:
+            user_id (:obj:`int`): The user id to delete from the persistence.
+        """
+        # in lazy mode the user may only exist in the database
+        changed = self.lazy or user_id in (self.user_data or {})
+        if self.lazy:
+            self._loaded.add(("user_data", user_id))
+        await super().drop_user_data(user_id)
+        self._mark_dirty("user_data", user_id, changed)
+        await self._after_update()
+
+    async def flush(self) -> None:
+        """Will be called by :class:`telegram.ext.Updater` upon receiving a stop signal. Gives the
+        Persistence a chance to finish up saving or close a database connection gracefully.
+        Stops the write-behind task and writes everything that is still dirty.
+        """
+        if self._write_behind_task is not None:
+            self._write_behind_task.cancel()
+            try:
+                await self._write_behind_task
+            except asyncio.CancelledError:
+                pass
+            self._write_behind_task = None
+
+        await self._flush_dirty()
+        self.logger.debug("Persistence stats: %s", self.stats())
@@ -0,0 +1,174 @@
+"""This module contains the PersonaIndex class, a precomputed search index over the personas."""
+
+import bisect
+import math
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# Telegram shows at most 50 results per inline query answer
+PAGE_SIZE = 50
+
+# minimum share of the query's trigrams a name needs to contain to count as a fuzzy match
+FUZZY_THRESHOLD = 0.5
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(text: str) -> str:
+    """Case folds a name, description or query and collapses separators into single spaces,
+    so that ``Math-Teacher`` and ``math teacher`` match."""
+    return _SEPARATORS.sub(" ", text.casefold()).strip()
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PersonaIndex:
+    """Search index over personas, built once when the personas are loaded.
+
+    Matches are ranked: exact name, name prefix, prefix of a word of the name, substring of
+    the name, substring of the description and, if that does not fill the page, names sharing
+    most of the query's trigrams, which catches typos. Within a rank shorter names come first.
+    Candidates are only tested and ordered until the requested page is full.
+
+    Args:
+        personas (List[:obj:`dict`]): Personas as returned by the Inquire API, with ``name``
+            and ``description``.
+    """
+
+    def __init__(self, personas: List[Dict[str, Any]]) -> None:
+        # a copy, the caller may reorder its list
+        self.personas = list(personas)
+        self._names = [normalize(persona['name']) for persona in self.personas]
+        self._descriptions = [normalize(persona.get('description') or "") for persona in self.personas]
+
+        # position of every persona in the tie-break order within a rank
+        self._by_order = sorted(range(len(self._names)), key=lambda i: (len(self._names[i]), self._names[i]))
+        self._order = [0] * len(self.personas)
+        for position, i in enumerate(self._by_order):
+            self._order[i] = position
+
+        self._sorted_names: List[Tuple[str, int]] = sorted((name, i) for i, name in enumerate(self._names))
+        self._sorted_words: List[Tuple[str, int]] = sorted(
+            (word, i) for i, name in enumerate(self._names) for word in set(name.split(" ")))
+
+        self._name_trigram_sets = [trigrams(name) for name in self._names]
+        self._name_trigrams = self._postings(self._names)
+        self._description_trigrams = self._postings(self._descriptions)
+
+    @staticmethod
+    def _postings(texts: List[str]) -> Dict[str, Set[int]]:
+        postings: Dict[str, Set[int]] = {}
+        for i, text in enumerate(texts):
+            for trigram in trigrams(text):
+                postings.setdefault(trigram, set()).add(i)
+        return postings
+
+    def __len__(self) -> int:
+        return len(self.personas)
+
+    @staticmethod
+    def _prefixed(entries: List[Tuple[str, int]], prefix: str) -> List[Tuple[str, int]]:
+        start = bisect.bisect_left(entries, (prefix,))
+        end = bisect.bisect_left(entries, (prefix + "\U0010ffff",), start)
+        return entries[start:end]
+
+    @staticmethod
+    def _containing(postings: Dict[str, Set[int]], query_trigrams: Set[str]) -> Set[int]:
+        """Returns the entries having the query's two rarest trigrams, a superset of the entries
+        containing the query. Intersecting the common trigrams as well costs more than testing
+        the few remaining candidates."""
+        sets = sorted((postings.get(trigram, set()) for trigram in query_trigrams), key=len)
+        return sets[0].intersection(*sets[1:2])
+
+    def _tiers(self, query: str) -> Iterator[Tuple[Set[int], Optional[Callable[[int], bool]]]]:
+        """Yields the candidates for every rank, best rank first, with the test a candidate has
+        to pass to match, if any. A persona may be yielded again for worse ranks."""
+        prefixed = self._prefixed(self._sorted_names, query)
+        yield {i for name, i in prefixed if name == query}, None
+        yield {i for _, i in prefixed}, None
+        yield {i for _, i in self._prefixed(self._sorted_words, query)}, None
+
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return
+        # with a single trigram its postings are exactly the texts containing the query
+        exact = len(query) == 3
+        yield (self._containing(self._name_trigrams, query_trigrams),
+               None if exact else lambda i: query in self._names[i])
+        yield (self._containing(self._description_trigrams, query_trigrams),
+               None if exact else lambda i: query in self._descriptions[i])
+
+    def _ordered(self, candidates: Set[int]) -> Iterable[int]:
+        """Returns the candidates in tie-break order, lazily if there are many of them."""
+        if len(candidates) * 8 > len(self._by_order):
+            return (i for i in self._by_order if i in candidates)
+        return sorted(candidates, key=self._order.__getitem__)
+
+    def _fuzzy(self, query: str, exclude: Set[int]) -> List[int]:
+        """Returns the personas whose names share most of the query's trigrams, most similar first."""
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return []
+        needed = math.ceil(FUZZY_THRESHOLD * len(query_trigrams))
+        # a name sharing ``needed`` trigrams has at least one of the rarest
+        # ``len - needed + 1`` trigrams, so only their postings need to be looked at
+        sets = sorted((self._name_trigrams.get(trigram, set()) for trigram in query_trigrams), key=len)
+        candidates = set().union(*sets[:len(query_trigrams) - needed + 1]) - exclude
+        similar = {}
+        for i in candidates:
+            shared = len(query_trigrams & self._name_trigram_sets[i])
+            if shared >= needed:
+                similar[i] = shared / (len(query_trigrams) + len(self._name_trigram_sets[i]) - shared)
+        return sorted(similar, key=lambda i: (-similar[i], self._order[i]))
+
+    def rank(self, query: str, limit: int = None) -> Tuple[List[int], bool]:
+        """
+        Returns the indices of the best matching personas, best match first
+        :param query: The search query
+        :param limit: Number of indices to return, all if not set
+        :return: The indices and whether there are more matches than ``limit``
+        """
+        query = normalize(query)
+        if not query:
+            return [], False
+
+        ranked: List[int] = []
+        seen: Set[int] = set()
+        for candidates, test in self._tiers(query):
+            candidates -= seen
+            for i in self._ordered(candidates):
+                if test is not None and not test(i):
+                    continue
+                if limit is not None and len(ranked) == limit:
+                    # the page is full, this only tells there is a next page
+                    return ranked, True
+                ranked.append(i)
+                seen.add(i)
+
+        # typos, only looked for if the other matches do not fill the page
+        if limit is None or len(ranked) < limit:
+            fuzzy = self._fuzzy(query, seen)
+            if limit is not None and len(ranked) + len(fuzzy) > limit:
+                return ranked + fuzzy[:limit - len(ranked)], True
+            return ranked + fuzzy, False
+        return ranked, False
+
+    def search(self, query: str, offset: str = "", limit: int = PAGE_SIZE) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        Returns one page of the personas matching the query
+        :param query: The search query
+        :param offset: Offset of the page as sent back by Telegram, empty for the first page
+        :param limit: Number of personas per page
+        :return: The personas and the offset of the next page, empty if this is the last page
+        """
+        try:
+            start = max(int(offset or 0), 0)
+        except ValueError:
+            start = 0
+
+        ranked, more = self.rank(query, start + limit)
+        page = [self.personas[i] for i in ranked[start:start + limit]]
+        next_offset = str(start + limit) if more else ""
+        return page, next_offset
@@ -0,0 +1,20 @@
+"""This module renders the list of commands and personas shown by /all and given to @BotFather's /setcommands."""
+
+from typing import Any, Dict, Iterable
+
+BASE_COMMANDS = """
+help - Show a help message
+chat - Directly chat with the bot
+random - Show random personas
+persona - Show the current persona
+set - Set the persona to talk to
+"""
+
+
+def render_commands(personas: Iterable[Dict[str, Any]]) -> str:
+    """
+    Renders the base commands followed by one ``name - description`` line per persona
+    :param personas: Personas as returned by the Inquire API
+    :return: The listing
+    """
+    return BASE_COMMANDS + "".join(f"{persona['name']} - {persona['description']}\n" for persona in personas)
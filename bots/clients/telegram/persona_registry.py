@@ -0,0 +1,196 @@
+"""This module contains the PersonaRegistry class, the persona catalog kept up to date in the background."""
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from clients.telegram.persona_index import PersonaIndex
+
+
+class PersonaCatalog:
+    """One version of the persona catalog with its lookup structures. The personas are never
+    changed once built, a refresh builds a new catalog.
+
+    Args:
+        personas (List[:obj:`dict`]): Personas as returned by the Inquire API.
+        version (:obj:`int`): Number of the catalog, increased with every change.
+        etag (:obj:`str`, optional): ``ETag`` of the response the personas came from.
+        last_modified (:obj:`str`, optional): ``Last-Modified`` of the response the personas came from.
+    """
+
+    def __init__(
+        self,
+        personas: List[Dict[str, Any]],
+        version: int,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        self.personas: Tuple[Dict[str, Any], ...] = tuple(personas)
+        self.version = version
+        self.etag = etag
+        self.last_modified = last_modified
+        self.names: FrozenSet[str] = frozenset(persona['name'] for persona in self.personas)
+        self.index = PersonaIndex(self.personas)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.names
+
+    def __len__(self) -> int:
+        return len(self.personas)
+
+
+class PersonaRegistry:
+    """Loads the persona catalog from the Inquire API and refreshes it every
+    ``refresh_interval`` seconds from a background task.
+
+    Refreshes are conditional requests with the ``ETag``/``Last-Modified`` of the last response,
+    an unchanged catalog costs a ``304`` and nothing else. A changed catalog is built off the
+    event loop and then replaces the current one in a single assignment, so handlers always see
+    either the old or the new catalog. Every catalog is also written to ``cache_file``, which
+    is used at startup when the API can't be reached.
+
+    Args:
+        client (:class:`clients.telegram.inquire.InquireClient`): Client used to fetch the catalog.
+        cache_file (:obj:`str`, optional): File the last catalog is kept in, no cache if not set.
+        refresh_interval (:obj:`float`, optional): Seconds between refreshes, ``0`` disables them.
+    """
+
+    def __init__(self, client: Any, cache_file: Optional[str] = None, refresh_interval: float = 300.0) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.client = client
+        self.cache_file = cache_file
+        self.refresh_interval = refresh_interval
+
+        self._catalog: Optional[PersonaCatalog] = None
+        self._listeners: List[Callable[[PersonaCatalog], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"refreshes": 0, "not_modified": 0, "changes": 0, "errors": 0}
+
+    @property
+    def catalog(self) -> PersonaCatalog:
+        """The current catalog, callers should keep the returned object for one update."""
+        if self._catalog is None:
+            raise RuntimeError("The persona catalog is not loaded yet.")
+        return self._catalog
+
+    def __contains__(self, name: object) -> bool:
+        return self._catalog is not None and name in self._catalog
+
+    def add_listener(self, callback: Callable[[PersonaCatalog], None]) -> None:
+        """Calls ``callback`` with every new catalog, and right away if one is loaded."""
+        self._listeners.append(callback)
+        if self._catalog is not None:
+            callback(self._catalog)
+
+    def _read_cache(self) -> Optional[Dict[str, Any]]:
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as excp:
+            self.logger.warning("Ignoring unreadable persona cache %s: %s", self.cache_file, excp)
+            return None
+
+    def _write_cache(self, catalog: PersonaCatalog) -> None:
+        """Replaces the cache file atomically, several processes may share it."""
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                    json.dump({"etag": catalog.etag, "last_modified": catalog.last_modified,
+                               "personas": list(catalog.personas)}, file)
+                os.replace(temporary, self.cache_file)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+        except OSError as excp:
+            self.logger.warning("Failed to write persona cache %s: %s", self.cache_file, excp)
+
+    async def _swap(self, personas: List[Dict[str, Any]], etag: Optional[str], last_modified: Optional[str],
+                    write_cache: bool = True) -> None:
+        loop = asyncio.get_running_loop()
+        version = self._catalog.version + 1 if self._catalog is not None else 1
+        # indexing a large catalog takes a while, the event loop keeps handling updates meanwhile
+        catalog = await loop.run_in_executor(None, PersonaCatalog, personas, version, etag, last_modified)
+        self._catalog = catalog
+        self.stats["changes"] += 1
+        self.logger.info("Persona catalog version %s loaded with %s personas", catalog.version, len(catalog))
+
+        for callback in self._listeners:
+            try:
+                callback(catalog)
+            except Exception as excp:  # pylint: disable=W0703
+                self.logger.warning("Persona catalog listener failed: %s", excp)
+        if write_cache and self.cache_file:
+            await loop.run_in_executor(None, self._write_cache, catalog)
+
+    async def refresh(self) -> bool:
+        """
+        Fetches the catalog if it changed since the last fetch
+        :return: Whether the catalog changed
+        """
+        self.stats["refreshes"] += 1
+        current = self._catalog
+        fetched = await self.client.list_personas(
+            etag=current.etag if current is not None else None,
+            last_modified=current.last_modified if current is not None else None,
+        )
+        if fetched is None:
+            self.stats["not_modified"] += 1
+            return False
+
+        personas, etag, last_modified = fetched
+        # servers without validators answer 200 every time
+        if current is not None and list(current.personas) == personas:
+            self.stats["not_modified"] += 1
+            current.etag, current.last_modified = etag, last_modified
+            return False
+        await self._swap(personas, etag, last_modified)
+        return True
+
+    async def load(self) -> None:
+        """Loads the catalog, from the cache file first and then from the API. Only fails if
+        neither is available."""
+        cached = self._read_cache()
+        if cached is not None:
+            await self._swap(cached["personas"], cached.get("etag"), cached.get("last_modified"), write_cache=False)
+        try:
+            await self.refresh()
+        except Exception as excp:  # pylint: disable=W0703
+            self.stats["errors"] += 1
+            if self._catalog is None:
+                self.logger.error("Error loading personas: %s", excp)
+                raise
+            self.logger.warning("Failed to load personas, using the cached catalog: %s", excp)
+
+    async def start(self) -> None:
+        """Loads the catalog and starts the background refresh."""
+        await self.load()
+        if self.refresh_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as excp:  # pylint: disable=W0703
+                # keep serving the current catalog
+                self.stats["errors"] += 1
+                self.logger.warning("Failed to refresh personas: %s", excp)
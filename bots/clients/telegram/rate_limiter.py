@@ -0,0 +1,313 @@
+"""This module contains the TokenBucketRateLimiter class, pacing the bot's Bot API requests per chat."""
+
+import asyncio
+import heapq
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from clients.telegram.metrics import REGISTRY
+
+JSONDict = Dict[str, Any]
+
+# lanes, lower is served first. Progress updates are superseded by the next one and chat
+# actions are only useful right away, both give way to answers and are dropped when they would
+# come late
+ANSWER, PROGRESS, BACKGROUND = range(3)
+BACKGROUND_ENDPOINTS = frozenset({"sendChatAction"})
+# ``rate_limit_args`` of a request in the progress lane, e.g. an edit showing a partial answer
+PROGRESS_UPDATE = "progress"
+# messages per second a bot may send overall, and at once
+OVERALL_RATE = 25
+OVERALL_BURST = 5
+
+TELEGRAM_CALLS = REGISTRY.counter(
+    "bot_telegram_calls", "Bot API calls by method and outcome: ok, retry_after (a 429), dropped or error",
+    ["endpoint", "outcome"])
+TELEGRAM_SECONDS = REGISTRY.histogram(
+    "bot_telegram_call_seconds", "Seconds a Bot API call took, without waiting for the rate limits", ["endpoint"])
+
+# buckets are only cleaned up once there are more than this many
+_MAX_IDLE_BUCKETS = 1024
+
+
+class _Bucket:
+    """Token bucket, ``capacity`` requests at once and ``rate`` requests per second on average."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # set after a 429, no request is sent before
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self._refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def reserve(self, now: float) -> float:
+        """Takes a token, going into debt if there is none, and returns the seconds until it is due."""
+        self._refill(now)
+        self.tokens -= 1
+        return max(self.blocked_until - now, -self.tokens / self.rate if self.tokens < 0 else 0.0)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class TokenBucketRateLimiter(BaseRateLimiter[Union[int, str]]):
+    """Rate limiter with token buckets for the whole bot, every private chat and every group,
+    sized after Telegram's limits: 30 messages per second overall, one per second in a private
+    chat and 20 per minute in a group. A bucket lets ``burst + rate * period`` requests through
+    in any period, the defaults keep that within the limits.
+
+    A request first waits for its chat's bucket, so a busy chat does not hold up other chats,
+    then for the overall bucket. Like :class:`telegram.ext.AIORateLimiter` requests without a
+    ``chat_id``, e.g. answers to inline queries, are not limited. Waiting requests get overall tokens by lane, answers before
+    progress updates before chat actions. Chat actions do not use the chat's budget and are dropped (answered with
+    :obj:`True` without calling the API) when they would wait longer than ``background_max_wait``.
+    Progress updates, requests sent with ``rate_limit_args=PROGRESS_UPDATE``, are only sent if
+    the chat and the whole bot have budget left right away, so that they never delay an answer.
+
+    A 429 pauses the chat it was sent to, or all requests if it was not sent to a chat, for its
+    ``retry_after`` and the request is retried up to ``max_retries`` times. Progress updates
+    and chat actions are not retried.
+
+    Args:
+        overall_rate (:obj:`float`, optional): Requests per second for the whole bot.
+        overall_burst (:obj:`float`, optional): Requests the whole bot may send at once.
+        private_rate (:obj:`float`, optional): Messages per second in a private chat.
+        private_burst (:obj:`float`, optional): Messages that may be sent at once to a private chat.
+        group_rate (:obj:`float`, optional): Messages per second in a group or channel.
+        group_burst (:obj:`float`, optional): Messages that may be sent at once to a group or channel.
+        max_retries (:obj:`int`, optional): Retries after a 429, the ``rate_limit_args`` of a
+            request override it.
+        background_max_wait (:obj:`float`, optional): Seconds a chat action may wait.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = OVERALL_RATE,
+        overall_burst: float = OVERALL_BURST,
+        private_rate: float = 1,
+        private_burst: float = 1,
+        group_rate: float = 15 / 60,
+        group_burst: float = 5,
+        max_retries: int = 3,
+        background_max_wait: float = 1.0,
+    ) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.overall_rate = overall_rate
+        self.overall_burst = overall_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.background_max_wait = background_max_wait
+
+        self._overall: Optional[_Bucket] = None
+        self._chats: Dict[Union[int, str], _Bucket] = {}
+        # (lane, sequence, future) of requests waiting for an overall token
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._observers: List[Callable[[str, Dict[str, Any]], None]] = []
+
+        self.stats = {"requests": 0, "retry_after": 0, "retries": 0, "dropped": 0, "waited_seconds": 0.0}
+
+    def add_observer(self, callback: Callable[[str, Dict[str, Any]], None]) -> None:
+        """Calls ``callback`` with the endpoint and data of every successful request."""
+        self._observers.append(callback)
+
+    async def initialize(self) -> None:
+        """Does nothing."""
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    @staticmethod
+    def _chat_key(chat_id: Any) -> Tuple[Optional[Union[int, str]], bool]:
+        """Returns the key of a chat's bucket and whether the chat is a group or channel."""
+        if chat_id is None:
+            return None, False
+        # in case the chat id is an integer passed as string
+        try:
+            chat_id = int(chat_id)
+        except (ValueError, TypeError):
+            pass
+        # @username chat ids only exist for channels and supergroups
+        return chat_id, isinstance(chat_id, str) or chat_id < 0
+
+    def _chat_bucket(self, key: Union[int, str], group: bool, now: float) -> _Bucket:
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) > _MAX_IDLE_BUCKETS:
+                for idle in [other for other, other_bucket in self._chats.items() if other_bucket.idle(now)]:
+                    del self._chats[idle]
+            if group:
+                bucket = _Bucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = _Bucket(self.private_rate, self.private_burst, now)
+            self._chats[key] = bucket
+        return bucket
+
+    def _overall_bucket(self, now: float) -> _Bucket:
+        if self._overall is None:
+            self._overall = _Bucket(self.overall_rate, self.overall_burst, now)
+        return self._overall
+
+    async def _acquire(self, lane: int, chat: Optional[Union[int, str]], group: bool) -> bool:
+        """Waits until the request may be sent, returns :obj:`False` if it should be dropped."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        overall = self._overall_bucket(start)
+        if chat is None:
+            # only held back by a 429
+            if overall.blocked_until > start:
+                await asyncio.sleep(overall.blocked_until - start)
+            return True
+
+        bucket = self._chat_bucket(chat, group, start)
+        if lane == ANSWER:
+            delay = bucket.reserve(start)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                # a 429 may have paused the chat meanwhile
+                delay = bucket.blocked_until - loop.time()
+        elif lane == PROGRESS:
+            # sent right away with the budget left over, or not at all
+            if bucket.wait_time(start) > 0 or self._waiters or overall.wait_time(start) > 0:
+                return False
+            bucket.take()
+            overall.take()
+            return True
+        elif bucket.blocked_until > start:
+            return False
+
+        if not self._waiters and overall.wait_time(loop.time()) == 0:
+            overall.take()
+            self.stats["waited_seconds"] += loop.time() - start
+            return True
+
+        future = loop.create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (lane, self._sequence, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        try:
+            if lane == BACKGROUND:
+                await asyncio.wait_for(asyncio.shield(future), self.background_max_wait)
+            else:
+                await future
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            # the request is not waiting anymore, the dispatcher skips it
+            future.cancel()
+        self.stats["waited_seconds"] += loop.time() - start
+        return True
+
+    async def _dispatch(self) -> None:
+        """Hands out overall tokens to the waiting requests, best lane first."""
+        loop = asyncio.get_running_loop()
+        overall = self._overall_bucket(loop.time())
+        while self._waiters:
+            wait = overall.wait_time(loop.time())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            overall.take()
+            future.set_result(None)
+
+    def _pause(self, chat: Optional[Union[int, str]], group: bool, seconds: float) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        bucket = self._chat_bucket(chat, group, now) if chat is not None else self._overall_bucket(now)
+        bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+
+    # mypy doesn't understand that the last run of the for loop returns or raises
+    async def process_request(  # type: ignore[return]
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, JSONDict, List[JSONDict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Union[int, str]],
+    ) -> Union[bool, JSONDict, List[JSONDict]]:
+        """
+        Processes a request by applying rate limiting.
+
+        See :meth:`telegram.ext.BaseRateLimiter.process_request` for detailed information on the
+        arguments.
+
+        Args:
+            rate_limit_args (:obj:`None` | :obj:`int` | :obj:`str`): If set, specifies the maximum number of
+                retries to be made in case of a :exc:`~telegram.error.RetryAfter` exception.
+                Defaults to :paramref:`TokenBucketRateLimiter.max_retries`. :data:`PROGRESS_UPDATE`
+                sends the request in the progress lane instead.
+        """
+        if rate_limit_args == PROGRESS_UPDATE:
+            max_retries, lane = 0, PROGRESS
+        else:
+            max_retries = self.max_retries if rate_limit_args is None else int(rate_limit_args)
+            lane = BACKGROUND if endpoint in BACKGROUND_ENDPOINTS else ANSWER
+        chat, group = self._chat_key(data.get("chat_id"))
+        self.stats["requests"] += 1
+
+        for attempt in range(max_retries + 1):
+            if not await self._acquire(lane, chat, group):
+                self.stats["dropped"] += 1
+                TELEGRAM_CALLS.labels(endpoint, "dropped").inc()
+                return True
+            start = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                TELEGRAM_CALLS.labels(endpoint, "ok").inc()
+                for observer in self._observers:
+                    observer(endpoint, data)
+                return result
+            except RetryAfter as exc:
+                self.stats["retry_after"] += 1
+                TELEGRAM_CALLS.labels(endpoint, "retry_after").inc()
+                self._pause(chat, group, exc.retry_after + 0.1)
+                if lane != ANSWER:
+                    # a late chat action or superseded progress update is worthless
+                    self.stats["dropped"] += 1
+                    return True
+                if attempt == max_retries:
+                    self.logger.warning("Rate limit hit after %d retries", attempt)
+                    raise
+                self.stats["retries"] += 1
+                self.logger.info("Rate limit hit. Retrying after %s seconds", exc.retry_after)
+            except Exception:
+                TELEGRAM_CALLS.labels(endpoint, "error").inc()
+                raise
+            finally:
+                TELEGRAM_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
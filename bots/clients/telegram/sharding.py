@@ -0,0 +1,244 @@
+"""This module contains the ShardRouter class, which spreads updates over sharded bot workers.
+
+The bot keeps the state of a chat in the memory of the process handling it, so a single
+process can only use one core. Sharded, an ingress process receives the updates, from a
+webhook or by polling, and forwards each one to the worker owning its chat. Every worker is
+a bot in webhook mode that only loads and persists the chats of its shard. The updates of a
+chat always go to the same worker, in the order they were received.
+"""
+
+import asyncio
+import hmac
+import logging
+import zlib
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import httpx
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+from clients.telegram.http_server import HttpRequest, HttpResponse, HttpServer
+from clients.telegram.webhook import SECRET_HEADER
+
+
+def shard_for(key: int, shards: int) -> int:
+    """
+    Returns the shard a chat or user belongs to, stable across processes and restarts
+    :param key: Id of the chat or user
+    :param shards: Number of shards
+    """
+    return zlib.crc32(str(key).encode()) % shards
+
+
+def update_key(update: Dict[str, Any]) -> Optional[int]:
+    """
+    Returns the id of the chat an update belongs to, the user's id for updates outside a chat
+    like inline queries, which is also the id of the private chat with the user
+    :param update: The update as sent by Telegram
+    :return: The id, :obj:`None` if the update has neither chat nor user, e.g. a poll
+    """
+    for field, payload in update.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        # callback queries carry the chat in their message
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+    return None
+
+
+class ShardRouter:
+    """Forwards updates to the worker owning their chat, see the module docstring.
+
+    Every worker has a bounded queue and a task posting the queued updates in order, up to
+    ``batch_size`` at once as a JSON list. A worker that cannot be reached is retried with
+    backoff until it is back, its queue filling up meanwhile.
+
+    Args:
+        workers (List[:obj:`str`]): Update URLs of the workers, the index is the shard.
+        secret_token (:obj:`str`, optional): Secret token updates posted to :meth:`handle_update`
+            must carry, also sent to the workers.
+        path (:obj:`str`, optional): Path Telegram posts the updates to.
+        max_pending (:obj:`int`, optional): Updates queued per worker at most.
+        batch_size (:obj:`int`, optional): Updates posted to a worker at once at most.
+        retry_backoff (:obj:`float`, optional): Seconds before retrying a worker, doubled for
+            every further retry up to 30 seconds.
+    """
+
+    def __init__(
+        self,
+        workers: Sequence[str],
+        secret_token: Optional[str] = None,
+        path: str = "/telegram",
+        max_pending: int = 10000,
+        batch_size: int = 100,
+        retry_backoff: float = 0.5,
+    ) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.workers = list(workers)
+        self.secret_token = secret_token
+        self.path = path
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.retry_backoff = retry_backoff
+        # created in start(), on the loop they are used on
+        self._queues: List[asyncio.Queue] = []
+        self._forwarders: List[asyncio.Task] = []
+        self._client: Optional[httpx.AsyncClient] = None
+        self._closing = False
+        # shards whose worker exited, their queued updates can't be delivered
+        self._exited: Set[int] = set()
+        self.stats = {"routed": 0, "forwarded": 0, "batches": 0, "retries": 0, "rejected": 0, "full": 0,
+                      "undelivered": 0}
+        self.forwarded = [0] * len(self.workers)
+
+    @property
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def attach(self, server: HttpServer) -> None:
+        """Registers the update route on a :class:`HttpServer`."""
+        server.route("POST", self.path, self.handle_update)
+
+    async def start(self) -> None:
+        headers = {SECRET_HEADER: self.secret_token} if self.secret_token else {}
+        self._client = httpx.AsyncClient(headers=headers, timeout=30.0)
+        self._queues = [asyncio.Queue(self.max_pending) for _ in self.workers]
+        self._forwarders = [asyncio.get_running_loop().create_task(self._forward(shard))
+                            for shard in range(len(self.workers))]
+
+    def worker_exited(self, shard: int) -> None:
+        """
+        Stops taking updates once a worker is gone, the updates queued for it are dropped when stopping
+        :param shard: Index of the worker
+        """
+        self._closing = True
+        self._exited.add(shard)
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        Stops taking updates and waits until the queued ones are forwarded to the workers still running
+        :param timeout: Seconds to wait for the workers
+        """
+        self._closing = True
+        for shard in self._exited:
+            dropped = self._queues[shard].qsize()
+            self.stats["undelivered"] += dropped
+            self.logger.error("Dropping %d queued updates of the exited worker %d", dropped, shard)
+        running = [queue for shard, queue in enumerate(self._queues) if shard not in self._exited]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in running)), timeout)
+        except asyncio.TimeoutError:
+            dropped = sum(queue.qsize() for queue in running)
+            self.stats["undelivered"] += dropped
+            self.logger.error("Gave up forwarding %d updates", dropped)
+        for task in self._forwarders:
+            task.cancel()
+        await asyncio.gather(*self._forwarders, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+
+    def _queue(self, update: Dict[str, Any]) -> asyncio.Queue:
+        key = update_key(update)
+        return self._queues[0 if key is None else shard_for(key, len(self.workers))]
+
+    async def route(self, update: Dict[str, Any]) -> None:
+        """
+        Queues an update for its worker, waits while the worker's queue is full
+        :param update: The update as sent by Telegram
+        """
+        await self._queue(update).put(update)
+        self.stats["routed"] += 1
+
+    async def handle_update(self, request: HttpRequest) -> HttpResponse:
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.stats["rejected"] += 1
+            return 401, {"code": "UNAUTHORIZED", "message": "Invalid secret token"}
+        if self._closing:
+            return 503, {"code": "SERVICE_UNAVAILABLE", "message": "Not accepting updates"}
+
+        try:
+            update = request.json()
+            queue = self._queue(update)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, {"code": "BAD_REQUEST", "message": "Expected an update"}
+
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram retries later
+            self.stats["full"] += 1
+            return 503, {"code": "SERVICE_UNAVAILABLE", "message": "Too many pending updates"}
+        self.stats["routed"] += 1
+        return 200, ""
+
+    async def poll(self, bot: Bot, stop: asyncio.Event, timeout: int = 10) -> None:
+        """
+        Routes the updates of ``getUpdates`` until ``stop`` is set, the updates not routed by then
+        are left for the next ``getUpdates``
+        :param bot: Bot to poll with
+        :param stop: Event ending the polling
+        :param timeout: Seconds of a long poll
+        """
+        await bot.delete_webhook()
+        offset = None
+        stopped = asyncio.ensure_future(stop.wait())
+        try:
+            while not stop.is_set():
+                fetch = asyncio.ensure_future(bot.get_updates(
+                    offset=offset, timeout=timeout, read_timeout=timeout + 5, allowed_updates=Update.ALL_TYPES))
+                await asyncio.wait([fetch, stopped], return_when=asyncio.FIRST_COMPLETED)
+                if not fetch.done():
+                    # not confirmed, Telegram sends these updates again
+                    fetch.cancel()
+                    break
+                try:
+                    updates = fetch.result()
+                except TelegramError as excp:
+                    self.logger.warning("Failed to get updates: %s", excp)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    # waits while the worker's queue is full, e.g. because the worker exited
+                    routed = asyncio.ensure_future(self.route(update.to_dict()))
+                    await asyncio.wait([routed, stopped], return_when=asyncio.FIRST_COMPLETED)
+                    if not routed.done():
+                        routed.cancel()
+                        break
+                    offset = update.update_id + 1
+        finally:
+            stopped.cancel()
+
+        if offset is not None:
+            # confirms the routed updates
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+    async def _forward(self, shard: int) -> None:
+        """Posts the queued updates of a worker in order."""
+        queue = self._queues[shard]
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            attempt = 0
+            while True:
+                try:
+                    response = await self._client.post(self.workers[shard], json=batch)
+                    response.raise_for_status()
+                    break
+                except httpx.HTTPError as excp:
+                    self.stats["retries"] += 1
+                    self.logger.warning("Failed to forward %d updates to shard %d: %s", len(batch), shard, excp)
+                    await asyncio.sleep(min(self.retry_backoff * 2 ** attempt, 30))
+                    attempt += 1
+
+            self.stats["forwarded"] += len(batch)
+            self.stats["batches"] += 1
+            self.forwarded[shard] += len(batch)
+            for _ in batch:
+                queue.task_done()
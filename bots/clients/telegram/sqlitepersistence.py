@@ -0,0 +1,79 @@
+"""This module contains the SQLitePersistence class, storing the bot's data in a local SQLite database."""
+
+from typing import Any
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.sql import text
+
+from clients.telegram.mysqlpersistence import MySQLPersistence
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+class SQLitePersistence(MySQLPersistence):
+    """Stores the bot's data in a SQLite database file in WAL mode, for staging, load tests and
+    single-node deployments. Uses the same tables and incremental writes as
+    :class:`clients.telegram.mysqlpersistence.MySQLPersistence` and creates the tables if they
+    don't exist yet.
+
+    Args:
+        url (:obj:`str`, Optional) the database url, ``sqlite:///<path>``.
+        session (:obj:`scoped_session`, Optional): sqlalchemy scoped session.
+        normalized (:obj:`bool`, optional): whether to store one row per chat/user id,
+            defaults to :obj:`True`.
+        synchronous (:obj:`str`, optional): the ``synchronous`` pragma. With ``NORMAL`` a power
+            loss may lose the last transactions, but never corrupts the database.
+        **kwargs (:obj:`dict`): Arbitrary keyword Arguments to be passed to the
+            :class:`clients.telegram.mysqlpersistence.MySQLPersistence` constructor.
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        session: scoped_session = None,
+        normalized: bool = True,
+        synchronous: str = "NORMAL",
+        **kwargs: Any,
+    ) -> None:
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise TypeError(f"synchronous must be one of {', '.join(SYNCHRONOUS_MODES)}.")
+        self.synchronous = synchronous.upper()
+        super().__init__(url=url, session=session, normalized=normalized, **kwargs)
+
+    def _create_engine(self, url: str, **pool_options: Any) -> Engine:
+        # an in-memory database would exist once per connection, the writer thread uses its own
+        if not url.startswith("sqlite:///") or url.endswith(":memory:"):
+            raise TypeError(f"{url} isn't a valid SQLite database file URL.")
+        engine = create_engine(url, **pool_options)
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection: Any, _: Any) -> None:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={self.synchronous}")
+            cursor.close()
+
+        return engine
+
+    def _init_database(self) -> None:
+        """Creates the tables of /web/prisma/schema.prisma if they don't exist."""
+        self.logger.info("Creating tables if needed...")
+        self._session.execute(text(
+            """CREATE TABLE IF NOT EXISTS Persistence (
+                bot_data TEXT,
+                chat_data TEXT,
+                user_data TEXT,
+                callback_data TEXT,
+                conversations TEXT,
+                updatedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )"""))
+        self._session.execute(text(
+            """CREATE TABLE IF NOT EXISTS PersistenceEntry (
+                kind VARCHAR(32) NOT NULL,
+                id VARCHAR(191) NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            )"""))
+        self._session.commit()
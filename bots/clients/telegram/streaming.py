@@ -0,0 +1,237 @@
+"""This module contains the ReplyStreamer class and the StreamingReply it starts, which show an
+answer while it is being written by editing the reply as partial results arrive."""
+
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from telegram import Message
+from telegram.error import BadRequest, TelegramError
+
+from clients.telegram.outbound import MAX_TEXT_LENGTH, split_markdown
+from clients.telegram.rate_limiter import PROGRESS_UPDATE, TokenBucketRateLimiter
+from clients.telegram.tracing import TRACER
+
+
+class StreamingReply:
+    """A reply growing with the partial results of an inquiry, started by :meth:`ReplyStreamer.start`.
+
+    A placeholder message is sent right away. Partial results passed to :meth:`feed` are shown
+    by editing it at most every ``interval`` seconds, intermediate ones are skipped. The edits
+    after the first one are progress updates for :class:`TokenBucketRateLimiter`, which drops
+    them rather than delay an answer, the next edit shows the text then. Text past 4096
+    characters continues in a new message. Partial results are shown as plain text, since their
+    Markdown may not be closed yet, :meth:`finish` shows the final answer as Markdown.
+
+    Args:
+        streamer (:class:`ReplyStreamer`): Streamer recording the reply's statistics.
+        chat_id (:obj:`int`): Chat to reply in.
+        reply_to_message_id (:obj:`int`, optional): Message answered.
+        interval (:obj:`float`): Seconds between two edits.
+        started (:obj:`float`): :func:`time.perf_counter` when the question was received.
+    """
+
+    def __init__(self, streamer: "ReplyStreamer", chat_id: int, reply_to_message_id: Optional[int],
+                 interval: float, started: float) -> None:
+        self.streamer = streamer
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.interval = interval
+        self.started = started
+        self.messages: List[Message] = []
+        # (text, parse mode) last sent per message
+        self._shown: List[Tuple[str, Optional[str]]] = []
+        self._text = ""
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._editing = False
+        self.first_token: Optional[float] = None
+        self.finished = False
+
+    async def _start(self, placeholder: str) -> None:
+        await self._show([placeholder], None)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def feed(self, text: str) -> None:
+        """
+        Shows the answer written so far, with the next edit
+        :param text: The whole answer so far, not just what was added
+        """
+        if text and text != self._text and not self.finished:
+            self._text = text
+            self._changed.set()
+
+    def feed_inquiry(self, inquiry: Dict[str, Any]) -> None:
+        """Shows the partial ``result`` of an unfinished inquiry, pass it as ``on_partial``."""
+        self.feed(inquiry.get('result') or "")
+
+    async def _run(self) -> None:
+        """Edits the reply whenever the text changed, at most every ``interval`` seconds."""
+        while not self.finished:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self._text
+            self._editing = True
+            try:
+                # the first words are an answer, not a progress update
+                shown = await self._show([text[i:i + MAX_TEXT_LENGTH] for i in range(0, len(text), MAX_TEXT_LENGTH)],
+                                         None, progress=self.first_token is not None)
+            except TelegramError as excp:
+                self.streamer.counters["errors"] += 1
+                self.streamer.logger.warning("Failed to show a partial answer in %s: %s", self.chat_id, excp)
+            else:
+                if shown:
+                    self._first_token()
+                else:
+                    # retried with the next edit, even if no new text arrives
+                    self._changed.set()
+            finally:
+                self._editing = False
+            if not self.finished:
+                await asyncio.sleep(self.interval)
+
+    async def _show(self, parts: List[str], parse_mode: Optional[str], progress: bool = False) -> bool:
+        """
+        Edits the messages whose text changed and sends the parts that do not have one yet
+        :param parts: Text of every message
+        :param parse_mode: Parse mode of the text
+        :param progress: Whether the edits may be dropped by the rate limiter
+        :return: Whether all of the text is shown, :obj:`False` if an edit was dropped
+        """
+        for i, part in enumerate(parts):
+            if i >= len(self.messages):
+                with TRACER.span("message.send", part=i + 1, chars=len(part)):
+                    message = await self.streamer.bot.send_message(
+                        self.chat_id, part, parse_mode=parse_mode, reply_to_message_id=self.reply_to_message_id)
+                self.messages.append(message)
+                self._shown.append((part, parse_mode))
+                self.streamer.counters["messages"] += 1
+            elif self._shown[i] != (part, parse_mode):
+                try:
+                    with TRACER.span("message.edit", part=i + 1, chars=len(part), progress=progress):
+                        edited = await self.streamer.bot.edit_message_text(
+                            part, chat_id=self.chat_id, message_id=self.messages[i].message_id, parse_mode=parse_mode,
+                            rate_limit_args=self.streamer.progress_args if progress else None)
+                except BadRequest as excp:
+                    # e.g. the Markdown renders to the text shown already
+                    if "not modified" not in excp.message.lower():
+                        raise
+                    edited = None
+                if edited is True:
+                    self.streamer.counters["dropped"] += 1
+                    return False
+                self._shown[i] = (part, parse_mode)
+                self.streamer.counters["edits"] += 1
+
+        # the final Markdown parts may be fewer than the plain ones streamed
+        while len(self.messages) > max(len(parts), 1):
+            message = self.messages.pop()
+            self._shown.pop()
+            await self.streamer.bot.delete_message(self.chat_id, message.message_id)
+        return True
+
+    def _first_token(self) -> None:
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.started
+            self.streamer.record_first_token(self.first_token)
+
+    async def _stop(self) -> None:
+        self.finished = True
+        if self._task is not None:
+            # an edit in progress completes, so that the messages sent are known
+            if not self._editing:
+                self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def finish(self, text: str, answer: bool = True) -> Optional[Message]:
+        """
+        Replaces the streamed text with the final one
+        :param text: The final text, Markdown
+        :param answer: Whether the text is the answer, an apology does not count as first token
+        :return: The last message of the reply
+        """
+        await self._stop()
+        await self._show(split_markdown(text) or [text], "Markdown")
+        if answer:
+            self._first_token()
+        self.streamer.counters["replies"] += 1
+        return self.messages[-1] if self.messages else None
+
+    async def close(self) -> None:
+        """Stops editing, removes the placeholder if neither partial nor final text replaced it."""
+        if self.finished and self._task is None:
+            return
+        await self._stop()
+        if self.first_token is None and self.messages:
+            try:
+                for message in self.messages:
+                    await self.streamer.bot.delete_message(self.chat_id, message.message_id)
+            except TelegramError as excp:
+                self.streamer.logger.warning("Failed to remove the placeholder in %s: %s", self.chat_id, excp)
+            self.messages.clear()
+
+
+class ReplyStreamer:
+    """Starts :class:`StreamingReply` replies and records the time to first token, the seconds
+    from receiving a question until the first words of the answer are shown. For replies sent
+    in one piece it is the time until the whole answer is sent, see :meth:`record_first_token`.
+
+    Edits count against the same per-chat limits as messages, 1 per second in private chats and
+    20 per minute in groups, so groups are edited less often.
+
+    Args:
+        bot (:class:`telegram.Bot`): Bot to send with.
+        interval (:obj:`float`, optional): Seconds between two edits in a private chat.
+        group_interval (:obj:`float`, optional): Seconds between two edits in a group.
+        placeholder (:obj:`str`, optional): Text shown until the first partial result arrives.
+        samples (:obj:`int`, optional): Number of recent replies the time to first token is computed from.
+    """
+
+    def __init__(self, bot: Any, interval: float = 1.0, group_interval: float = 4.0, placeholder: str = "…",
+                 samples: int = 1000) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.bot = bot
+        # other rate limiters don't know progress updates
+        self.progress_args = PROGRESS_UPDATE if isinstance(
+            getattr(bot, "rate_limiter", None), TokenBucketRateLimiter) else None
+        self.interval = interval
+        self.group_interval = group_interval
+        self.placeholder = placeholder
+        self._first_tokens: Deque[float] = deque(maxlen=samples)
+        self.counters = {"streams": 0, "replies": 0, "messages": 0, "edits": 0, "dropped": 0, "errors": 0}
+
+    def interval_for(self, chat_id: int) -> float:
+        return self.group_interval if chat_id < 0 else self.interval
+
+    async def start(self, chat_id: int, reply_to_message_id: Optional[int] = None,
+                    started: Optional[float] = None) -> StreamingReply:
+        """
+        Sends the placeholder of a streamed reply
+        :param chat_id: Chat to reply in
+        :param reply_to_message_id: Message answered
+        :param started: :func:`time.perf_counter` when the question was received, defaults to now
+        :return: The reply, to be finished with :meth:`StreamingReply.finish` and closed with
+            :meth:`StreamingReply.close`
+        """
+        reply = StreamingReply(self, chat_id, reply_to_message_id, self.interval_for(chat_id),
+                               time.perf_counter() if started is None else started)
+        self.counters["streams"] += 1
+        await reply._start(self.placeholder)  # pylint: disable=W0212
+        return reply
+
+    def record_first_token(self, seconds: float) -> None:
+        self._first_tokens.append(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        first_tokens = sorted(self._first_tokens)
+        return dict(
+            self.counters,
+            p50_first_token_seconds=statistics.median(first_tokens) if first_tokens else 0.0,
+            p99_first_token_seconds=first_tokens[min(len(first_tokens) - 1, int(len(first_tokens) * 0.99))]
+            if first_tokens else 0.0,
+        )
@@ -0,0 +1,261 @@
+"""This module contains the Tracer class recording timed spans of the work done for an update,
+the TraceContextFilter adding the ids of the current span to log records and the
+OtlpFileExporter writing finished spans as OTLP JSON.
+
+The current span is kept in a :mod:`contextvars` variable, so it follows an update through its
+handler and the tasks the handler starts. Spans are created on the shared :data:`TRACER`::
+
+    with TRACER.span("inquiry.create", persona=persona):
+        ...
+
+Correlation attributes (``update_id``, ``chat_id``, ``user_id`` and ``inquiry_id``) of a span
+are inherited by its children and added to every log line written while it is current.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+# attributes inherited by child spans and added to log records
+CORRELATION_KEYS = ("update_id", "chat_id", "user_id", "inquiry_id")
+
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("span", default=None)
+
+# marks the parent argument as not given, None starts a new trace
+_CURRENT: Any = object()
+
+
+class Span:
+    """A timed operation, part of the trace of an update. Created by :meth:`Tracer.start_span`.
+
+    Args:
+        tracer (:class:`Tracer`): Tracer the span is reported to when it ends.
+        name (:obj:`str`): Name of the operation, e.g. ``inquiry.poll``.
+        parent (:class:`Span`, optional): Enclosing span, :obj:`None` starts a new trace.
+        attributes (:obj:`dict`): Attributes of the span.
+    """
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "fields", "attributes", "start",
+                 "end_time", "error")
+
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], attributes: Dict[str, Any]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent is not None else None
+        self.fields: Dict[str, Any] = dict(parent.fields) if parent is not None else {}
+        self.attributes: Dict[str, Any] = {}
+        self.set(**attributes)
+        self.start = time.time_ns()
+        self.end_time: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        """Adds attributes, correlation attributes are also inherited by spans started afterwards."""
+        self.attributes.update(attributes)
+        for key in CORRELATION_KEYS:
+            if key in attributes:
+                self.fields[key] = attributes[key]
+
+    @property
+    def duration(self) -> float:
+        """Seconds the span took, or took so far."""
+        return ((self.end_time or time.time_ns()) - self.start) / 1e9
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """
+        Ends the span and reports it, ending it again does nothing
+        :param error: Exception the operation failed with
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.tracer._finished(self)  # pylint: disable=W0212
+
+
+class OtlpFileExporter:
+    """Appends finished spans to a file as OTLP JSON, one ``ExportTraceServiceRequest`` per line,
+    the format of the OpenTelemetry collector's file exporter. Spans are written in batches of
+    ``batch_size`` and when the exporter is closed.
+
+    Args:
+        path (:obj:`str`): File to append to.
+        service (:obj:`str`, optional): ``service.name`` of the resource.
+        batch_size (:obj:`int`, optional): Spans written at once.
+    """
+
+    def __init__(self, path: str, service: str = "bots", batch_size: int = 256) -> None:
+        self.path = path
+        self.service = service
+        self.batch_size = batch_size
+        self._spans: List[Span] = []
+        # spans may end on several threads, e.g. the persistence's
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+            if len(self._spans) < self.batch_size:
+                return
+            spans, self._spans = self._spans, []
+        self._write(spans)
+
+    def close(self) -> None:
+        """Writes the spans not written yet."""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if spans:
+            self._write(spans)
+
+    def _write(self, spans: List[Span]) -> None:
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", self.service)]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [_otlp_span(span) for span in spans]}],
+        }]}
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # 64 bit integers are strings in OTLP JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    return {"key": key, "value": _otlp_value(value)}
+
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    otlp = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # SPAN_KIND_INTERNAL
+        "kind": 1,
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end_time),
+        "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items() if value is not None],
+        # STATUS_CODE_OK or STATUS_CODE_ERROR
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id is not None:
+        otlp["parentSpanId"] = span.parent_id
+    return otlp
+
+
+class Tracer:
+    """Starts spans and reports them when they end.
+
+    Spans are always tracked, so that log lines carry the ids of the update they belong to.
+    With ``log_spans`` every finished span is also logged, with its duration and attributes, and
+    with an ``exporter`` it is exported, e.g. by :class:`OtlpFileExporter`.
+
+    Args:
+        log_spans (:obj:`bool`, optional): Whether to log finished spans.
+        exporter (:class:`OtlpFileExporter`, optional): Exporter of finished spans.
+    """
+
+    def __init__(self, log_spans: bool = False, exporter: Optional[OtlpFileExporter] = None) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.log_spans = log_spans
+        self.exporter = exporter
+        self.counters = {"spans": 0, "errors": 0}
+
+    def configure(self, log_spans: bool = False, exporter: Optional[OtlpFileExporter] = None) -> None:
+        """Sets how finished spans are reported, closing the previous exporter."""
+        self.close()
+        self.log_spans = log_spans
+        self.exporter = exporter
+
+    @staticmethod
+    def current() -> Optional[Span]:
+        """Returns the current span, :obj:`None` outside of a trace."""
+        return _current.get()
+
+    def start_span(self, name: str, parent: Union[Span, None, Any] = _CURRENT, **attributes: Any) -> Span:
+        """
+        Starts a span without making it current, e.g. for a request made on behalf of several traces
+        :param name: Name of the operation
+        :param parent: Enclosing span, defaults to the current span, :obj:`None` starts a new trace
+        :param attributes: Attributes of the span
+        :return: The span, to be ended with :meth:`Span.end`
+        """
+        return Span(self, name, _current.get() if parent is _CURRENT else parent, attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, parent: Union[Span, None, Any] = _CURRENT, **attributes: Any) -> Iterator[Span]:
+        """
+        Times the block as a span, current while the block runs
+        :param name: Name of the operation
+        :param parent: Enclosing span, defaults to the current span, :obj:`None` starts a new trace
+        :param attributes: Attributes of the span
+        """
+        span = self.start_span(name, parent, **attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as excp:
+            span.end(excp)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+    @staticmethod
+    def detach() -> None:
+        """Leaves the current trace, for background tasks started while handling an update."""
+        _current.set(None)
+
+    def _finished(self, span: Span) -> None:
+        self.counters["spans"] += 1
+        if span.error:
+            self.counters["errors"] += 1
+        if self.log_spans:
+            self.logger.info("Span %s took %.1f ms", span.name, span.duration * 1000, extra=dict(
+                span.fields, **span.attributes, span=span.name, duration_ms=round(span.duration * 1000, 3),
+                trace_id=span.trace_id, span_id=span.span_id, parent_id=span.parent_id, error=span.error))
+        if self.exporter is not None:
+            try:
+                self.exporter.export(span)
+            except OSError as excp:
+                self.logger.warning("Failed to export spans: %s", excp)
+
+    def close(self) -> None:
+        """Writes the spans the exporter holds."""
+        if self.exporter is not None:
+            try:
+                self.exporter.close()
+            except OSError as excp:
+                self.logger.warning("Failed to export spans: %s", excp)
+
+
+class TraceContextFilter(logging.Filter):
+    """Adds ``trace_id``, ``span_id`` and the correlation attributes of the current span to log
+    records, add it to the handlers whose formatter writes them, e.g. the JSON formatter."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = _current.get()
+        if span is not None:
+            for key, value in (("trace_id", span.trace_id), ("span_id", span.span_id), *span.fields.items()):
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+# tracer of this process
+TRACER = Tracer()
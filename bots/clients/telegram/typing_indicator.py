@@ -0,0 +1,117 @@
+"""This module contains the TypingIndicator class, keeping at most one typing indicator per chat."""
+
+import asyncio
+import contextlib
+import logging
+from typing import Any, AsyncIterator, Dict, Optional, Union
+
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
+
+# Bot API methods after which Telegram stops showing the chat action
+MESSAGE_ENDPOINTS = frozenset({
+    "sendMessage", "sendPhoto", "sendDocument", "sendAudio", "sendVideo", "sendVoice", "sendSticker",
+    "sendAnimation", "sendMediaGroup", "sendLocation", "sendPoll", "sendDice",
+})
+
+# chats whose indicator expired are only cleaned up once there are more than this many
+_MAX_CHATS = 4096
+
+
+class _Typing:
+    __slots__ = ("users", "task")
+
+    def __init__(self) -> None:
+        self.users = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class TypingIndicator:
+    """Sends ``typing`` chat actions, at most one per chat every ``interval`` seconds.
+
+    Telegram shows a chat action for 5 seconds or until the bot sends a message to the chat.
+    :meth:`ping` only calls the API if the chat is not showing the indicator already, and
+    :meth:`typing` keeps it up for as long as work for the chat is in progress, however many
+    handlers are working on the chat. Sent messages are reported with :meth:`observe`,
+    :class:`clients.telegram.rate_limiter.TokenBucketRateLimiter` does that for every request.
+
+    Args:
+        bot (:class:`telegram.Bot`): Bot to send the chat actions with.
+        interval (:obj:`float`, optional): Seconds an indicator is assumed to be shown.
+    """
+
+    def __init__(self, bot: Any, interval: float = 4.5) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.bot = bot
+        self.interval = interval
+        # loop time of the last indicator per chat, removed when a message is sent to it
+        self._shown: Dict[Union[int, str], float] = {}
+        self._typing: Dict[Union[int, str], _Typing] = {}
+        self.stats = {"sent": 0, "suppressed": 0, "failed": 0}
+
+    def observe(self, endpoint: str, data: Dict[str, Any]) -> None:
+        """Notes a successful Bot API request, a sent message hides the chat's indicator."""
+        if endpoint in MESSAGE_ENDPOINTS and data.get("chat_id") is not None:
+            self._shown.pop(self._key(data["chat_id"]), None)
+
+    @staticmethod
+    def _key(chat_id: Any) -> Union[int, str]:
+        try:
+            return int(chat_id)
+        except (ValueError, TypeError):
+            return chat_id
+
+    async def ping(self, chat_id: Union[int, str]) -> None:
+        """
+        Shows the typing indicator in a chat unless it is shown already
+        :param chat_id: Id of the chat
+        """
+        key = self._key(chat_id)
+        now = asyncio.get_running_loop().time()
+        shown = self._shown.get(key)
+        if shown is not None and now - shown < self.interval:
+            self.stats["suppressed"] += 1
+            return
+
+        if len(self._shown) > _MAX_CHATS:
+            self._shown = {chat: at for chat, at in self._shown.items() if now - at < self.interval}
+        # set before sending, concurrent pings for the chat are suppressed
+        self._shown[key] = now
+        try:
+            await self.bot.send_chat_action(chat_id, ChatAction.TYPING)
+            self.stats["sent"] += 1
+        except TelegramError as excp:
+            # only cosmetic, the handler goes on
+            self._shown.pop(key, None)
+            self.stats["failed"] += 1
+            self.logger.warning("Failed to send typing indicator: %s", excp)
+
+    async def _keep(self, chat_id: Union[int, str]) -> None:
+        loop = asyncio.get_running_loop()
+        key = self._key(chat_id)
+        while True:
+            await self.ping(chat_id)
+            shown = self._shown.get(key, loop.time())
+            # wakes up right when the indicator runs out, a message sent meanwhile hides it earlier
+            await asyncio.sleep(max(shown + self.interval - loop.time(), 0.5))
+
+    @contextlib.asynccontextmanager
+    async def typing(self, chat_id: Union[int, str]) -> AsyncIterator[None]:
+        """
+        Keeps the typing indicator up in a chat while the block runs
+        :param chat_id: Id of the chat
+        """
+        key = self._key(chat_id)
+        entry = self._typing.get(key)
+        if entry is None:
+            entry = self._typing[key] = _Typing()
+            entry.task = asyncio.get_running_loop().create_task(self._keep(chat_id))
+        entry.users += 1
+        try:
+            yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._typing[key]
+                entry.task.cancel()
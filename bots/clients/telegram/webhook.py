@@ -0,0 +1,98 @@
+"""This module contains the TelegramWebhook class, which receives updates Telegram pushes to the bot
+instead of the bot long polling ``getUpdates``."""
+
+import hmac
+import logging
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Application
+
+from clients.telegram.http_server import HttpRequest, HttpResponse, HttpServer
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+class TelegramWebhook:
+    """Puts the updates Telegram ``POST``s to ``path`` on the application's update queue.
+
+    Any number of bot replicas can serve the same webhook URL behind a load balancer, the
+    updates are processed by whichever replica received them. Once the application stopped
+    running updates are answered with ``503``, which Telegram retries later. Besides single
+    updates the body can be a list of updates, as forwarded by
+    :class:`clients.telegram.sharding.ShardRouter`.
+
+    Args:
+        application (:class:`telegram.ext.Application`): Application processing the updates.
+        url (:obj:`str`, optional): Public HTTPS URL of the webhook, registered with Telegram by
+            :meth:`register`. Left alone if not set, e.g. when registered by the deployment.
+        path (:obj:`str`, optional): Path the updates are posted to.
+        secret_token (:obj:`str`, optional): Expected value of the
+            ``X-Telegram-Bot-Api-Secret-Token`` header, 1-256 characters ``A-Z``, ``a-z``,
+            ``0-9``, ``_`` and ``-``.
+        max_connections (:obj:`int`, optional): Connections Telegram opens at most to deliver
+            updates, 1-100.
+    """
+
+    def __init__(
+        self,
+        application: Application,
+        url: Optional[str] = None,
+        path: str = "/telegram",
+        secret_token: Optional[str] = None,
+        max_connections: int = 40,
+    ) -> None:
+        self.logger = logging.getLogger(__name__)
+
+        self.application = application
+        self.url = url
+        self.path = path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.stats = {"updates": 0, "rejected": 0, "invalid": 0, "unavailable": 0}
+
+        if not secret_token:
+            self.logger.warning("No webhook secret token set, anybody can post updates to %s", path)
+
+    def attach(self, server: HttpServer) -> None:
+        """Registers the update route on a :class:`HttpServer`."""
+        server.route("POST", self.path, self.handle_update)
+
+    async def register(self, drop_pending_updates: bool = False) -> None:
+        """
+        Tells Telegram to deliver updates to :attr:`url`, does nothing if it is not set
+        :param drop_pending_updates: Whether to drop the updates Telegram did not deliver yet
+        """
+        if not self.url:
+            return
+        await self.application.bot.set_webhook(
+            url=self.url,
+            secret_token=self.secret_token,
+            max_connections=self.max_connections,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=drop_pending_updates,
+        )
+        self.logger.info("Webhook registered at %s", self.url)
+
+    async def handle_update(self, request: HttpRequest) -> HttpResponse:
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.stats["rejected"] += 1
+            return 401, {"code": "UNAUTHORIZED", "message": "Invalid secret token"}
+
+        if not self.application.running:
+            self.stats["unavailable"] += 1
+            return 503, {"code": "SERVICE_UNAVAILABLE", "message": "Not accepting updates"}
+
+        try:
+            data = request.json()
+            updates = Update.de_list(data if isinstance(data, list) else [data], self.application.bot)
+        except (ValueError, KeyError, TypeError):
+            updates = []
+        if not updates:
+            self.stats["invalid"] += 1
+            return 400, {"code": "BAD_REQUEST", "message": "Expected an update or a list of updates"}
+
+        self.stats["updates"] += len(updates)
+        for update in updates:
+            await self.application.update_queue.put(update)
+        return 200, ""
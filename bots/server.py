@@ -1,37 +1,203 @@
 from clients.telegram.bot import Telegram
-from pythonjsonlogger import jsonlogger
+from clients.telegram.http_server import HttpServer
+from clients.telegram.inquire import InquireClient
+from clients.telegram.logs import JsonFormatter, QueueLogging, SamplingFilter
+from clients.telegram.metrics import REGISTRY
+from clients.telegram.persona_listing import render_commands
+from clients.telegram.sharding import ShardRouter
+from clients.telegram.tracing import TraceContextFilter
+from telegram import Bot, Update
+import argparse
+import asyncio
 import logging
-import datetime
+import os
+import signal
+import subprocess
+import sys
+from typing import Sequence
 import dotenv
 dotenv.load_dotenv()
 
 
-class CustomJsonFormatter(jsonlogger.JsonFormatter):
-    def add_fields(self, log_record, record, message_dict):
-        super(CustomJsonFormatter, self).add_fields(
-            log_record, record, message_dict)
+def setup_logging() -> QueueLogging:
+    """
+    Logs JSON lines to stderr from a background thread, keeping the share of the lines of the loggers
+    in LOG_SAMPLING, e.g. clients.telegram.commands=0.1
+    :return: QueueLogging object, stop it to write the queued lines
+    """
+    logHandler = logging.StreamHandler()
+    logHandler.setFormatter(JsonFormatter(static_fields={'app': 'bots'}))
+    sampling = SamplingFilter.parse(os.environ.get('LOG_SAMPLING', ''))
+    # adds the trace, span, update, chat, user and inquiry ids to the lines logged while handling an update
+    filters = [sampling, TraceContextFilter()]
+
+    # lines waiting to be written at most, 0 writes them from the thread logging
+    logs = QueueLogging([logHandler], filters=filters, max_queue=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    logs.start(logging.INFO)
+    REGISTRY.add_stats("bot_logging", "Logging", lambda: dict(logs.stats(), **sampling.stats))
+    return logs
+
+
+async def export_commands(output: str) -> None:
+    """
+    Writes the base commands and all personas in the format of @BotFather's /setcommands
+    :param output: File to write to, - for stdout
+    """
+    inquire = InquireClient(os.environ.get('INQUIRE_API'), os.environ.get('INQUIRE_API_KEY'))
+    try:
+        personas, _, _ = await inquire.list_personas()
+    finally:
+        await inquire.close()
+
+    commands = render_commands(personas)
+    if output == "-":
+        sys.stdout.write(commands)
+    else:
+        with open(output, "w") as f:
+            f.write(commands)
+
+
+async def watch_workers(processes: Sequence[subprocess.Popen], router: ShardRouter, stop: asyncio.Event) -> None:
+    """
+    Stops the ingress once a worker exited, instead of taking updates that can't be delivered
+    :param processes: Worker processes, the index is the shard
+    :param router: ShardRouter object
+    :param stop: Event stopping the ingress
+    """
+    while not stop.is_set():
+        for shard, process in enumerate(processes):
+            if process.poll() is not None:
+                logging.getLogger(__name__).error("Worker %d exited with %s, stopping", shard, process.returncode)
+                router.worker_exited(shard)
+                stop.set()
+                return
+        await asyncio.sleep(0.5)
+
 
-        log_record['app'] = 'bots'
-        log_record['msg'] = record.message
+async def run_ingress(workers: int, webhook: bool, processes: Sequence[subprocess.Popen] = ()) -> None:
+    """
+    Routes updates to the workers of a sharded bot until SIGINT or SIGTERM or until a worker exits, then
+    forwards the queued ones
+    :param workers: Number of workers, listening on consecutive ports from SHARD_BASE_PORT
+    :param webhook: Whether to serve the webhook instead of polling
+    :param processes: Worker processes to watch
+    """
+    base_port = int(os.environ.get('SHARD_BASE_PORT', 8600))
+    path = os.environ.get('WEBHOOK_PATH', '/telegram')
+    secret = os.environ.get('WEBHOOK_SECRET')
+    router = ShardRouter([f"http://127.0.0.1:{base_port + shard}{path}" for shard in range(workers)],
+                         secret_token=secret, path=path)
+    bot = Bot(os.environ.get('TELEGRAM_API_KEY'))
 
-        if not log_record.get('time'):
-            # this doesn't use record.created, so it is slightly off
-            now = int((datetime.datetime.utcnow() -
-                      datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
-            log_record['time'] = now
-        if log_record.get('level'):
-            log_record['level'] = log_record['level'].upper()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    # the ingress serves its own metrics, the workers' are on the following ports
+    metrics_server = None
+    if os.environ.get('METRICS_PORT'):
+        metrics_server = HttpServer(os.environ.get('METRICS_HOST', '127.0.0.1'), int(os.environ['METRICS_PORT']))
+        REGISTRY.attach(metrics_server)
+        REGISTRY.add_stats("bot_shard_router", "Shard router", lambda: router.stats)
+
+    await bot.initialize()
+    await router.start()
+    watcher = loop.create_task(watch_workers(processes, router, stop))
+    server = None
+    try:
+        if metrics_server is not None:
+            await metrics_server.start()
+        if webhook:
+            max_connections = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+            server = HttpServer(os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'), int(os.environ.get('WEBHOOK_PORT', 8443)),
+                                max_connections=max_connections,
+                                idle_timeout=float(os.environ.get('WEBHOOK_IDLE_TIMEOUT', 30)))
+            router.attach(server)
+            await server.start()
+            if os.environ.get('WEBHOOK_URL'):
+                await bot.set_webhook(os.environ['WEBHOOK_URL'], secret_token=secret,
+                                      max_connections=max_connections, allowed_updates=Update.ALL_TYPES)
+            await stop.wait()
         else:
-            log_record['level'] = record.levelname
+            await router.poll(bot, stop)
+    finally:
+        watcher.cancel()
+        if server is not None:
+            await server.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await router.stop()
+        await bot.shutdown()
+        logging.getLogger(__name__).info("Ingress stopped, stats: %s, per shard: %s", router.stats, router.forwarded)
+
+
+def run_sharded(workers: int, webhook: bool) -> None:
+    """
+    Starts the workers of a sharded bot as child processes and routes the updates to them
+    :param workers: Number of workers
+    :param webhook: Whether to serve the webhook instead of polling
+    """
+    # checked before starting, every worker would fail to load its shard while the ingress takes updates
+    if os.environ.get('DB_URI', '').split('://', 1)[0] not in ('file', 'sqlite') and \
+            os.environ.get('DB_NORMALIZED', 'false').lower() != 'true':
+        sys.exit("Sharded workers need the normalized storage, set DB_NORMALIZED=true")
+
+    base_port = int(os.environ.get('SHARD_BASE_PORT', 8600))
+    processes = []
+    for shard in range(workers):
+        env = dict(os.environ, WEBHOOK_LISTEN='127.0.0.1', WEBHOOK_PORT=str(base_port + shard))
+        # several workers can't share the notification port, they poll the inquiries instead
+        env.pop('INQUIRY_NOTIFY_PORT', None)
+        if os.environ.get('METRICS_PORT'):
+            env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + 1 + shard)
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker", "--shard", str(shard), "--shards", str(workers)],
+            env=env, start_new_session=True))
+    try:
+        asyncio.run(run_ingress(workers, webhook, processes))
+    finally:
+        exited = [shard for shard, process in enumerate(processes) if process.poll() is not None]
+        # the workers are in their own session, so a Ctrl-C only reaches the ingress, and drain
+        # once it forwarded everything
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in processes:
+            process.wait()
+    if exited:
+        sys.exit(f"Workers {exited} exited, stopped the ingress")
 
 
 if __name__ == "__main__":
-    # start telegram bot
-    logHandler = logging.StreamHandler()
-    formatter = CustomJsonFormatter('%(level)s %(time)s %(msg)s %(name)s')
-    logHandler.setFormatter(formatter)
-    logging.basicConfig(level=logging.INFO, handlers=[
-        logHandler
-    ])
+    parser = argparse.ArgumentParser(description="Inquire Telegram bot")
+    subcommands = parser.add_subparsers(dest="command")
+    subcommands.add_parser("run", help="run the bot polling for updates (default)")
+    subcommands.add_parser(
+        "webhook", help="run the bot serving updates pushed to a webhook, configured by the WEBHOOK_* variables")
+    sharded = subcommands.add_parser(
+        "sharded", help="run the bot as worker processes, each handling a shard of the chats")
+    sharded.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of workers")
+    sharded.add_argument("--webhook", action="store_true", help="serve the webhook instead of polling")
+    worker = subcommands.add_parser(
+        "worker", help="run one worker of a sharded bot, taking updates from the ingress on WEBHOOK_PORT")
+    worker.add_argument("--shard", type=int, required=True, help="index of the shard")
+    worker.add_argument("--shards", type=int, required=True, help="number of shards")
+    setcommands = subcommands.add_parser(
+        "setcommands", help="print the command list to send to @BotFather's /setcommands")
+    setcommands.add_argument("-o", "--output", default="-", help="file to write to instead of stdout")
+    args = parser.parse_args()
 
-    telegram = Telegram()
+    logs = setup_logging()
+    try:
+        if args.command == "setcommands":
+            asyncio.run(export_commands(args.output))
+        elif args.command == "sharded":
+            run_sharded(args.workers, args.webhook)
+        elif args.command == "worker":
+            telegram = Telegram(webhook=True, shard=(args.shard, args.shards))
+        else:
+            # start telegram bot
+            telegram = Telegram(webhook=args.command == "webhook")
+    finally:
+        logs.stop()
@@ -6,6 +6,8 @@ const EnvSchema = z.object({
   DATABASE_PASSWORD: z.string(),
   OPENAI_API_KEY: z.string(),
   DUST_API_KEY: z.string(),
+  INQUIRY_NOTIFY_URL: z.string().optional(),
+  INQUIRY_NOTIFY_SECRET: z.string().optional(),
 });
 
 export const env = EnvSchema.parse(process.env);
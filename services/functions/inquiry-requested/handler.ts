@@ -8,6 +8,7 @@ import { completeInquiryWithOpenAI } from "../../inquiries/complete-inquiry-open
 import { completeInquiryWithDust } from "../../inquiries/complete-inquiry-dust";
 import { updateInquiryWithPlanetScale } from "../../inquiries/update-inquiry-planetscale";
 import { UpdateInquiryHandler } from "../../inquiries/update-inquiry.interface";
+import { notifyInquiryWithWebhook } from "../../inquiries/notify-inquiry-webhook";
 import { connect } from "@planetscale/database";
 import { fetch } from "undici";
 import { logger } from "../../utils/logger";
@@ -47,10 +48,20 @@ export const completeInquiry: CompleteInquiryHandler = async (args) => {
   }
 };
 
-export const updateInquiry: UpdateInquiryHandler = (id, args) => {
-  return updateInquiryWithPlanetScale(id, args, {
+export const updateInquiry: UpdateInquiryHandler = async (id, args) => {
+  const inquiry = await updateInquiryWithPlanetScale(id, args, {
     conn,
   });
+
+  // push the final status to the bot so it can skip polling for it
+  if (env.INQUIRY_NOTIFY_URL && inquiry.connectionType === "TELEGRAM") {
+    await notifyInquiryWithWebhook(inquiry, {
+      url: env.INQUIRY_NOTIFY_URL,
+      secret: env.INQUIRY_NOTIFY_SECRET,
+    });
+  }
+
+  return inquiry;
 };
 
 /* c8 ignore next 22 */
@@ -0,0 +1,70 @@
+import axios from "axios";
+import { afterEach, describe, expect, it, Mock, vi } from "vitest";
+import { notifyInquiryWithWebhook } from "./notify-inquiry-webhook";
+import { Inquiry } from "./update-inquiry.interface";
+
+vi.mock("axios", () => {
+  return {
+    default: {
+      post: vi.fn(),
+    },
+  };
+});
+
+const mockPost = axios.post as Mock;
+
+describe("notifyInquiryWithWebhook tests", () => {
+  const inquiry = {
+    id: "id",
+    connectionType: "TELEGRAM",
+    connectionUserId: "connectionUserId",
+    createdAt: new Date(),
+    updatedAt: new Date(),
+    query: "query",
+    queryType: "queryType",
+    status: "COMPLETED",
+    result: "result",
+  } satisfies Inquiry;
+
+  afterEach(() => {
+    vi.clearAllMocks();
+  });
+
+  it("should post the inquiry to the webhook with the secret header", async () => {
+    mockPost.mockResolvedValueOnce({ status: 200 });
+
+    await notifyInquiryWithWebhook(inquiry, {
+      url: "http://bot:8081",
+      secret: "secret",
+    });
+
+    expect(mockPost).toHaveBeenCalledWith(
+      "http://bot:8081/inquiries/id",
+      { data: inquiry },
+      {
+        headers: {
+          "Content-Type": "application/json",
+          "x-notify-secret": "secret",
+        },
+        timeout: 5_000,
+      }
+    );
+  });
+
+  it("should not notify inquiries that are still requested", async () => {
+    await notifyInquiryWithWebhook(
+      { ...inquiry, status: "REQUESTED" },
+      { url: "http://bot:8081" }
+    );
+
+    expect(mockPost).not.toHaveBeenCalled();
+  });
+
+  it("should not throw if the webhook call fails", async () => {
+    mockPost.mockRejectedValueOnce(new Error("Mock Error"));
+
+    await expect(
+      notifyInquiryWithWebhook(inquiry, { url: "http://bot:8081" })
+    ).resolves.toBeUndefined();
+  });
+});
@@ -0,0 +1,32 @@
+import axios from "axios";
+import { logger } from "../utils/logger";
+import { Inquiry } from "./update-inquiry.interface";
+
+/**
+ * Notifies a bot's completion webhook that an inquiry reached a final status,
+ * so the bot does not have to poll `/inquiries/{id}` for it.
+ * Failures are only logged, the bot falls back to polling on missed notifications.
+ */
+export async function notifyInquiryWithWebhook(
+  inquiry: Inquiry,
+  ctx: { url: string; secret?: string }
+) {
+  if (inquiry.status === "REQUESTED") return;
+
+  try {
+    await axios.post(
+      `${ctx.url}/inquiries/${inquiry.id}`,
+      { data: inquiry },
+      {
+        headers: {
+          "Content-Type": "application/json",
+          ...(ctx.secret ? { "x-notify-secret": ctx.secret } : {}),
+        },
+        timeout: 5_000,
+      }
+    );
+    logger.info("Inquiry completion notified");
+  } catch (error) {
+    logger.warn("Failed to notify inquiry completion", { error });
+  }
+}